@@ -0,0 +1,143 @@
+import os
+import shutil
+import uuid
+
+from diferido import importar_diferido
+from indices import INDICES, columnas_indice
+
+pd = importar_diferido('pandas')
+
+# pyarrow es opcional: solo se necesita para el dataset Parquet. pyarrow.dataset se importa
+# en las funciones que lo usan, porque importarlo carga todo pyarrow
+try:
+    pa = importar_diferido('pyarrow')
+except ImportError:
+    pa = None
+
+# Columnas por escena guardadas en el dataset, en orden. Hay columnas para todos los índices
+# disponibles, aunque no se hayan calculado, para que todos los archivos compartan el esquema
+COLUMNAS_ESCENA = (['date', 'scene_id', 'tile', 'cloud_cover'] + columnas_indice('NDVI') + ['valid_pixels']
+                   + [c for indice in INDICES if indice != 'NDVI' for c in columnas_indice(indice)])
+
+def pyarrow_disponible():
+    """Indica si pyarrow está instalado"""
+    return pa is not None
+
+def esquema_escenas():
+    """Esquema Arrow de las filas por escena, sin las columnas de partición"""
+    tipos = {'date': pa.date32(), 'scene_id': pa.string(), 'tile': pa.string(), 'valid_pixels': pa.int64()}
+    return pa.schema([(columna, tipos.get(columna, pa.float64())) for columna in COLUMNAS_ESCENA])
+
+def esquema_dataset():
+    """Esquema completo de los archivos del dataset: escenas, momento de escritura y particiones"""
+    return (esquema_escenas().append(pa.field('written_at', pa.timestamp('us', tz='UTC')))
+            .append(pa.field('polygon', pa.string())).append(pa.field('year', pa.int32())))
+
+def particionado():
+    """Particiones hive polygon=<sitio>/year=<año>"""
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([('polygon', pa.string()), ('year', pa.int32())]), flavor='hive')
+
+def tabla_escenas(polygon_name, df):
+    """Convierte el DataFrame por escena en una tabla Arrow tipada con sus columnas de partición"""
+    df = df.reindex(columns=COLUMNAS_ESCENA).copy()
+    fechas = pd.to_datetime(df['date'])
+    df['date'] = fechas.dt.date
+    df['scene_id'] = df['scene_id'].fillna('').astype(str)
+    df['tile'] = df['tile'].fillna('').astype(str)
+    df['valid_pixels'] = pd.to_numeric(df['valid_pixels']).round().astype('Int64')
+    tabla = pa.Table.from_pandas(df, schema=esquema_escenas(), preserve_index=False)
+    # Orden de escritura: si una escena se escribió más de una vez, al leer vale la última
+    escrito = pd.Timestamp.now(tz='UTC')
+    tabla = tabla.append_column('written_at', pa.array([escrito] * len(df), pa.timestamp('us', tz='UTC')))
+    tabla = tabla.append_column('polygon', pa.array([polygon_name] * len(df), pa.string()))
+    return tabla.append_column('year', pa.array(fechas.dt.year, pa.int32()))
+
+def escribir_escenas(dataset_dir, polygon_name, df, reemplazar=False):
+    """Agrega las escenas de un polígono al dataset; devuelve el número de filas escritas.
+
+    Cada llamada escribe archivos nuevos, así que agregar escenas no reescribe las ya
+    guardadas. Con `reemplazar` la partición del polígono se escribe aparte y sustituye
+    a la anterior con dos renombres: la anterior se aparta y la nueva ocupa su lugar. Un
+    lector ve una u otra completa, nunca una a medias (entre los dos renombres puede no
+    encontrar ninguna), y la anterior se borra recién después.
+    """
+    import pyarrow.dataset as ds
+    if df.empty:
+        return 0
+    tabla = tabla_escenas(polygon_name, df)
+    plantilla = f"{uuid.uuid4().hex}-{{i}}.parquet"
+    if not reemplazar:
+        ds.write_dataset(tabla, dataset_dir, format='parquet', partitioning=particionado(),
+                         basename_template=plantilla, existing_data_behavior='overwrite_or_ignore')
+        return tabla.num_rows
+
+    # Los directorios que empiezan con '.' no se leen como parte del dataset
+    temporal = os.path.join(dataset_dir, f".{uuid.uuid4().hex}.tmp")
+    anterior = os.path.join(dataset_dir, f".{uuid.uuid4().hex}.old")
+    try:
+        ds.write_dataset(tabla, temporal, format='parquet', partitioning=particionado(),
+                         basename_template=plantilla)
+        # El nombre del directorio de partición lo codifica pyarrow
+        particion = os.listdir(temporal)[0]
+        destino = os.path.join(dataset_dir, particion)
+        if os.path.exists(destino):
+            os.rename(destino, anterior)
+        try:
+            os.rename(os.path.join(temporal, particion), destino)
+        except OSError:
+            # Si la nueva no pudo ocupar su lugar, vuelve la anterior
+            if os.path.exists(anterior):
+                os.rename(anterior, destino)
+            raise
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+        shutil.rmtree(anterior, ignore_errors=True)
+    return tabla.num_rows
+
+def leer_escenas(dataset_dir, poligonos=None, desde=None, hasta=None, columnas=None, filtro=None):
+    """Lee escenas del dataset como DataFrame, filtrando en la lectura.
+
+    Los filtros por polígono y año descartan particiones completas sin abrirlas; los de fecha
+    y el `filtro` adicional (una expresión de pyarrow.dataset, p. ej.
+    `ds.field('cloud_cover') < 10`) se aplican sobre las estadísticas de cada archivo Parquet.
+    Las escenas repetidas de un mismo polígono se cuentan una sola vez, con la versión
+    escrita más recientemente (`written_at`; los archivos anteriores a esa columna cuentan
+    como los más antiguos).
+    """
+    import pyarrow.dataset as ds
+    if not os.path.isdir(dataset_dir):
+        return pd.DataFrame(columns=columnas or ['polygon', 'year'] + COLUMNAS_ESCENA + ['written_at'])
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=particionado(), schema=esquema_dataset())
+
+    condiciones = []
+    if poligonos is not None:
+        condiciones.append(ds.field('polygon').isin(list(poligonos)))
+    if desde is not None:
+        desde = pd.to_datetime(desde)
+        condiciones.append(ds.field('year') >= desde.year)
+        condiciones.append(ds.field('date') >= pa.scalar(desde.date(), pa.date32()))
+    if hasta is not None:
+        hasta = pd.to_datetime(hasta)
+        condiciones.append(ds.field('year') <= hasta.year)
+        condiciones.append(ds.field('date') <= pa.scalar(hasta.date(), pa.date32()))
+    if filtro is not None:
+        condiciones.append(filtro)
+
+    expresion = None
+    for condicion in condiciones:
+        expresion = condicion if expresion is None else expresion & condicion
+
+    # Las columnas para descartar repetidas se leen siempre, aunque no se hayan pedido
+    leidas = None if columnas is None else list(dict.fromkeys(list(columnas) + ['polygon', 'scene_id', 'written_at']))
+    df = dataset.to_table(columns=leidas, filter=expresion).to_pandas()
+    # El orden en que se recorren los archivos es arbitrario: se ordena por escritura antes de descartar
+    df = df.sort_values('written_at', kind='stable', na_position='first')
+    repetidas = df.duplicated(['polygon', 'scene_id'], keep='last') & (df['scene_id'] != '')
+    df = df[~repetidas]
+    if columnas is not None:
+        df = df[list(columnas)]
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+        df = df.sort_values([c for c in ('polygon', 'date') if c in df.columns])
+    return df.reset_index(drop=True)
@@ -0,0 +1,55 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+def huella_escenas(ids):
+    """Huella corta del conjunto de escenas de un compuesto; cambia solo si entra o sale alguna escena"""
+    return hashlib.sha256(','.join(sorted(ids)).encode('utf-8')).hexdigest()[:16]
+
+def entrada_miniatura(cache_dir, polygon_hash, filename, origen, params):
+    """Entrada de la caché de miniaturas de un producto mensual.
+
+    La clave combina el origen del compuesto (mes, umbral de nubes y, si el mes sigue abierto,
+    la huella de sus escenas) con los parámetros de visualización; la región queda fijada por
+    el hash del polígono.
+    """
+    visualizacion = {k: v for k, v in params.items() if k != 'region'}
+    contenido = json.dumps({'origen': origen, 'params': visualizacion}, sort_keys=True)
+    nombre, extension = os.path.splitext(filename)
+    return {
+        'dir': os.path.join(cache_dir, polygon_hash),
+        'nombre': nombre,
+        'clave': hashlib.sha256(contenido.encode('utf-8')).hexdigest()[:16],
+        'extension': extension
+    }
+
+def _ruta(entrada):
+    return os.path.join(entrada['dir'], f"{entrada['nombre']}.{entrada['clave']}{entrada['extension']}")
+
+def copiar_miniatura(entrada, output_path):
+    """Copia la miniatura cacheada al destino; devuelve False si no está"""
+    ruta = _ruta(entrada)
+    if not os.path.exists(ruta):
+        return False
+    shutil.copyfile(ruta, output_path)
+    return True
+
+def guardar_miniatura(entrada, archivo):
+    """Guarda una copia de la miniatura descargada y borra las versiones anteriores del mismo producto"""
+    os.makedirs(entrada['dir'], exist_ok=True)
+    ruta = _ruta(entrada)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.copyfile(archivo, temporal)
+    os.replace(temporal, ruta)
+    # Las versiones con otra clave son de un mes abierto que ya cambió de escenas
+    prefijo = f"{entrada['nombre']}."
+    for nombre in os.listdir(entrada['dir']):
+        anterior = os.path.join(entrada['dir'], nombre)
+        if (nombre.startswith(prefijo) and nombre.endswith(entrada['extension']) and anterior != ruta
+                and len(nombre) == len(os.path.basename(ruta))):
+            try:
+                os.remove(anterior)
+            except OSError:
+                pass
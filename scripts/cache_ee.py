@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from limitador import solicitud
+from metricas import contar
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS respuestas (
+    clave TEXT PRIMARY KEY,
+    valor TEXT NOT NULL,
+    guardado REAL NOT NULL,
+    expira REAL
+);
+CREATE INDEX IF NOT EXISTS respuestas_expira ON respuestas (expira);
+"""
+
+# Ruta de la caché activa; None deja que evaluar() consulte siempre al servidor
+_ruta = None
+_lock = threading.Lock()
+_conteos = {'aciertos': 0, 'consultas': 0}
+
+@contextmanager
+def conectar(ruta):
+    """Abre la caché en una transacción, creando el archivo y su tabla si no existen"""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    conexion = sqlite3.connect(ruta, timeout=30)
+    try:
+        conexion.executescript(ESQUEMA)
+        with conexion:
+            yield conexion
+    finally:
+        conexion.close()
+
+def activar_cache(ruta):
+    """Activa la caché persistente en `ruta` y borra las respuestas vencidas"""
+    global _ruta
+    with conectar(ruta) as conexion:
+        vencidas = conexion.execute("DELETE FROM respuestas WHERE expira IS NOT NULL AND expira <= ?",
+                                    (time.time(),)).rowcount
+    _ruta = ruta
+    if vencidas:
+        print(f"🧹 Caché de Earth Engine: {vencidas} respuestas vencidas eliminadas")
+
+def clave_expresion(objeto):
+    """Clave de una evaluación: hash del grafo de expresiones serializado de Earth Engine"""
+    return hashlib.sha256(objeto.serialize().encode('utf-8')).hexdigest()
+
+def consultar(objeto):
+    """getInfo() a través del limitador de solicitudes, que mide su latencia"""
+    with solicitud('ee_getinfo'):
+        return objeto.getInfo()
+
+def evaluar(objeto, ttl=None):
+    """getInfo() con caché persistente de la respuesta.
+
+    `ttl` en segundos: None guarda la respuesta sin vencimiento (datos pasados que ya no
+    cambian) y 0 no la guarda. Los errores no se cachean.
+    """
+    if _ruta is None or ttl == 0:
+        return consultar(objeto)
+    clave = clave_expresion(objeto)
+    ahora = time.time()
+    with conectar(_ruta) as conexion:
+        fila = conexion.execute("SELECT valor FROM respuestas WHERE clave = ? AND (expira IS NULL OR expira > ?)",
+                                (clave, ahora)).fetchone()
+    if fila is not None:
+        with _lock:
+            _conteos['aciertos'] += 1
+        contar('cache_ee_aciertos')
+        return json.loads(fila[0])
+
+    valor = consultar(objeto)
+    with _lock:
+        _conteos['consultas'] += 1
+    with conectar(_ruta) as conexion:
+        conexion.execute("INSERT OR REPLACE INTO respuestas VALUES (?, ?, ?, ?)",
+                         (clave, json.dumps(valor), ahora, None if ttl is None else ahora + ttl))
+    return valor
+
+def estadisticas_cache():
+    """Aciertos y consultas al servidor de la caché en esta corrida"""
+    with _lock:
+        return dict(_conteos)
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import math
+import os
+import threading
+
+from diferido import importar_diferido
+
+np = importar_diferido('numpy')
+
+# Presupuesto de disco por defecto para la caché de bandas
+PRESUPUESTO_GB = 5.0
+
+_lock = threading.Lock()
+
+def clave_raster(origen, polygon_hash, grid, bands):
+    """Clave de contenido de un arreglo de bandas.
+
+    `origen` identifica los datos (id de escena o compuesto mensual), `polygon_hash` el polígono
+    del registro, y la grilla completa (escala, dimensiones y origen) y las bandas el recorte pedido.
+    """
+    contenido = json.dumps({
+        'origen': origen,
+        'polygon': polygon_hash,
+        'grid': grid,
+        'bands': list(bands)
+    }, sort_keys=True)
+    return hashlib.sha256(contenido.encode('utf-8')).hexdigest()
+
+def _ruta(cache_dir, clave):
+    return os.path.join(cache_dir, clave[:2], f"{clave}.npy")
+
+def leer_raster(cache_dir, clave):
+    """Devuelve el arreglo cacheado como memmap de solo lectura, o None si no está"""
+    ruta = _ruta(cache_dir, clave)
+    try:
+        arreglo = np.load(ruta, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    # La fecha de modificación marca el último uso para la expulsión LRU
+    try:
+        os.utime(ruta)
+    except OSError:
+        pass
+    return arreglo
+
+def guardar_raster(cache_dir, clave, arreglo, presupuesto_bytes):
+    """Guarda un arreglo en la caché y expulsa los menos usados si se supera el presupuesto.
+
+    Con presupuesto infinito (compuestos de meses cerrados) no se expulsa nada.
+    """
+    if presupuesto_bytes <= 0:
+        return
+    ruta = _ruta(cache_dir, clave)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'wb') as f:
+        np.save(f, np.ascontiguousarray(arreglo))
+    os.replace(temporal, ruta)
+    if math.isfinite(presupuesto_bytes):
+        expulsar_lru(cache_dir, presupuesto_bytes)
+
+def expulsar_lru(cache_dir, presupuesto_bytes):
+    """Borra los arreglos usados hace más tiempo hasta que la caché quepa en el presupuesto"""
+    with _lock:
+        archivos = []
+        for raiz, _, nombres in os.walk(cache_dir):
+            for nombre in nombres:
+                if not nombre.endswith('.npy'):
+                    continue
+                ruta = os.path.join(raiz, nombre)
+                try:
+                    stat = os.stat(ruta)
+                except OSError:
+                    continue
+                archivos.append((stat.st_mtime, stat.st_size, ruta))
+
+        total = sum(tamano for _, tamano, _ in archivos)
+        if total <= presupuesto_bytes:
+            return
+        expulsados = 0
+        for _, tamano, ruta in sorted(archivos):
+            if total <= presupuesto_bytes:
+                break
+            try:
+                os.remove(ruta)
+                total -= tamano
+                expulsados += 1
+            except OSError:
+                pass
+        print(f"🧹 Caché de rasters: {expulsados} arreglos expulsados ({total / 1e9:.2f} GB en uso)")
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS escenas (
+    scene_index TEXT PRIMARY KEY,
+    product_id TEXT,
+    time_start INTEGER NOT NULL,
+    tile TEXT,
+    cloud_cover REAL,
+    west REAL,
+    south REAL,
+    east REAL,
+    north REAL
+);
+CREATE INDEX IF NOT EXISTS escenas_tiempo ON escenas (time_start);
+CREATE INDEX IF NOT EXISTS escenas_nubes ON escenas (cloud_cover, time_start);
+CREATE TABLE IF NOT EXISTS sincronizacion (
+    clave TEXT PRIMARY KEY,
+    valor TEXT
+);
+"""
+
+def ms_de_fecha(fecha):
+    """Convierte 'YYYY-MM-DD' (medianoche UTC, como filterDate) en milisegundos desde la época"""
+    return int(datetime.strptime(fecha, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+@contextmanager
+def conectar(ruta):
+    """Abre el catálogo en una transacción, creando el archivo y sus tablas si no existen"""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    conexion = sqlite3.connect(ruta, timeout=30)
+    conexion.row_factory = sqlite3.Row
+    try:
+        conexion.executescript(ESQUEMA)
+        with conexion:
+            yield conexion
+    finally:
+        conexion.close()
+
+def cobertura(ruta):
+    """Devuelve la fecha desde la que el catálogo está sincronizado y el time_start más reciente guardado"""
+    with conectar(ruta) as conexion:
+        fila = conexion.execute("SELECT valor FROM sincronizacion WHERE clave = 'inicio'").fetchone()
+        ultimo = conexion.execute("SELECT MAX(time_start) FROM escenas").fetchone()[0]
+    return (fila['valor'] if fila else None), ultimo
+
+def bbox_huella(huella):
+    """Caja [oeste, sur, este, norte] de la huella GeoJSON de una escena"""
+    coordenadas = huella['coordinates']
+    # system:footprint es un LinearRing; un Polygon trae sus anillos anidados un nivel más
+    if huella['type'] == 'Polygon':
+        coordenadas = coordenadas[0]
+    lons = [p[0] for p in coordenadas]
+    lats = [p[1] for p in coordenadas]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+def guardar_escenas(ruta, escenas, inicio):
+    """Inserta o actualiza escenas y amplía la cobertura del catálogo hasta `inicio`.
+
+    Cada escena es un dict con scene_index, product_id, time_start, tile, cloud_cover y bbox.
+    """
+    with conectar(ruta) as conexion:
+        conexion.executemany(
+            "INSERT OR REPLACE INTO escenas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(e['scene_index'], e['product_id'], e['time_start'], e['tile'], e['cloud_cover'], *e['bbox'])
+             for e in escenas]
+        )
+        fila = conexion.execute("SELECT valor FROM sincronizacion WHERE clave = 'inicio'").fetchone()
+        if fila is None or inicio < fila['valor']:
+            conexion.execute("INSERT OR REPLACE INTO sincronizacion VALUES ('inicio', ?)", (inicio,))
+        conexion.execute("INSERT OR REPLACE INTO sincronizacion VALUES ('actualizado', ?)",
+                         (datetime.now(timezone.utc).isoformat(timespec='seconds'),))
+
+def _condiciones(fecha_inicio, fecha_fin, max_nubes, excluir_productos):
+    """Cláusula WHERE equivalente a filterDate(inicio, fin) y CLOUDY_PIXEL_PERCENTAGE < max_nubes"""
+    sql = "time_start >= ? AND time_start < ? AND cloud_cover < ?"
+    parametros = [ms_de_fecha(fecha_inicio), ms_de_fecha(fecha_fin), max_nubes]
+    if excluir_productos:
+        sql += f" AND product_id NOT IN ({','.join('?' * len(excluir_productos))})"
+        parametros += list(excluir_productos)
+    return sql, parametros
+
+def contar_escenas(ruta, fecha_inicio, fecha_fin, max_nubes=100, excluir_productos=None):
+    """Número de escenas de la ventana con menos de `max_nubes` % de nubes"""
+    sql, parametros = _condiciones(fecha_inicio, fecha_fin, max_nubes, excluir_productos)
+    with conectar(ruta) as conexion:
+        return conexion.execute(f"SELECT COUNT(*) FROM escenas WHERE {sql}", parametros).fetchone()[0]
+
+def ids_escenas(ruta, fecha_inicio, fecha_fin, max_nubes=100):
+    """system:index de las escenas de la ventana, en orden de adquisición"""
+    sql, parametros = _condiciones(fecha_inicio, fecha_fin, max_nubes, None)
+    with conectar(ruta) as conexion:
+        filas = conexion.execute(f"SELECT scene_index FROM escenas WHERE {sql} ORDER BY time_start", parametros)
+        return [fila['scene_index'] for fila in filas]
+
+def mejor_escena(ruta, fecha_inicio, fecha_fin, limites):
+    """Conteos por nivel de nubes y la escena menos nublada del primer nivel con escenas.
+
+    Reproduce los niveles de plan_best_image_query sin consultar Earth Engine.
+    """
+    conteos = [contar_escenas(ruta, fecha_inicio, fecha_fin, limite) for limite in limites]
+    for limite, conteo in zip(limites, conteos):
+        if conteo > 0:
+            sql, parametros = _condiciones(fecha_inicio, fecha_fin, limite, None)
+            with conectar(ruta) as conexion:
+                fila = conexion.execute(
+                    f"SELECT * FROM escenas WHERE {sql} ORDER BY cloud_cover, time_start LIMIT 1", parametros
+                ).fetchone()
+            return conteos, dict(fila)
+    return conteos, None
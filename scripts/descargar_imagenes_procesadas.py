@@ -1,16 +1,43 @@
-import ee
-import geopandas as gpd
 import os
+import csv
 import json
-from datetime import datetime, timedelta
-import pandas as pd
-import numpy as np
-from PIL import Image
-import io
-import requests
-import matplotlib.pyplot as plt
-import seaborn as sns
+import queue
+import shutil
+import signal
+import sys
+from datetime import datetime, timedelta, timezone
 import time
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from diferido import cargar, importar_diferido
+from descargas import MAX_WORKERS_DESCARGA, descargar_productos, espera_backoff
+from registro_poligonos import ESCALA_NATIVA, cargar_poligono, escala_para_area
+from cache_rasters import PRESUPUESTO_GB, clave_raster, guardar_raster, leer_raster
+from render_local import (PALETA_DIFF, PALETA_NDVI, descargar_bandas, grilla_para_bbox, indice_normalizado,
+                          render_paleta, render_productos, render_rgb)
+from teselas import generar_teselas_productos
+from almacen_series import escribir_escenas, pyarrow_disponible
+from indices import ESTADISTICOS, imagen_indices, parse_indices
+from catalogo_escenas import bbox_huella, cobertura, contar_escenas, guardar_escenas, ids_escenas, mejor_escena
+from grupos_teselas import agrupar_por_teselas, cargar_teselas, guardar_teselas
+from cache_compuestos import entrada_miniatura, huella_escenas
+from cache_ee import activar_cache, estadisticas_cache, evaluar
+from publicacion import EXTENSIONES_IMAGENES, EXTENSIONES_SERIES, SUBDIRECTORIOS_IMAGENES, preparar_staging, publicar
+from manifiesto import actualizar_indice, generar_manifiesto
+from graficos import (FORMATOS_GRAFICO, cerrar_pool, datos_grafico, enviar_grafico, guardar_huella, parse_formatos,
+                      rutas_grafico)
+from limitador import CONCURRENCIA_MAXIMA, TASA_MAXIMA, configurar, estado_limitador
+from servicio import cargar_estado, desencolar, encolar, guardar_estado, nueva_cola, pendientes
+from metricas import (cerrar_corrida, contar, contexto_poligono, enviar, escribir_prometheus, etapa, imprimir_tabla,
+                      iniciar_corrida, medir, observar, registrar)
+
+# Earth Engine, pandas y NumPy se cargan recién cuando una etapa los usa, para que los
+# subcomandos livianos (status, plot, publish) arranquen rápido
+ee = importar_diferido('ee')
+pd = importar_diferido('pandas')
+np = importar_diferido('numpy')
 
 # Configuración de autenticación persistente
 def initialize_earth_engine():
@@ -32,9 +59,84 @@ def initialize_earth_engine():
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 IMAGENES_DIR = os.path.join(BASE_DIR, 'Imagenes')
 TIMESERIES_DIR = os.path.join(BASE_DIR, 'timeseries')
+CACHE_DIR = os.path.join(BASE_DIR, '.cache')
+REGISTRO_DIR = os.path.join(CACHE_DIR, 'poligonos')
+RASTER_CACHE_DIR = os.path.join(CACHE_DIR, 'rasters')
+CATALOGO_DIR = os.path.join(CACHE_DIR, 'catalogo')
+TESELAS_MGRS_CACHE = os.path.join(CACHE_DIR, 'teselas_mgrs.json')
+# Compuestos de meses cerrados: no cambian más, así que se guardan sin expulsión
+COMPUESTOS_DIR = os.path.join(CACHE_DIR, 'compuestos')
+MINIATURAS_DIR = os.path.join(CACHE_DIR, 'miniaturas')
+EE_CACHE = os.path.join(CACHE_DIR, 'ee_respuestas.sqlite')
+METRICAS_DIR = os.path.join(BASE_DIR, 'metricas')
+# Productos de la corrida en curso, antes de publicarlos; en el mismo disco para que os.replace sea atómico
+STAGING_DIR = os.path.join(CACHE_DIR, 'staging')
+GRAFICOS_CACHE_DIR = os.path.join(CACHE_DIR, 'graficos')
+ESTADO_SERVICIO = os.path.join(CACHE_DIR, 'servicio.json')
+DATASET_DIR = os.path.join(TIMESERIES_DIR, '_dataset')
+
+# Días hacia atrás desde la última fecha guardada que se vuelven a consultar en modo incremental,
+# para recoger escenas que Earth Engine ingiere con retraso
+DIAS_REVISION_INCREMENTAL = 5
+
+# Días tras el fin de un mes a partir de los cuales su compuesto ya no cambia
+DIAS_CIERRE_MES = 5
+
+# Horas que se conservan en la caché de Earth Engine las respuestas sobre ventanas recientes,
+# que todavía pueden recibir escenas; las de ventanas pasadas no vencen
+TTL_EE_RECIENTE_HORAS = 6
+
+# Ventanas mensuales de la serie temporal evaluadas a la vez por polígono
+TIMESERIES_WORKERS = 4
+
+# Porcentaje máximo de nubes de las escenas que entran en la serie temporal
+MAX_NUBES_SERIE = 25
 
-def create_directories(polygon_name, clean_files=True):
-    """Crea los directorios necesarios para un polígono y opcionalmente limpia los archivos anteriores"""
+# Minutos entre revisiones de adquisiciones nuevas del modo servicio
+INTERVALO_SERVICIO_MIN = 15
+
+# Días de escenas recientes consultados para saber qué teselas MGRS toca un polígono
+DIAS_DESCUBRIR_TESELAS = 60
+
+# Polígonos reducidos juntos en cada reduceRegions del modo por lotes; acota el tamaño de
+# cada respuesta (escenas de la ventana × polígonos) por debajo del límite de getInfo
+MAX_POLIGONOS_LOTE = 100
+
+# Procesos que dibujan los gráficos de las series temporales
+GRAFICO_WORKERS = 2
+
+# Etapas de procesar_poligono que consultan Earth Engine
+ETAPAS = ('timeseries', 'images')
+
+def ttl_ventana(fecha_fin):
+    """TTL en la caché de Earth Engine de una evaluación sobre escenas anteriores a `fecha_fin`.
+    
+    Sin vencimiento si la ventana terminó antes del margen de ingestas tardías de
+    DIAS_REVISION_INCREMENTAL días; si no, TTL_EE_RECIENTE_HORAS.
+    """
+    limite = datetime.now() - timedelta(days=DIAS_REVISION_INCREMENTAL)
+    if datetime.strptime(fecha_fin, '%Y-%m-%d') <= limite:
+        return None
+    return TTL_EE_RECIENTE_HORAS * 3600
+
+def ruta_csv_serie(polygon_name):
+    """Ruta del CSV de la serie temporal de un polígono"""
+    return os.path.join(TIMESERIES_DIR, polygon_name, f"{polygon_name}_ndvi_timeseries.csv")
+
+def serie_publicada(polygon_name):
+    """Archivos publicados de la serie temporal de un polígono para el manifiesto, relativos a BASE_DIR"""
+    graficos = rutas_grafico(os.path.join(TIMESERIES_DIR, polygon_name), polygon_name, FORMATOS_GRAFICO)
+    serie = {'csv': ruta_csv_serie(polygon_name), 'plot': graficos['png'], 'plot_svg': graficos['svg'],
+             'data': graficos['json']}
+    return {clave: os.path.relpath(ruta, BASE_DIR).replace(os.sep, '/')
+            for clave, ruta in serie.items() if os.path.exists(ruta)}
+
+def create_directories(polygon_name):
+    """Crea los directorios publicados de un polígono si no existen.
+    
+    Los productos de cada corrida se escriben en un staging aparte y se publican aquí al
+    terminar, así que los archivos anteriores se conservan mientras tanto.
+    """
     polygon_images_dir = os.path.join(IMAGENES_DIR, polygon_name)
     polygon_timeseries_dir = os.path.join(TIMESERIES_DIR, polygon_name)
     
@@ -43,109 +145,37 @@ def create_directories(polygon_name, clean_files=True):
             os.makedirs(directory)
             print(f"✅ Directorio creado: {directory}")
     
-    # Limpiar archivos anteriores si se solicita
-    if clean_files:
-        if os.path.exists(polygon_images_dir):
-            clean_previous_images(polygon_images_dir, polygon_name)
-        if os.path.exists(polygon_timeseries_dir):
-            clean_previous_timeseries(polygon_timeseries_dir, polygon_name)
-    
     return polygon_images_dir, polygon_timeseries_dir
 
-def clean_previous_images(images_dir, polygon_name):
-    """Limpia las imágenes anteriores de un polígono para que solo se mantengan las más recientes"""
-    try:
-        if not os.path.exists(images_dir):
-            return
-        
-        # Obtener lista de archivos de imágenes
-        image_files = [f for f in os.listdir(images_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.tif'))]
-        
-        if len(image_files) == 0:
-            print(f"📂 No hay imágenes anteriores que limpiar en {polygon_name}")
-            return
-        
-        print(f"🧹 Limpiando {len(image_files)} imágenes anteriores de {polygon_name}...")
-        
-        # Eliminar cada archivo
-        deleted_count = 0
-        for file in image_files:
-            try:
-                file_path = os.path.join(images_dir, file)
-                os.remove(file_path)
-                deleted_count += 1
-                print(f"🗑️ Eliminado: {file}")
-            except Exception as e:
-                print(f"⚠️ Error eliminando {file}: {str(e)}")
-        
-        print(f"✅ Limpieza de imágenes completada: {deleted_count}/{len(image_files)} archivos eliminados")
-        
-    except Exception as e:
-        print(f"❌ Error durante la limpieza de imágenes de {polygon_name}: {str(e)}")
-        # Continuar con el procesamiento aunque falle la limpieza
-
-def clean_previous_timeseries(timeseries_dir, polygon_name):
-    """Limpia los archivos de series temporales anteriores (CSV y gráficos)"""
-    try:
-        if not os.path.exists(timeseries_dir):
-            return
-        
-        # Obtener lista de archivos de series temporales
-        timeseries_files = [f for f in os.listdir(timeseries_dir) if f.lower().endswith(('.csv', '.png', '.jpg', '.jpeg'))]
-        
-        if len(timeseries_files) == 0:
-            print(f"📂 No hay archivos de series temporales anteriores que limpiar en {polygon_name}")
-            return
-        
-        print(f"🧹 Limpiando {len(timeseries_files)} archivos de series temporales anteriores de {polygon_name}...")
-        
-        # Eliminar cada archivo
-        deleted_count = 0
-        for file in timeseries_files:
-            try:
-                file_path = os.path.join(timeseries_dir, file)
-                os.remove(file_path)
-                deleted_count += 1
-                print(f"🗑️ Eliminado: {file}")
-            except Exception as e:
-                print(f"⚠️ Error eliminando {file}: {str(e)}")
-        
-        print(f"✅ Limpieza de series temporales completada: {deleted_count}/{len(timeseries_files)} archivos eliminados")
-        
-    except Exception as e:
-        print(f"❌ Error durante la limpieza de series temporales de {polygon_name}: {str(e)}")
-        # Continuar con el procesamiento aunque falle la limpieza
+def publicar_productos(staging_dir, destino_dir, extensiones, descripcion, subdirectorios=()):
+    """Publica los productos del staging en su directorio e informa qué cambió"""
+    with etapa('publicacion'):
+        actualizados, sin_cambios, eliminados = publicar(staging_dir, destino_dir, extensiones, subdirectorios)
+    contar('archivos_publicados', actualizados)
+    contar('archivos_sin_cambios', sin_cambios)
+    print(f"📤 {descripcion} publicadas en {destino_dir}: {actualizados} actualizados, "
+          f"{sin_cambios} sin cambios, {eliminados} obsoletos eliminados")
 
 def get_geometry_area(geometry):
     """Calcula el área de la geometría en km²"""
     try:
-        area = geometry.area().getInfo()  # Área en metros cuadrados
+        area = evaluar(geometry.area())  # Área en metros cuadrados
         area_km2 = area / 1000000  # Convertir a km²
         return area_km2
     except:
         return 0
 
-def get_optimal_scale_and_dimensions(geometry):
-    """Determina la escala y dimensiones óptimas basadas en el área de la geometría"""
+def get_optimal_scale_and_dimensions(geometry, area_km2=None):
+    """Determina la escala y dimensiones óptimas basadas en el área de la geometría.
+    
+    Si se conoce `area_km2` (por ejemplo desde el registro de polígonos) no se consulta al servidor.
+    """
     try:
-        area_km2 = get_geometry_area(geometry)
+        if area_km2 is None:
+            area_km2 = get_geometry_area(geometry)
         print(f"📐 Área de la geometría: {area_km2:.2f} km²")
         
-        if area_km2 > 1000:  # Área muy grande (>1000 km²)
-            scale = 60
-            dimensions = 1024
-        elif area_km2 > 100:  # Área grande (100-1000 km²)
-            scale = 30
-            dimensions = 1536
-        elif area_km2 > 10:  # Área mediana (10-100 km²)
-            scale = 20
-            dimensions = 2048
-        elif area_km2 > 1:  # Área pequeña (1-10 km²)
-            scale = 10
-            dimensions = 2048
-        else:  # Área muy pequeña (<1 km²)
-            scale = 10
-            dimensions = 1024
+        scale, dimensions = escala_para_area(area_km2)
             
         print(f"📏 Escala seleccionada: {scale}m, Dimensiones: {dimensions}x{dimensions}")
         return scale, dimensions
@@ -154,74 +184,238 @@ def get_optimal_scale_and_dimensions(geometry):
         print(f"⚠️ Error calculando parámetros óptimos: {e}. Usando valores por defecto.")
         return 20, 2048
 
-def get_best_image_in_period(geometry, fecha_inicio, fecha_fin, max_cloud_cover=25):
-    """Obtiene la mejor imagen en un período dado"""
+def plan_best_image_query(geometry, fecha_inicio, fecha_fin, max_cloud_cover=25, area_km2=None):
+    """Construye un ee.Dictionary con los conteos de cada nivel de nubes y los metadatos de la mejor escena.
+    
+    Los niveles son: 15% para polígonos grandes (>100 km²) o `max_cloud_cover` para el resto,
+    luego `max_cloud_cover` y por último 100%. La colección del primer nivel con imágenes se
+    elige en el servidor, de modo que todo se evalúa con un solo getInfo. Si se conoce
+    `area_km2` el primer nivel se decide localmente.
+    """
+    base_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+                      .filterDate(fecha_inicio, fecha_fin)
+                      .filterBounds(geometry))
+    
+    # Para polígonos grandes, ser más estricto con las nubes
+    if area_km2 is None:
+        area_m2 = geometry.area(maxError=1)
+        initial_cloud_limit = ee.Number(ee.Algorithms.If(area_m2.gt(100 * 1000000), 15, max_cloud_cover))
+    else:
+        area_m2 = ee.Number(area_km2 * 1000000)
+        initial_cloud_limit = ee.Number(15 if area_km2 > 100 else max_cloud_cover)
+    
+    limits = [initial_cloud_limit, ee.Number(max_cloud_cover), ee.Number(100)]
+    collections = [base_collection.filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', limit))
+                                  .sort('CLOUDY_PIXEL_PERCENTAGE')
+                   for limit in limits]
+    counts = [collection.size() for collection in collections]
+    
+    # Primer nivel con imágenes; si ninguno tiene, queda la colección vacía del último nivel
+    chosen = ee.ImageCollection(ee.Algorithms.If(
+        counts[0].gt(0), collections[0],
+        ee.Algorithms.If(counts[1].gt(0), collections[1], collections[2])
+    ))
+    best = chosen.limit(1)
+    
+    return ee.Dictionary({
+        'area_m2': area_m2,
+        'limits': ee.List(limits),
+        'counts': ee.List(counts),
+        'index': best.aggregate_array('system:index'),
+        'time_start': best.aggregate_array('system:time_start'),
+        'cloud_cover': best.aggregate_array('CLOUDY_PIXEL_PERCENTAGE')
+    })
+
+def plan_best_image_local(catalogo, fecha_inicio, fecha_fin, max_cloud_cover, area_km2):
+    """Mismo resultado que plan_best_image_query, respondido con el catálogo local de escenas"""
+    limits = [15 if area_km2 > 100 else max_cloud_cover, max_cloud_cover, 100]
+    counts, best = mejor_escena(catalogo, fecha_inicio, fecha_fin, limits)
+    return {
+        'area_m2': area_km2 * 1000000,
+        'limits': limits,
+        'counts': counts,
+        'index': [best['scene_index']] if best else [],
+        'time_start': [best['time_start']] if best else [],
+        'cloud_cover': [best['cloud_cover']] if best else []
+    }
+
+def get_best_image_in_period(geometry, fecha_inicio, fecha_fin, max_cloud_cover=25, area_km2=None, catalogo=None):
+    """Obtiene la mejor imagen en un período dado con una sola consulta al servidor (o ninguna, con catálogo)"""
+    image, image_date, _ = get_best_scene_in_period(geometry, fecha_inicio, fecha_fin, max_cloud_cover, area_km2,
+                                                    catalogo)
+    return image, image_date
+
+@medir
+def get_best_scene_in_period(geometry, fecha_inicio, fecha_fin, max_cloud_cover=25, area_km2=None, catalogo=None):
+    """Como get_best_image_in_period, pero devuelve también el system:index de la escena"""
     try:
         print(f"🔍 Buscando imágenes entre {fecha_inicio} y {fecha_fin}")
         
-        # Para polígonos grandes, ser más estricto con las nubes
-        area_km2 = get_geometry_area(geometry)
-        if area_km2 > 100:  # Polígonos grandes como Hopelchen
-            initial_cloud_limit = 15  # Muy estricto inicialmente
-            print(f"🔍 Polígono grande detectado ({area_km2:.1f} km²), buscando imágenes con <{initial_cloud_limit}% nubes")
+        if catalogo is not None and area_km2 is not None:
+            plan = plan_best_image_local(catalogo, fecha_inicio, fecha_fin, max_cloud_cover, area_km2)
         else:
-            initial_cloud_limit = max_cloud_cover
-        
-        # Crear colección con filtros más flexibles
-        collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-                     .filterDate(fecha_inicio, fecha_fin)
-                     .filterBounds(geometry)
-                     .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', initial_cloud_limit))
-                     .sort('CLOUDY_PIXEL_PERCENTAGE'))
-        
-        # Verificar si hay imágenes
-        size = collection.size().getInfo()
-        print(f"📊 Imágenes encontradas con <{initial_cloud_limit}% nubes: {size}")
-        
-        if size == 0:
-            # Intentar con tolerancia media
-            print(f"⚠️ Reintentando con hasta {max_cloud_cover}% de nubes...")
-            collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-                         .filterDate(fecha_inicio, fecha_fin)
-                         .filterBounds(geometry)
-                         .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', max_cloud_cover))
-                         .sort('CLOUDY_PIXEL_PERCENTAGE'))
-            
-            size = collection.size().getInfo()
-            print(f"📊 Imágenes encontradas con <{max_cloud_cover}% nubes: {size}")
-            
-            if size == 0:
-                # Último intento con 50% de nubes
-                print(f"⚠️ Último intento con hasta 50% de nubes...")
-                collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-                             .filterDate(fecha_inicio, fecha_fin)
-                             .filterBounds(geometry)
-                             .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 100))
-                             .sort('CLOUDY_PIXEL_PERCENTAGE'))
-                
-                size = collection.size().getInfo()
-                print(f"📊 Imágenes encontradas con <50% nubes: {size}")
-                
-                if size == 0:
-                    return None, None
+            plan = evaluar(plan_best_image_query(geometry, fecha_inicio, fecha_fin, max_cloud_cover, area_km2),
+                           ttl_ventana(fecha_fin))
+        
+        area_km2 = plan['area_m2'] / 1000000
+        if area_km2 > 100:  # Polígonos grandes como Hopelchen
+            print(f"🔍 Polígono grande detectado ({area_km2:.1f} km²), buscando imágenes con <{plan['limits'][0]:.0f}% nubes")
+        
+        for i, (limit, size) in enumerate(zip(plan['limits'], plan['counts'])):
+            if i > 0:
+                print(f"⚠️ Reintentando con hasta {limit:.0f}% de nubes...")
+            print(f"📊 Imágenes encontradas con <{limit:.0f}% nubes: {size}")
+            if size > 0:
+                break
+        
+        if not plan['index']:
+            return None, None, None
         
         # Obtener la imagen con menos nubes
-        best_image = ee.Image(collection.first())
+        best_image = ee.Image(f"COPERNICUS/S2_SR_HARMONIZED/{plan['index'][0]}")
         
-        # Obtener metadatos de la imagen
-        image_date = ee.Date(best_image.get('system:time_start')).format('YYYY-MM-dd').getInfo()
-        cloud_cover = best_image.get('CLOUDY_PIXEL_PERCENTAGE').getInfo()
+        # Metadatos de la imagen, ya evaluados en la misma consulta
+        image_date = datetime.fromtimestamp(plan['time_start'][0] / 1000, tz=timezone.utc).strftime('%Y-%m-%d')
+        cloud_cover = plan['cloud_cover'][0]
         
         print(f"✅ Mejor imagen encontrada: {image_date} (nubes: {cloud_cover:.1f}%)")
         
-        return best_image, image_date
+        return best_image, image_date, plan['index'][0]
         
     except Exception as e:
         print(f"❌ Error obteniendo imagen: {str(e)}")
-        return None, None
+        return None, None, None
+
+def mes_cerrado(year_month):
+    """Indica si un mes 'YYYY-MM' terminó hace suficiente para que su compuesto ya no cambie"""
+    year, month = (int(parte) for parte in year_month.split('-'))
+    fin_mes = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return datetime.now() >= fin_mes + timedelta(days=DIAS_CIERRE_MES)
+
+def origen_compuesto(tipo, year_month, max_nubes, ids):
+    """Identificador del compuesto mensual `tipo` ('ndvi_mediana' o 'compuesto') para las cachés.
+    
+    Un mes cerrado se identifica solo por mes y umbral de nubes; uno abierto lleva además la
+    huella de sus escenas, así que cambia (y se recalcula) únicamente cuando llegan escenas nuevas.
+    """
+    origen = f"{tipo}:{year_month}:nubes<{max_nubes}"
+    if mes_cerrado(year_month):
+        return origen
+    return f"{origen}:escenas={huella_escenas(ids)}"
+
+def obtener_bandas(image, bands, grid, origen=None, polygon_hash=None, raster_cache_gb=PRESUPUESTO_GB,
+                   permanente=False):
+    """Devuelve las bandas de `image` en la grilla, leyéndolas de la caché de rasters si ya se descargaron.
+    
+    `origen` identifica el contenido (id de escena o compuesto mensual); si es None los píxeles
+    se descargan siempre y no se guardan. Con `permanente` (compuestos de meses cerrados) el
+    arreglo se guarda en la caché de compuestos, fuera del presupuesto y la expulsión LRU.
+    """
+    usar_cache = origen is not None and polygon_hash is not None and (permanente or raster_cache_gb > 0)
+    if usar_cache:
+        cache_dir = COMPUESTOS_DIR if permanente else RASTER_CACHE_DIR
+        clave = clave_raster(origen, polygon_hash, grid, bands)
+        arreglo = leer_raster(cache_dir, clave)
+        if arreglo is not None:
+            print(f"💾 Bandas {', '.join(bands)} de {origen} leídas de la caché local")
+            contar('cache_rasters_aciertos')
+            return arreglo
+        contar('cache_rasters_fallos')
+    
+    arreglo = descargar_bandas(image, bands, grid)
+    if usar_cache:
+        guardar_raster(cache_dir, clave, arreglo, float('inf') if permanente else int(raster_cache_gb * 1e9))
+    return arreglo
+
+def cache_miniatura(polygon_hash, filename, origen, params):
+    """Entrada de la caché de miniaturas para un producto de compuestos mensuales, o None sin hash de polígono"""
+    if polygon_hash is None or origen is None:
+        return None
+    return entrada_miniatura(MINIATURAS_DIR, polygon_hash, filename, origen, params)
 
-def get_monthly_average(geometry, fecha_reciente):
-    """Obtiene el promedio mensual de NDVI para el mes anterior a la fecha dada"""
+def consultar_escenas_catalogo(geometry, fecha_inicio, fecha_fin):
+    """Metadatos de todas las escenas que tocan el polígono en [fecha_inicio, fecha_fin), en un solo getInfo"""
+    se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+           .filterDate(fecha_inicio, fecha_fin)
+           .filterBounds(geometry))
+    
+    def get_metadata(image):
+        return ee.Feature(None, {
+            'scene_index': image.get('system:index'),
+            'product_id': image.get('PRODUCT_ID'),
+            'time_start': image.get('system:time_start'),
+            'tile': image.get('MGRS_TILE'),
+            'cloud_cover': image.get('CLOUDY_PIXEL_PERCENTAGE'),
+            'footprint': image.get('system:footprint')
+        })
+    
+    escenas = []
+    for feature in evaluar(se2_collection.map(get_metadata), ttl_ventana(fecha_fin))['features']:
+        props = feature['properties']
+        escenas.append({
+            'scene_index': props['scene_index'],
+            'product_id': props.get('product_id'),
+            'time_start': props['time_start'],
+            'tile': props.get('tile'),
+            'cloud_cover': props.get('cloud_cover'),
+            'bbox': bbox_huella(props['footprint']) if props.get('footprint') else [None] * 4
+        })
+    return escenas
+
+@medir
+def sincronizar_catalogo(geometry, ruta_catalogo, fecha_inicio):
+    """Pone al día el catálogo local de escenas del polígono; devuelve True si quedó utilizable.
+    
+    Solo se consultan las escenas posteriores a la última guardada (revisando los últimos
+    DIAS_REVISION_INCREMENTAL días por ingestas tardías) y, si `fecha_inicio` es anterior a lo
+    ya sincronizado, ese tramo faltante.
+    """
+    try:
+        inicio, ultimo = cobertura(ruta_catalogo)
+        manana = (datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d')
+        if inicio is None:
+            tramos = [(fecha_inicio, manana)]
+        else:
+            tramos = [(fecha_inicio, inicio)] if fecha_inicio < inicio else []
+            desde = inicio
+            if ultimo is not None:
+                revision = datetime.fromtimestamp(ultimo / 1000, tz=timezone.utc) - timedelta(days=DIAS_REVISION_INCREMENTAL)
+                desde = max(desde, revision.strftime('%Y-%m-%d'))
+            tramos.append((desde, manana))
+        
+        for tramo_inicio, tramo_fin in tramos:
+            escenas = consultar_escenas_catalogo(geometry, tramo_inicio, tramo_fin)
+            guardar_escenas(ruta_catalogo, escenas, tramo_inicio)
+            print(f"🗂️ Catálogo de escenas: {len(escenas)} escenas sincronizadas de {tramo_inicio} a {tramo_fin}")
+        return True
+    except Exception as e:
+        print(f"❌ Error sincronizando el catálogo de escenas, se consultará al servidor: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+def coleccion_de_catalogo(ids):
+    """Colección S2_SR_HARMONIZED formada directamente por las escenas elegidas en el catálogo"""
+    return ee.ImageCollection([ee.Image(f"COPERNICUS/S2_SR_HARMONIZED/{scene_index}") for scene_index in ids])
+
+def coleccion_mensual(geometry, start_date, end_date, max_nubes, catalogo=None):
+    """Escenas del mes con menos de `max_nubes` % de nubes y sus system:index.
+    
+    Con catálogo los ids son locales y la colección se arma con ellos; sin él se filtra en
+    el servidor y los ids cuestan un getInfo (el mismo que antes costaba el conteo).
+    """
+    if catalogo is not None:
+        ids = ids_escenas(catalogo, start_date, end_date, max_nubes)
+        return coleccion_de_catalogo(ids), ids
+    se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+           .filterDate(start_date, end_date)
+           .filterBounds(geometry)
+           .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', max_nubes))
+           .sort('system:time_start'))
+    return se2_collection, evaluar(se2_collection.aggregate_array('system:index'), ttl_ventana(end_date))
+
+def get_monthly_average(geometry, fecha_reciente, catalogo=None):
+    """Obtiene el promedio mensual de NDVI para el mes anterior a la fecha dada, su mes y su origen de caché"""
     try:
         # Calcular el mes anterior
         fecha_obj = datetime.strptime(fecha_reciente, '%Y-%m-%d')
@@ -242,19 +436,14 @@ def get_monthly_average(geometry, fecha_reciente):
         print(f"📊 Calculando promedio mensual para {prev_year}-{prev_month:02d}...")
         
         # Obtener colección de imágenes del mes anterior
-        se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-               .filterDate(start_date, end_date)
-               .filterBounds(geometry)
-               .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 60))
-               .sort('system:time_start'))
+        se2_collection, ids = coleccion_mensual(geometry, start_date, end_date, 60, catalogo)
         
         # Verificar si la colección está vacía
-        size = se2_collection.size().getInfo()
-        if size == 0:
+        if len(ids) == 0:
             print(f"⚠️ No se encontraron imágenes para {prev_year}-{prev_month:02d}.")
-            return None, None
+            return None, None, None
 
-        print(f"📊 {size} imágenes encontradas para el promedio mensual")
+        print(f"📊 {len(ids)} imágenes encontradas para el promedio mensual")
 
         # Calcular NDVI para cada imagen
         def add_ndvi(image):
@@ -266,13 +455,14 @@ def get_monthly_average(geometry, fecha_reciente):
         # Calcular la mediana de NDVI para el mes
         monthly_ndvi = ndvi_collection.select('NDVI').median()
         
-        return monthly_ndvi, f"{prev_year}-{prev_month:02d}"
+        year_month = f"{prev_year}-{prev_month:02d}"
+        return monthly_ndvi, year_month, origen_compuesto('ndvi_mediana', year_month, 60, ids)
         
     except Exception as e:
         print(f"❌ Error calculando promedio mensual: {str(e)}")
-        return None, None
+        return None, None, None
 
-def get_monthly_rgb_average(geometry, year, month):
+def get_monthly_rgb_average(geometry, year, month, catalogo=None):
     """Obtiene el promedio mensual de RGB para un mes específico"""
     try:
         # Calcular fechas de inicio y fin del mes
@@ -285,30 +475,26 @@ def get_monthly_rgb_average(geometry, year, month):
         print(f"📊 Calculando promedio RGB para {year}-{month:02d}...")
         
         # Obtener colección de imágenes del mes
-        se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-               .filterDate(start_date, end_date)
-               .filterBounds(geometry)
-               .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 40))
-               .sort('system:time_start'))
+        se2_collection, ids = coleccion_mensual(geometry, start_date, end_date, 40, catalogo)
         
         # Verificar si la colección está vacía
-        size = se2_collection.size().getInfo()
-        if size == 0:
+        if len(ids) == 0:
             print(f"⚠️ No se encontraron imágenes para {year}-{month:02d}.")
-            return None, None
+            return None, None, None
 
-        print(f"📊 {size} imágenes encontradas para el promedio RGB mensual")
+        print(f"📊 {len(ids)} imágenes encontradas para el promedio RGB mensual")
 
         # Calcular la mediana de RGB para el mes
         monthly_rgb = se2_collection.select(['B4', 'B3', 'B2']).median()
         
-        return monthly_rgb, f"{year}-{month:02d}"
+        year_month = f"{year}-{month:02d}"
+        return monthly_rgb, year_month, origen_compuesto('compuesto', year_month, 40, ids)
         
     except Exception as e:
         print(f"❌ Error calculando promedio RGB mensual: {str(e)}")
-        return None, None
+        return None, None, None
 
-def get_monthly_collection_average(geometry, year, month):
+def get_monthly_collection_average(geometry, year, month, catalogo=None):
     """Obtiene la colección promedio mensual completa para calcular diferentes índices"""
     try:
         # Calcular fechas de inicio y fin del mes
@@ -321,65 +507,75 @@ def get_monthly_collection_average(geometry, year, month):
         print(f"📊 Obteniendo colección promedio para {year}-{month:02d}...")
         
         # Obtener colección de imágenes del mes
-        se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-               .filterDate(start_date, end_date)
-               .filterBounds(geometry)
-               .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 40))
-               .sort('system:time_start'))
+        se2_collection, ids = coleccion_mensual(geometry, start_date, end_date, 40, catalogo)
         
         # Verificar si la colección está vacía
-        size = se2_collection.size().getInfo()
-        if size == 0:
+        if len(ids) == 0:
             print(f"⚠️ No se encontraron imágenes para {year}-{month:02d}.")
-            return None, None
+            return None, None, None
 
-        print(f"📊 {size} imágenes encontradas para el promedio mensual completo")
+        print(f"📊 {len(ids)} imágenes encontradas para el promedio mensual completo")
 
         # Calcular la mediana de todas las bandas necesarias
         monthly_collection = se2_collection.select(['B2', 'B3', 'B4', 'B8']).median()
         
-        return monthly_collection, f"{year}-{month:02d}"
+        year_month = f"{year}-{month:02d}"
+        return monthly_collection, year_month, origen_compuesto('compuesto', year_month, 40, ids)
         
     except Exception as e:
         print(f"❌ Error obteniendo colección promedio mensual: {str(e)}")
-        return None, None
+        return None, None, None
 
-def download_image_with_retry(url, output_path, max_retries=3):
-    """Descarga una imagen con reintentos"""
-    for attempt in range(max_retries):
-        try:
-            print(f"📥 Descargando: {os.path.basename(output_path)} (intento {attempt + 1})")
-            
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()
-            
-            # Verificar que la respuesta contiene una imagen
-            if len(response.content) < 1000:
-                raise Exception("Respuesta muy pequeña, posible error del servidor")
-            
-            with open(output_path, 'wb') as f:
-                f.write(response.content)
-            
-            # Verificar que el archivo se guardó correctamente
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 1000:
-                print(f"✅ {os.path.basename(output_path)} descargada correctamente")
-                return True
-            else:
-                raise Exception("Archivo no guardado correctamente")
-                
-        except Exception as e:
-            print(f"⚠️ Error en intento {attempt + 1}: {str(e)}")
-            if attempt < max_retries - 1:
-                print("🔄 Reintentando en 5 segundos...")
-                time.sleep(5)
-            else:
-                print(f"❌ Falló la descarga de {os.path.basename(output_path)} después de {max_retries} intentos")
-                return False
+def compuesto_de_grupo(grupo, clave, calcular):
+    """Calcula una sola vez por grupo de teselas un compuesto (imagen, fecha, origen) que comparten sus polígonos.
+    
+    El lock del grupo solo protege el diccionario de futuros: el primer polígono que pide
+    `clave` la calcula fuera del lock y los que pidan la misma clave esperan su futuro, sin
+    bloquear a los que piden otras. Si el cálculo falla, la clave se descarta para que el
+    próximo pedido lo reintente.
+    """
+    with grupo['lock']:
+        futuro = grupo['compuestos'].get(clave)
+        propio = futuro is None
+        if propio:
+            futuro = grupo['compuestos'][clave] = Future()
+    if not propio:
+        print(f"♻️ Compuesto {clave[0]} {clave[1]} reutilizado del grupo de teselas {grupo['id']}")
+        return futuro.result()
+    try:
+        futuro.set_result(calcular())
+    except Exception as e:
+        with grupo['lock']:
+            del grupo['compuestos'][clave]
+        futuro.set_exception(e)
+    return futuro.result()
+
+def promedio_mensual(geometry, fecha_reciente, catalogo=None, grupo=None):
+    """get_monthly_average; con grupo de teselas se calcula una vez sobre la región del grupo.
     
-    return False
+    La mediana sobre la región del grupo coincide con la del polígono en sus píxeles, porque
+    las escenas que no lo tocan no aportan valores ahí; cada polígono la recorta después.
+    """
+    if grupo is None:
+        return get_monthly_average(geometry, fecha_reciente, catalogo)
+    return compuesto_de_grupo(grupo, ('ndvi_mediana', fecha_reciente[:7]),
+                              lambda: get_monthly_average(grupo['region'], fecha_reciente))
 
-def download_hopelchen_monthly_images(geometry, output_dir, polygon_name):
-    """Descarga todos los índices promedio mensuales específicamente para Hopelchen"""
+def compuesto_mensual(geometry, year, month, catalogo=None, grupo=None):
+    """get_monthly_collection_average; con grupo de teselas se calcula una vez sobre la región del grupo"""
+    if grupo is None:
+        return get_monthly_collection_average(geometry, year, month, catalogo)
+    return compuesto_de_grupo(grupo, ('compuesto', f"{year}-{month:02d}"),
+                              lambda: get_monthly_collection_average(grupo['region'], year, month))
+
+@medir
+def download_hopelchen_monthly_images(geometry, output_dir, polygon_name, download_workers=MAX_WORKERS_DESCARGA, area_km2=None,
+                                      catalogo=None, grupo=None, polygon_hash=None):
+    """Descarga todos los índices promedio mensuales específicamente para Hopelchen.
+    
+    Con `polygon_hash` cada producto se copia de la caché de miniaturas si su compuesto no
+    cambió desde la última descarga, sin pedir URL ni píxeles a Earth Engine.
+    """
     try:
         print(f"🖼️ Iniciando descarga de todos los índices promedio mensuales para {polygon_name}...")
         
@@ -402,7 +598,7 @@ def download_hopelchen_monthly_images(geometry, output_dir, polygon_name):
         os.makedirs(output_dir, exist_ok=True)
         
         # Obtener parámetros óptimos
-        scale, dimensions = get_optimal_scale_and_dimensions(geometry)
+        scale, dimensions = get_optimal_scale_and_dimensions(geometry, area_km2)
         
         # Configuración base para descarga
         base_params = {
@@ -413,167 +609,100 @@ def download_hopelchen_monthly_images(geometry, output_dir, polygon_name):
         }
         print(f"📐 Usando configuración: escala={scale}m")
         
-        successful_downloads = 0
-        total_downloads = 0
+        # Lista de imágenes a descargar
+        downloads = []
         
         # Obtener colecciones promedio para ambos meses
-        current_collection, current_date = get_monthly_collection_average(geometry, current_year, current_month)
-        prev_collection, prev_date = get_monthly_collection_average(geometry, prev_year, prev_month)
+        current_collection, current_date, current_origen = compuesto_mensual(geometry, current_year, current_month,
+                                                                             catalogo, grupo)
+        prev_collection, prev_date, prev_origen = compuesto_mensual(geometry, prev_year, prev_month, catalogo, grupo)
+        
+        def agregar(image, params, filename, description, origen):
+            downloads.append({
+                'image': image,
+                'params': params,
+                'filename': filename,
+                'description': description,
+                'cache': cache_miniatura(polygon_hash, filename, origen, params)
+            })
         
         # Procesar mes actual
         if current_collection is not None:
             print(f"🔄 Procesando índices para {current_date}...")
             
             # 1. RGB promedio mes actual
-            try:
-                rgb_current = current_collection.select(['B4', 'B3', 'B2']).clip(geometry)
-                rgb_processed = (
-                    rgb_current.divide(10000)
-                               .pow(0.7)
-                               .multiply(2.8)
-                               .clamp(0, 1)
-                               .unmask(0)
-                )
-                
-                rgb_params = {**base_params, 'min': 0, 'max': 1, 'gamma': 1.2}
-                url = rgb_processed.getThumbUrl(rgb_params)
-                output_path = os.path.join(output_dir, f'RGB_promedio_{current_date}.png')
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                total_downloads += 1
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error RGB {current_date}: {str(e)}")
-                total_downloads += 1
+            rgb_current = current_collection.select(['B4', 'B3', 'B2']).clip(geometry)
+            rgb_processed = (
+                rgb_current.divide(10000)
+                           .pow(0.7)
+                           .multiply(2.8)
+                           .clamp(0, 1)
+                           .unmask(0)
+            )
+            
+            agregar(rgb_processed, {**base_params, 'min': 0, 'max': 1, 'gamma': 1.2},
+                    f'RGB_promedio_{current_date}.png', f'RGB {current_date}', current_origen)
             
             # 2. NDVI promedio mes actual
-            try:
-                ndvi_current = (
-                    current_collection.normalizedDifference(['B8', 'B4'])
-                                     .rename('NDVI')
-                                     .clip(geometry)
-                                     .unmask(0)
-                )
-                
-                ndvi_params = {
-                    **base_params,
-                    'min': -1,
-                    'max': 1,
-                    'palette': ['#d73027', '#f46d43', '#fdae61', '#fee08b', '#ffffbf', '#d9ef8b', '#a6d96a', '#66bd63', '#1a9850']
-                }
-                
-                url = ndvi_current.getThumbUrl(ndvi_params)
-                output_path = os.path.join(output_dir, f'NDVI_promedio_{current_date}.png')
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                total_downloads += 1
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error NDVI {current_date}: {str(e)}")
-                total_downloads += 1
+            ndvi_current = (
+                current_collection.normalizedDifference(['B8', 'B4'])
+                                 .rename('NDVI')
+                                 .clip(geometry)
+                                 .unmask(0)
+            )
+            
+            agregar(ndvi_current, {**base_params, 'min': -1, 'max': 1, 'palette': PALETA_NDVI},
+                    f'NDVI_promedio_{current_date}.png', f'NDVI {current_date}', current_origen)
             
             # 3. False Color promedio mes actual
-            try:
-                false_color_current = current_collection.select(['B8', 'B4', 'B3']).clip(geometry)
-                false_color_processed = (
-                    false_color_current.divide(10000)
-                                      .pow(0.7)
-                                      .multiply(2.5)
-                                      .clamp(0, 1)
-                                      .unmask(0)
-                )
-                
-                false_color_params = {**base_params, 'min': 0, 'max': 1, 'gamma': 1.1}
-                url = false_color_processed.getThumbUrl(false_color_params)
-                output_path = os.path.join(output_dir, f'FalseColor_promedio_{current_date}.png')
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                total_downloads += 1
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error False Color {current_date}: {str(e)}")
-                total_downloads += 1
+            false_color_current = current_collection.select(['B8', 'B4', 'B3']).clip(geometry)
+            false_color_processed = (
+                false_color_current.divide(10000)
+                                  .pow(0.7)
+                                  .multiply(2.5)
+                                  .clamp(0, 1)
+                                  .unmask(0)
+            )
+            
+            agregar(false_color_processed, {**base_params, 'min': 0, 'max': 1, 'gamma': 1.1},
+                    f'FalseColor_promedio_{current_date}.png', f'False Color {current_date}', current_origen)
         
         # Procesar mes anterior - Solo NDVI
         if prev_collection is not None:
             print(f"🔄 Procesando NDVI promedio para {prev_date}...")
             
             # 4. NDVI promedio mes anterior
-            try:
-                ndvi_prev = (
-                    prev_collection.normalizedDifference(['B8', 'B4'])
-                                   .rename('NDVI')
-                                   .clip(geometry)
-                                   .unmask(0)
-                )
-                
-                ndvi_params = {
-                    **base_params,
-                    'min': -1,
-                    'max': 1,
-                    'palette': ['#d73027', '#f46d43', '#fdae61', '#fee08b', '#ffffbf', '#d9ef8b', '#a6d96a', '#66bd63', '#1a9850']
-                }
-                
-                url = ndvi_prev.getThumbUrl(ndvi_params)
-                output_path = os.path.join(output_dir, f'NDVI_promedio_{prev_date}.png')
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                total_downloads += 1
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error NDVI {prev_date}: {str(e)}")
-                total_downloads += 1
+            ndvi_prev = (
+                prev_collection.normalizedDifference(['B8', 'B4'])
+                               .rename('NDVI')
+                               .clip(geometry)
+                               .unmask(0)
+            )
+            
+            agregar(ndvi_prev, {**base_params, 'min': -1, 'max': 1, 'palette': PALETA_NDVI},
+                    f'NDVI_promedio_{prev_date}.png', f'NDVI {prev_date}', prev_origen)
         
         # 5. Diferencia NDVI entre meses (solo si ambos están disponibles)
         if current_collection is not None and prev_collection is not None:
-            try:
-                print(f"🔄 Calculando diferencia NDVI entre {current_date} y {prev_date}...")
-                
-                ndvi_current = (
-                    current_collection.normalizedDifference(['B8', 'B4'])
-                                     .rename('NDVI')
-                                     .clip(geometry)
-                                     .unmask(0)
-                )
-                
-                ndvi_prev = (
-                    prev_collection.normalizedDifference(['B8', 'B4'])
-                                   .rename('NDVI')
-                                   .clip(geometry)
-                                   .unmask(0)
-                )
-                
-                diff = ndvi_current.subtract(ndvi_prev).rename('NDVI_diff').unmask(0)
-                
-                diff_params = {
-                    **base_params,
-                    'min': -0.5,
-                    'max': 0.5,
-                    'palette': ['#8B0000', '#FF4500', '#FFA500', '#FFFF00', '#FFFFFF', '#90EE90', '#32CD32', '#228B22', '#006400']
-                }
-                
-                url = diff.getThumbUrl(diff_params)
-                output_path = os.path.join(output_dir, f'NDVI_Diff_{current_date}_{prev_date}.png')
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                total_downloads += 1
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error diferencia NDVI: {str(e)}")
-                total_downloads += 1
+            print(f"🔄 Calculando diferencia NDVI entre {current_date} y {prev_date}...")
+            
+            diff = ndvi_current.subtract(ndvi_prev).rename('NDVI_diff').unmask(0)
+            
+            diff_params = {
+                **base_params,
+                'min': -0.5,
+                'max': 0.5,
+                'palette': PALETA_DIFF
+            }
+            
+            agregar(diff, diff_params, f'NDVI_Diff_{current_date}_{prev_date}.png', 'Diferencia NDVI',
+                    f"{current_origen}|{prev_origen}")
+        
+        # Ejecutar descargas en paralelo
+        successful_downloads = descargar_productos(downloads, output_dir, max_workers=download_workers)
         
-        print(f"✅ Descarga de índices promedio completada: {successful_downloads}/{total_downloads} imágenes exitosas")
-        return successful_downloads > 0
+        print(f"✅ Descarga de índices promedio completada: {successful_downloads}/{len(downloads)} imágenes exitosas")
+        return successful_downloads > 0 and successful_downloads == len(downloads)
         
     except Exception as e:
         print(f"❌ Error en download_hopelchen_monthly_images: {str(e)}")
@@ -581,30 +710,33 @@ def download_hopelchen_monthly_images(geometry, output_dir, polygon_name):
         print(traceback.format_exc())
         return False
 
-def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, polygon_name):
+@medir
+def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, polygon_name, download_workers=MAX_WORKERS_DESCARGA, area_km2=None,
+                              catalogo=None, grupo=None, polygon_hash=None):
     """Descarga imágenes procesadas para un polígono con mejor manejo de errores"""
     try:
         print(f"🖼️ Iniciando descarga de imágenes para {polygon_name}...")
         
         # Obtener la mejor imagen en el período
-        image, fecha = get_best_image_in_period(geometry, fecha_inicio, fecha_fin)
+        image, fecha = get_best_image_in_period(geometry, fecha_inicio, fecha_fin, area_km2=area_km2, catalogo=catalogo)
         
         if image is None:
             print("❌ No se encontraron imágenes adecuadas")
             return False
         
         # Obtener el promedio mensual del mes anterior
-        monthly_avg, fecha_mes_anterior = get_monthly_average(geometry, fecha)
+        monthly_avg, fecha_mes_anterior, origen_mensual = promedio_mensual(geometry, fecha, catalogo, grupo)
         
         # Crear directorio de salida
         os.makedirs(output_dir, exist_ok=True)
         
         # CORREGIDO: Obtener parámetros óptimos basados en la geometría
-        scale, dimensions = get_optimal_scale_and_dimensions(geometry)
+        if area_km2 is None:
+            area_km2 = get_geometry_area(geometry)
+        scale, dimensions = get_optimal_scale_and_dimensions(geometry, area_km2)
         
         # Configuración base para descarga - CORREGIDO
         # Para polígonos grandes usamos 'scale' en lugar de 'dimensions' para evitar recortes
-        area_km2 = get_geometry_area(geometry)
         if area_km2 > 100:  # Para polígonos grandes como Hopelchen
             base_params = {
                 'region': geometry,
@@ -664,7 +796,7 @@ def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, pol
             **base_params,
             'min': -1,
             'max': 1,
-            'palette': ['#d73027', '#f46d43', '#fdae61', '#fee08b', '#ffffbf', '#d9ef8b', '#a6d96a', '#66bd63', '#1a9850']
+            'palette': PALETA_NDVI
         }
         
         downloads.append({
@@ -706,14 +838,17 @@ def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, pol
                 **base_params,
                 'min': -1,
                 'max': 1,
-                'palette': ['#d73027', '#f46d43', '#fdae61', '#fee08b', '#ffffbf', '#d9ef8b', '#a6d96a', '#66bd63', '#1a9850']
+                'palette': PALETA_NDVI
             }
             
+            # El promedio del mes anterior se repite en cada corrida: se reutiliza de la caché de miniaturas
             downloads.append({
                 'image': monthly_avg_clipped,
                 'params': monthly_params,
                 'filename': f'NDVI_promedio_{fecha_mes_anterior}.png',
-                'description': f'NDVI Promedio {fecha_mes_anterior}'
+                'description': f'NDVI Promedio {fecha_mes_anterior}',
+                'cache': cache_miniatura(polygon_hash, f'NDVI_promedio_{fecha_mes_anterior}.png',
+                                         origen_mensual, monthly_params)
             })
             
             # 5. Imagen de diferencias - CORREGIDO
@@ -729,7 +864,7 @@ def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, pol
                 **base_params,
                 'min': -0.5,
                 'max': 0.5,
-                'palette': ['#8B0000', '#FF4500', '#FFA500', '#FFFF00', '#FFFFFF', '#90EE90', '#32CD32', '#228B22', '#006400']
+                'palette': PALETA_DIFF
             }
             
             downloads.append({
@@ -739,32 +874,11 @@ def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, pol
                 'description': 'Diferencias NDVI'
             })
         
-        # Ejecutar descargas
-        successful_downloads = 0
-        for download in downloads:
-            try:
-                print(f"🔗 Generando URL para {download['description']}...")
-                
-                # CORREGIDO: Aplicar clip antes de generar URL
-                clipped_image = download['image']
-                
-                url = clipped_image.getThumbUrl(download['params'])
-                
-                output_path = os.path.join(output_dir, download['filename'])
-                
-                if download_image_with_retry(url, output_path):
-                    successful_downloads += 1
-                
-                # Pausa entre descargas para evitar sobrecarga del servidor
-                time.sleep(3)
-                
-            except Exception as e:
-                print(f"❌ Error generando/descargando {download['description']}: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
+        # Ejecutar descargas en paralelo
+        successful_downloads = descargar_productos(downloads, output_dir, max_workers=download_workers)
         
         print(f"✅ Descarga completada: {successful_downloads}/{len(downloads)} imágenes exitosas")
-        return successful_downloads > 0
+        return successful_downloads > 0 and successful_downloads == len(downloads)
         
     except Exception as e:
         print(f"❌ Error en download_processed_images: {str(e)}")
@@ -772,98 +886,742 @@ def download_processed_images(geometry, fecha_inicio, fecha_fin, output_dir, pol
         print(traceback.format_exc())
         return False
 
-def get_ndvi_timeseries(geometry, fecha_inicio, fecha_fin):
-    """Obtiene la serie temporal de NDVI para un polígono con mejor manejo de errores"""
+def agrupar_por_fecha(df):
+    """Agrupa escenas por fecha promediando NDVI y nubes según el número de escenas de cada fila.
+    
+    Las medias de otros índices (evi_mean, ...) se agregan como columnas extra, promediadas solo
+    entre las filas que las tienen: los CSV guardados antes de calcularlas no las incluyen.
+    """
+    df = df.copy()
+    extras = [c for c in df.columns if c.endswith('_mean') and c != 'ndvi_mean']
+    promediadas = ['ndvi_mean', 'cloud_cover'] + extras
+    agregados = {}
+    for columna in promediadas:
+        df[f'_{columna}_suma'] = df[columna] * df['n_scenes']
+        df[f'_{columna}_peso'] = df['n_scenes'].where(df[columna].notna(), 0)
+        agregados[f'_{columna}_suma'] = (f'_{columna}_suma', 'sum')
+        agregados[f'_{columna}_peso'] = (f'_{columna}_peso', 'sum')
+    df = df.groupby('date').agg(
+        n_scenes=('n_scenes', 'sum'),
+        scene_id=('scene_id', lambda ids: ';'.join(sorted({i for v in ids for i in str(v).split(';') if i}))),
+        **agregados
+    ).reset_index()
+    for columna in promediadas:
+        peso = df[f'_{columna}_peso']
+        df[columna] = (df[f'_{columna}_suma'] / peso).where(peso > 0)
+    return df[['date', 'ndvi_mean', 'cloud_cover', 'scene_id', 'n_scenes'] + extras].sort_values('date')
+
+def leer_serie_existente(csv_file):
+    """Lee la serie temporal guardada de un polígono; devuelve un DataFrame vacío si no existe"""
+    if not os.path.exists(csv_file):
+        return pd.DataFrame()
     try:
-        print(f"📊 Obteniendo serie temporal NDVI de {fecha_inicio} a {fecha_fin}")
-        
-        # Obtener colección de imágenes
-        se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-               .filterDate(fecha_inicio, fecha_fin)
-               .filterBounds(geometry)
-               .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 25))
-               .sort('system:time_start'))
+        df = pd.read_csv(csv_file, dtype={'scene_id': str})
+    except Exception as e:
+        print(f"⚠️ No se pudo leer la serie existente {csv_file}: {str(e)}")
+        return pd.DataFrame()
+    if df.empty:
+        return df
+    df['date'] = pd.to_datetime(df['date'])
+    # Los CSV anteriores no guardaban escenas: cada fila cuenta como una escena desconocida
+    if 'scene_id' not in df.columns:
+        df['scene_id'] = ''
+    df['scene_id'] = df['scene_id'].fillna('')
+    if 'n_scenes' not in df.columns:
+        df['n_scenes'] = 1
+    return df
+
+def fusionar_series(existente, nueva, fecha_inicio=None):
+    """Combina la serie guardada con las escenas nuevas, sin duplicar escenas ya contadas.
+    
+    Si se indica `fecha_inicio` se descartan las fechas anteriores (ventana móvil).
+    """
+    if existente.empty:
+        combinada = nueva
+    elif nueva.empty:
+        combinada = existente
+    else:
+        # Fechas guardadas sin identificadores de escena no se pueden completar sin duplicar
+        fechas_sin_ids = set(existente.loc[existente['scene_id'] == '', 'date'])
+        nueva = nueva[~nueva['date'].isin(fechas_sin_ids)]
+        combinada = agrupar_por_fecha(pd.concat([existente, nueva], ignore_index=True))
+    
+    if combinada.empty:
+        return combinada
+    if fecha_inicio is not None:
+        combinada = combinada[combinada['date'] >= pd.to_datetime(fecha_inicio)]
+    return combinada.sort_values('date').reset_index(drop=True)
+
+def inicio_incremental(existente, fecha_inicio):
+    """Devuelve la fecha desde la que consultar escenas nuevas y los ids de escena ya guardados en ese tramo"""
+    if existente.empty:
+        return fecha_inicio, []
+    desde = existente['date'].max() - timedelta(days=DIAS_REVISION_INCREMENTAL)
+    desde = max(desde, pd.to_datetime(fecha_inicio))
+    recientes = existente[existente['date'] >= desde]
+    ids = sorted({i for v in recientes['scene_id'] for i in str(v).split(';') if i})
+    return desde.strftime('%Y-%m-%d'), ids
+
+def productos_escena_local(bandas, ndvi_mensual, fecha, fecha_mes_anterior):
+    """Productos del render local de una escena a partir de sus bandas y del NDVI mediano del mes anterior"""
+    ndvi = indice_normalizado(bandas['B8'], bandas['B4'])
+    productos = [
+        {'filename': f'RGB_{fecha}.png', 'description': 'RGB',
+         'render': lambda: render_rgb(np.stack([bandas['B4'], bandas['B3'], bandas['B2']]), 2.8, 1.2)},
+        {'filename': f'NDVI_{fecha}.png', 'description': 'NDVI',
+         'render': lambda: render_paleta(ndvi, -1, 1, PALETA_NDVI)},
+        {'filename': f'FalseColor_{fecha}.png', 'description': 'Falso Color',
+         'render': lambda: render_rgb(np.stack([bandas['B8'], bandas['B4'], bandas['B3']]), 2.5, 1.1)}
+    ]
+    if ndvi_mensual is not None:
+        productos.append({
+            'filename': f'NDVI_promedio_{fecha_mes_anterior}.png',
+            'description': f'NDVI Promedio {fecha_mes_anterior}',
+            'render': lambda: render_paleta(ndvi_mensual, -1, 1, PALETA_NDVI)
+        })
+        productos.append({
+            'filename': f'NDVI_Diff_{fecha}.png',
+            'description': 'Diferencias NDVI',
+            'render': lambda: render_paleta(ndvi - ndvi_mensual, -0.5, 0.5, PALETA_DIFF)
+        })
+    return productos
+
+def productos_mensuales_local(actual, previo, current_date, prev_date):
+    """Productos del render local de Hopelchen a partir de los compuestos del mes actual y anterior"""
+    productos = []
+    ndvi_current = ndvi_prev = None
+    if actual is not None:
+        ndvi_current = indice_normalizado(actual['B8'], actual['B4'])
+        productos += [
+            {'filename': f'RGB_promedio_{current_date}.png', 'description': f'RGB {current_date}',
+             'render': lambda: render_rgb(np.stack([actual['B4'], actual['B3'], actual['B2']]), 2.8, 1.2)},
+            {'filename': f'NDVI_promedio_{current_date}.png', 'description': f'NDVI {current_date}',
+             'render': lambda: render_paleta(ndvi_current, -1, 1, PALETA_NDVI)},
+            {'filename': f'FalseColor_promedio_{current_date}.png', 'description': f'False Color {current_date}',
+             'render': lambda: render_rgb(np.stack([actual['B8'], actual['B4'], actual['B3']]), 2.5, 1.1)}
+        ]
+    if previo is not None:
+        ndvi_prev = indice_normalizado(previo['B8'], previo['B4'])
+        productos.append({
+            'filename': f'NDVI_promedio_{prev_date}.png', 'description': f'NDVI {prev_date}',
+            'render': lambda: render_paleta(ndvi_prev, -1, 1, PALETA_NDVI)
+        })
+    if ndvi_current is not None and ndvi_prev is not None:
+        productos.append({
+            'filename': f'NDVI_Diff_{current_date}_{prev_date}.png', 'description': 'Diferencia NDVI',
+            'render': lambda: render_paleta(ndvi_current - ndvi_prev, -0.5, 0.5, PALETA_DIFF)
+        })
+    return productos
+
+@medir
+def generar_teselas_local(productos_para_grilla, registro, output_dir):
+    """Etapa opcional: genera la pirámide XYZ de cada producto a la resolución nativa de 10 m.
+    
+    `productos_para_grilla` recibe una grilla y devuelve la lista de productos calculados en ella.
+    Solo aplica a polígonos cuya escala de trabajo es más gruesa que la nativa.
+    """
+    if registro['scale'] <= ESCALA_NATIVA:
+        print(f"🧩 {registro['polygon_name']} ya se renderiza a {registro['scale']}m; no se generan teselas")
+        return True
+    try:
+        grid = grilla_para_bbox(registro['bbox'], scale=ESCALA_NATIVA)
+        print(f"🧩 Generando teselas a {ESCALA_NATIVA}m ({grid['dimensions']['width']}x{grid['dimensions']['height']} px)...")
+        productos = productos_para_grilla(grid)
+        tiles_dir = os.path.join(output_dir, 'tiles')
+        successful = generar_teselas_productos(productos, grid, registro['bbox'],
+                                               registro['geometry']['coordinates'], tiles_dir, ESCALA_NATIVA)
+        print(f"✅ Teselas completadas: {successful}/{len(productos)} productos")
+        return successful == len(productos)
+    except Exception as e:
+        print(f"❌ Error generando teselas: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+@medir
+def render_processed_images_local(geometry, registro, fecha_inicio, fecha_fin, output_dir,
+                                  raster_cache_gb=PRESUPUESTO_GB, image_format='png', tiles=False, catalogo=None,
+                                  grupo=None):
+    """Renderiza localmente los productos de un polígono a partir de una sola descarga de bandas.
+    
+    Se descargan una vez las bandas B2/B3/B4/B8 de la mejor escena y el NDVI mediano del mes
+    anterior; RGB, NDVI, Falso Color, promedio y diferencia se calculan con NumPy reproduciendo
+    el estiramiento, gamma y paletas de download_processed_images. Las bandas se guardan en la
+    caché de rasters, así que volver a renderizar la misma escena no descarga píxeles. Los
+    productos con paleta se guardan como imágenes indexadas de 8 bits. Con `tiles` se genera
+    además la pirámide de teselas a resolución nativa.
+    """
+    polygon_name = registro['polygon_name']
+    area_km2 = registro['area_km2']
+    try:
+        print(f"🖼️ Iniciando render local de imágenes para {polygon_name}...")
         
-        # Verificar si hay imágenes
-        size = se2_collection.size().getInfo()
-        print(f"📊 Total de imágenes encontradas: {size}")
+        image, fecha, scene_index = get_best_scene_in_period(geometry, fecha_inicio, fecha_fin, area_km2=area_km2,
+                                                             catalogo=catalogo)
+        if image is None:
+            print("❌ No se encontraron imágenes adecuadas")
+            return False
         
-        if size == 0:
-            print("⚠️ No se encontraron imágenes para la serie temporal")
-            return pd.DataFrame()
+        monthly_avg, fecha_mes_anterior, origen_mensual = promedio_mensual(geometry, fecha, catalogo, grupo)
         
-        # Obtener escala óptima para el cálculo
-        scale, _ = get_optimal_scale_and_dimensions(geometry)
+        os.makedirs(output_dir, exist_ok=True)
         
-        # Calcular NDVI para cada imagen
-        def add_ndvi(image):
-            ndvi = image.normalizedDifference(['B8', 'B4']).rename('NDVI')
-            return image.addBands(ndvi)
+        scale, dimensions = get_optimal_scale_and_dimensions(geometry, area_km2)
+        # Misma grilla que getThumbUrl: escala para polígonos grandes, dimensiones para pequeños
+        if area_km2 > 100:
+            grid = grilla_para_bbox(registro['bbox'], scale=scale)
+        else:
+            grid = grilla_para_bbox(registro['bbox'], dimensions=dimensions)
+        print(f"📐 Grilla local: {grid['dimensions']['width']}x{grid['dimensions']['height']} px")
+        
+        def productos_para_grilla(grid):
+            print("📥 Descargando bandas B2, B3, B4, B8 de la escena...")
+            bandas = dict(zip(['B2', 'B3', 'B4', 'B8'], obtener_bandas(
+                image.clip(geometry).unmask(0), ['B2', 'B3', 'B4', 'B8'], grid,
+                f"escena:{scene_index}", registro['hash'], raster_cache_gb)))
+            ndvi_mensual = None
+            if monthly_avg is not None and fecha_mes_anterior:
+                print(f"📥 Descargando NDVI promedio de {fecha_mes_anterior}...")
+                ndvi_mensual = obtener_bandas(monthly_avg.clip(geometry).unmask(0), ['NDVI'], grid,
+                                              origen_mensual, registro['hash'], raster_cache_gb,
+                                              permanente=mes_cerrado(fecha_mes_anterior))[0]
+            return productos_escena_local(bandas, ndvi_mensual, fecha, fecha_mes_anterior)
+        
+        productos = productos_para_grilla(grid)
+        successful_downloads = render_productos(productos, output_dir, image_format)
+        print(f"✅ Render local completado: {successful_downloads}/{len(productos)} imágenes exitosas")
+        
+        completos = successful_downloads > 0 and successful_downloads == len(productos)
+        if tiles:
+            completos = generar_teselas_local(productos_para_grilla, registro, output_dir) and completos
+        return completos
         
-        ndvi_collection = se2_collection.map(add_ndvi)
+    except Exception as e:
+        print(f"❌ Error en render_processed_images_local: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+@medir
+def render_hopelchen_monthly_images_local(geometry, registro, output_dir,
+                                          raster_cache_gb=PRESUPUESTO_GB, image_format='png', tiles=False,
+                                          catalogo=None, grupo=None):
+    """Renderiza localmente los índices promedio mensuales de Hopelchen a partir de dos descargas de bandas"""
+    polygon_name = registro['polygon_name']
+    try:
+        print(f"🖼️ Iniciando render local de índices promedio mensuales para {polygon_name}...")
         
-        # Obtener estadísticas de NDVI para cada imagen
-        def get_stats(image):
-            stats = image.select('NDVI').reduceRegion(
-                reducer=ee.Reducer.mean(),
-                geometry=geometry,
-                scale=scale,  # Usar escala optimizada
-                maxPixels=1e8
-            )
-            return ee.Feature(None, {
-                'date': image.date().format('YYYY-MM-dd'),
-                'ndvi_mean': stats.get('NDVI'),
-                'cloud_cover': image.get('CLOUDY_PIXEL_PERCENTAGE'),
-                'scene_id': image.get('PRODUCT_ID')
-            })
+        fecha_actual = datetime.now()
+        current_year = fecha_actual.year
+        current_month = fecha_actual.month
+        if current_month == 1:
+            prev_year = current_year - 1
+            prev_month = 12
+        else:
+            prev_year = current_year
+            prev_month = current_month - 1
         
-        # Convertir a lista de características (limitar a 100 imágenes para evitar timeouts)
-        limited_collection = ndvi_collection.limit(100)
-        print("🔄 Calculando estadísticas NDVI...")
-        features = limited_collection.map(get_stats).getInfo()['features']
+        os.makedirs(output_dir, exist_ok=True)
         
-        # Convertir a DataFrame
-        data = []
-        for feature in features:
-            props = feature['properties']
-            if props['ndvi_mean'] is not None:
-                data.append({
-                    'date': props['date'],
-                    'ndvi_mean': props['ndvi_mean'],
-                    'cloud_cover': props['cloud_cover'],
-                    'scene_id': props.get('scene_id', 'unknown')
-                })
-        
-        if not data:
-            print("⚠️ No se obtuvieron datos válidos de NDVI")
-            return pd.DataFrame()
+        scale, dimensions = get_optimal_scale_and_dimensions(geometry, registro['area_km2'])
+        grid = grilla_para_bbox(registro['bbox'], scale=scale)
+        print(f"📐 Grilla local: {grid['dimensions']['width']}x{grid['dimensions']['height']} px (escala={scale}m)")
+        
+        current_collection, current_date, current_origen = compuesto_mensual(geometry, current_year, current_month,
+                                                                             catalogo, grupo)
+        prev_collection, prev_date, prev_origen = compuesto_mensual(geometry, prev_year, prev_month, catalogo, grupo)
+        
+        def productos_para_grilla(grid):
+            actual = previo = None
+            if current_collection is not None:
+                print(f"📥 Descargando bandas del compuesto {current_date}...")
+                actual = dict(zip(['B2', 'B3', 'B4', 'B8'], obtener_bandas(
+                    current_collection.clip(geometry).unmask(0), ['B2', 'B3', 'B4', 'B8'], grid,
+                    current_origen, registro['hash'], raster_cache_gb, permanente=mes_cerrado(current_date))))
+            if prev_collection is not None:
+                print(f"📥 Descargando bandas del compuesto {prev_date}...")
+                previo = dict(zip(['B4', 'B8'], obtener_bandas(
+                    prev_collection.clip(geometry).unmask(0), ['B4', 'B8'], grid,
+                    prev_origen, registro['hash'], raster_cache_gb, permanente=mes_cerrado(prev_date))))
+            return productos_mensuales_local(actual, previo, current_date, prev_date)
+        
+        productos = productos_para_grilla(grid)
+        successful_downloads = render_productos(productos, output_dir, image_format)
+        print(f"✅ Render local de índices promedio completado: {successful_downloads}/{len(productos)} imágenes exitosas")
+        
+        completos = successful_downloads > 0 and successful_downloads == len(productos)
+        if tiles and productos:
+            completos = generar_teselas_local(productos_para_grilla, registro, output_dir) and completos
+        return completos
         
-        df = pd.DataFrame(data)
-        df['date'] = pd.to_datetime(df['date'])
+    except Exception as e:
+        print(f"❌ Error en render_hopelchen_monthly_images_local: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+def ventanas_mensuales(fecha_inicio, fecha_fin):
+    """Divide el rango [fecha_inicio, fecha_fin) en ventanas por mes calendario"""
+    inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
+    fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
+    ventanas = []
+    while inicio < fin:
+        if inicio.month == 12:
+            siguiente = datetime(inicio.year + 1, 1, 1)
+        else:
+            siguiente = datetime(inicio.year, inicio.month + 1, 1)
+        corte = min(siguiente, fin)
+        ventanas.append((inicio.strftime('%Y-%m-%d'), corte.strftime('%Y-%m-%d')))
+        inicio = corte
+    return ventanas
+
+def reductor_estadisticas():
+    """Media, desviación, percentiles y píxeles válidos de todas las bandas en una sola pasada"""
+    return (ee.Reducer.mean()
+            .combine(ee.Reducer.stdDev(), sharedInputs=True)
+            .combine(ee.Reducer.percentile([10, 50, 90], ['p10', 'median', 'p90']), sharedInputs=True)
+            .combine(ee.Reducer.count(), sharedInputs=True))
+
+def propiedades_escena(image, stats, indices):
+    """Propiedades de una fila por escena a partir de la salida del reductor (diccionario o feature)"""
+    propiedades = {
+        'date': image.date().format('YYYY-MM-dd'),
+        'valid_pixels': stats.get(f'{indices[0]}_count'),
+        'cloud_cover': image.get('CLOUDY_PIXEL_PERCENTAGE'),
+        'scene_id': image.get('PRODUCT_ID'),
+        'tile': image.get('MGRS_TILE')
+    }
+    for indice in indices:
+        for sufijo, salida in ESTADISTICOS.items():
+            propiedades[f'{indice.lower()}_{sufijo}'] = stats.get(f'{indice}_{salida}')
+    return propiedades
+
+def evaluar_ventana(stats_collection, fecha_inicio, fecha_fin, max_retries=3):
+    """Evalúa la colección de estadísticas de una ventana, reintentando solo esa ventana"""
+    for attempt in range(max_retries):
+        try:
+            return evaluar(stats_collection, ttl_ventana(fecha_fin))['features']
+        except Exception as e:
+            print(f"⚠️ Error en ventana {fecha_inicio} a {fecha_fin} (intento {attempt + 1}): {str(e)}")
+            if attempt < max_retries - 1:
+                contar('reintentos_ventana')
+                espera = espera_backoff(attempt)
+                observar('espera_reintentos', espera)
+                time.sleep(espera)
+    raise RuntimeError(f"Ventana {fecha_inicio} a {fecha_fin} falló después de {max_retries} intentos")
+
+def get_ndvi_window_features(geometry, fecha_inicio, fecha_fin, scale, exclude_scene_ids=None, max_retries=3,
+                             indices=('NDVI',)):
+    """Calcula las estadísticas de los índices de todas las escenas de una ventana, reintentando solo esa ventana.
+    
+    Los índices se calculan como una imagen multibanda y se reducen juntos, así que agregar
+    índices no agrega evaluaciones.
+    """
+    # Obtener colección de imágenes
+    se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+           .filterDate(fecha_inicio, fecha_fin)
+           .filterBounds(geometry)
+           .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', MAX_NUBES_SERIE))
+           .sort('system:time_start'))
+    
+    if exclude_scene_ids:
+        se2_collection = se2_collection.filter(ee.Filter.inList('PRODUCT_ID', exclude_scene_ids).Not())
+    
+    reducer = reductor_estadisticas()
+    
+    # Obtener estadísticas de los índices para cada imagen
+    def get_stats(image):
+        stats = imagen_indices(image, indices).reduceRegion(
+            reducer=reducer,
+            geometry=geometry,
+            scale=scale,  # Usar escala optimizada
+            maxPixels=1e8
+        )
+        return ee.Feature(None, propiedades_escena(image, stats, indices))
+    
+    return evaluar_ventana(se2_collection.map(get_stats), fecha_inicio, fecha_fin, max_retries)
+
+def get_batch_window_features(poligonos, region, fecha_inicio, fecha_fin, scale, max_retries=3, indices=('NDVI',)):
+    """Estadísticas de cada escena de la ventana para todos los polígonos de un lote con una sola reduceRegions.
+    
+    `poligonos` es una FeatureCollection con la propiedad 'polygon'; cada escena se reduce solo
+    sobre los polígonos que toca.
+    """
+    se2_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+           .filterDate(fecha_inicio, fecha_fin)
+           .filterBounds(region)
+           .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', MAX_NUBES_SERIE))
+           .sort('system:time_start'))
+    
+    reducer = reductor_estadisticas()
+    
+    def get_stats(image):
+        resultados = imagen_indices(image, indices).reduceRegions(
+            collection=poligonos.filterBounds(image.geometry()),
+            reducer=reducer,
+            scale=scale
+        )
+        return resultados.map(
+            lambda stats: ee.Feature(None, propiedades_escena(image, stats, indices)).set('polygon', stats.get('polygon'))
+        )
+    
+    return evaluar_ventana(se2_collection.map(get_stats).flatten(), fecha_inicio, fecha_fin, max_retries)
+
+def features_a_escenas(features, indices=('NDVI',)):
+    """Convierte las features de estadísticas por escena en un DataFrame, descartando NDVI fuera de rango"""
+    data = []
+    for feature in features:
+        props = feature['properties']
+        if props.get('ndvi_mean') is not None:
+            fila = {
+                'date': props['date'],
+                'valid_pixels': props.get('valid_pixels'),
+                'cloud_cover': props['cloud_cover'],
+                'scene_id': props.get('scene_id') or '',
+                'tile': props.get('tile') or ''
+            }
+            for indice in indices:
+                for sufijo in ESTADISTICOS:
+                    fila[f'{indice.lower()}_{sufijo}'] = props.get(f'{indice.lower()}_{sufijo}')
+            data.append(fila)
+    
+    if not data:
+        return pd.DataFrame()
+    
+    df = pd.DataFrame(data)
+    df['date'] = pd.to_datetime(df['date'])
+    df['n_scenes'] = 1
+    
+    # Filtrar valores extremos de NDVI
+    df = df[(df['ndvi_mean'] >= -1) & (df['ndvi_mean'] <= 1)]
+    
+    return df.sort_values('date').reset_index(drop=True)
+
+@medir
+def get_ndvi_scenes(geometry, fecha_inicio, fecha_fin, area_km2=None, exclude_scene_ids=None,
+                    chunk_workers=TIMESERIES_WORKERS, indices=('NDVI',), catalogo=None):
+    """Obtiene las estadísticas NDVI (y de los demás `indices`) de cada escena de un polígono, una fila por escena.
+    
+    El rango se divide en ventanas mensuales que se evalúan en paralelo (`chunk_workers`),
+    sin límite de escenas; cada ventana reintenta su consulta con backoff. Si alguna sigue
+    fallando se lanza RuntimeError en lugar de devolver una serie con huecos, así que un
+    DataFrame vacío significa que no hay escenas. Las escenas cuyo PRODUCT_ID esté en
+    `exclude_scene_ids` se omiten (actualización incremental). Con catálogo, las ventanas
+    sin escenas se descartan sin consultar el servidor.
+    """
+    try:
+        print(f"📊 Obteniendo serie temporal NDVI de {fecha_inicio} a {fecha_fin}")
         
-        # Filtrar valores extremos de NDVI
-        df = df[(df['ndvi_mean'] >= -1) & (df['ndvi_mean'] <= 1)]
+        # Obtener escala óptima para el cálculo
+        scale, _ = get_optimal_scale_and_dimensions(geometry, area_km2)
+        
+        ventanas = ventanas_mensuales(fecha_inicio, fecha_fin)
+        if catalogo is not None:
+            total_ventanas = len(ventanas)
+            ventanas = [(inicio, fin) for inicio, fin in ventanas
+                        if contar_escenas(catalogo, inicio, fin, MAX_NUBES_SERIE, exclude_scene_ids) > 0]
+            print(f"🗂️ Catálogo: {total_ventanas - len(ventanas)} ventanas sin escenas omitidas")
+        print(f"🔄 Calculando estadísticas NDVI en {len(ventanas)} ventanas mensuales...")
+        
+        features = []
+        ventanas_fallidas = []
+        with ThreadPoolExecutor(max_workers=max(1, min(chunk_workers, len(ventanas)))) as executor:
+            futuros = {
+                enviar(executor, get_ndvi_window_features, geometry, inicio, fin, scale, exclude_scene_ids,
+                       indices=indices): (inicio, fin)
+                for inicio, fin in ventanas
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    features.extend(futuro.result())
+                except Exception as e:
+                    print(f"❌ {str(e)}")
+                    ventanas_fallidas.append(futuros[futuro])
+        
+        if ventanas_fallidas:
+            fallidas = ', '.join(f"{inicio}→{fin}" for inicio, fin in sorted(ventanas_fallidas))
+            raise RuntimeError(f"Serie temporal incompleta, ventanas fallidas: {fallidas}")
+        print(f"📊 Total de imágenes encontradas: {len(features)}")
+        
+        if not features:
+            print("⚠️ No se encontraron imágenes para la serie temporal")
+            return pd.DataFrame()
         
-        # Agrupar por fecha y calcular promedios
-        df = df.groupby('date').agg({
-            'ndvi_mean': 'mean',
-            'cloud_cover': 'mean'
-        }).reset_index()
+        # Convertir a DataFrame
+        df = features_a_escenas(features, indices)
+        if df.empty:
+            print("⚠️ No se obtuvieron datos válidos de NDVI")
+        return df
         
-        df = df.sort_values('date')
+    except Exception as e:
+        print(f"❌ Error obteniendo serie temporal: {str(e)}")
+        raise
+
+def get_ndvi_scenes_batch(registros, fecha_inicio, fecha_fin, chunk_workers=TIMESERIES_WORKERS, indices=('NDVI',),
+                          grupos=None):
+    """Estadísticas por escena de varios polígonos a la vez; devuelve {polygon_name: DataFrame}.
+    
+    Los polígonos se agrupan por escala de trabajo (y en lotes de MAX_POLIGONOS_LOTE) y cada
+    escena de cada ventana mensual se reduce sobre todo el lote con reduceRegions, así que el
+    costo crece con el número de escenas y no con escenas × polígonos. Con `grupos` (listas de
+    nombres de polígonos por grupo de teselas MGRS) los lotes no mezclan grupos, así que cada
+    uno recorre solo las escenas de sus teselas. Los polígonos de un lote con alguna ventana
+    fallida se omiten del resultado para consultarlos por separado.
+    """
+    try:
+        por_nombre = {registro['polygon_name']: registro for registro in registros}
+        agrupados = {nombre for nombres in (grupos or []) for nombre in nombres}
+        grupos = list(grupos or []) + [[nombre for nombre in por_nombre if nombre not in agrupados]]
+        
+        por_escala = {}
+        for n, nombres in enumerate(grupos):
+            for nombre in nombres:
+                if nombre in por_nombre:
+                    por_escala.setdefault((n, por_nombre[nombre]['scale']), []).append(por_nombre[nombre])
+        
+        lotes = []
+        for (_, scale), grupo in sorted(por_escala.items()):
+            for i in range(0, len(grupo), MAX_POLIGONOS_LOTE):
+                parte = grupo[i:i + MAX_POLIGONOS_LOTE]
+                poligonos = ee.FeatureCollection([
+                    ee.Feature(ee.Geometry.MultiPolygon(r['simplified']['coordinates']), {'polygon': r['polygon_name']})
+                    for r in parte
+                ])
+                region = ee.Geometry.MultiPolygon([p for r in parte for p in r['simplified']['coordinates']])
+                lotes.append((scale, poligonos, region, [r['polygon_name'] for r in parte]))
+        
+        ventanas = ventanas_mensuales(fecha_inicio, fecha_fin)
+        print(f"📦 Serie temporal por lotes: {len(registros)} polígonos en {len(lotes)} lotes, "
+              f"{len(ventanas)} ventanas mensuales de {fecha_inicio} a {fecha_fin}")
+        
+        features = {}
+        lotes_fallidos = set()
+        tareas = [(ventana, n) for ventana in ventanas for n in range(len(lotes))]
+        with ThreadPoolExecutor(max_workers=max(1, min(chunk_workers, len(tareas)))) as executor:
+            futuros = {
+                executor.submit(get_batch_window_features, lotes[n][1], lotes[n][2], inicio, fin, lotes[n][0],
+                                indices=indices): n
+                for (inicio, fin), n in tareas
+            }
+            for futuro in as_completed(futuros):
+                try:
+                    for feature in futuro.result():
+                        features.setdefault(feature['properties']['polygon'], []).append(feature)
+                except Exception as e:
+                    print(f"❌ {str(e)}")
+                    lotes_fallidos.add(futuros[futuro])
+        
+        resultados = {}
+        for n, (scale, _, _, nombres) in enumerate(lotes):
+            if n in lotes_fallidos:
+                print(f"⚠️ Lote a {scale}m incompleto; sus {len(nombres)} polígonos se consultarán por separado")
+                continue
+            for nombre in nombres:
+                resultados[nombre] = features_a_escenas(features.get(nombre, []), indices)
+        print(f"✅ Serie temporal por lotes: {sum(len(df) for df in resultados.values())} escenas-polígono")
+        return resultados
         
-        print(f"✅ Serie temporal obtenida: {len(df)} puntos de datos")
+    except Exception as e:
+        print(f"❌ Error en la serie temporal por lotes: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return {}
+
+@medir
+def calcular_escenas_lote(rutas, fecha_inicio, fecha_fin, incremental=False, chunk_workers=TIMESERIES_WORKERS,
+                          indices=('NDVI',), grupos=None):
+    """Etapa previa del modo por lotes: carga todos los polígonos y calcula sus escenas juntas.
+    
+    En modo incremental se consulta desde la fecha incremental más antigua entre los polígonos;
+    cada uno filtra después lo que ya tenía guardado.
+    """
+    registros = []
+    desdes = []
+    for ruta in rutas:
+        try:
+            registro = cargar_poligono(ruta, REGISTRO_DIR)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠️ {os.path.basename(ruta)} se omite del lote: {str(e)}")
+            continue
+        registros.append(registro)
+        if incremental:
+            existente = leer_serie_existente(ruta_csv_serie(registro['polygon_name']))
+            desdes.append(inicio_incremental(existente, fecha_inicio)[0])
+    
+    if not registros:
+        return {}
+    desde = min(desdes) if desdes else fecha_inicio
+    return get_ndvi_scenes_batch(registros, desde, fecha_fin, chunk_workers, indices, grupos)
+
+def descubrir_teselas(registros):
+    """Teselas MGRS que toca cada polígono; solo los que no están en caché se consultan, en un único getInfo"""
+    cache = cargar_teselas(TESELAS_MGRS_CACHE)
+    faltantes = [r for r in registros if r['hash'] not in cache]
+    if faltantes:
+        fin = datetime.now()
+        inicio = fin - timedelta(days=DIAS_DESCUBRIR_TESELAS)
+        consulta = ee.Dictionary({
+            r['hash']: (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+                        .filterDate(inicio.strftime('%Y-%m-%d'), fin.strftime('%Y-%m-%d'))
+                        .filterBounds(ee.Geometry.MultiPolygon(r['simplified']['coordinates']))
+                        .aggregate_array('MGRS_TILE')
+                        .distinct())
+            for r in faltantes
+        })
+        # Con TTL 0 la consulta no pasa por la caché de Earth Engine: estas teselas ya tienen la suya
+        consulta = evaluar(consulta, 0)
+        # Un polígono sin escenas recientes se vuelve a consultar la próxima vez
+        cache.update({clave: sorted(teselas) for clave, teselas in consulta.items() if teselas})
+        guardar_teselas(TESELAS_MGRS_CACHE, cache)
+        print(f"🧭 Teselas MGRS consultadas para {len(faltantes)} polígonos")
+    return {r['polygon_name']: cache.get(r['hash'], []) for r in registros}
+
+@medir
+def planificar_grupos(rutas):
+    """Agrupa los polígonos por las teselas Sentinel-2 que tocan y ordena las rutas por grupo.
+    
+    Devuelve las rutas ordenadas (los polígonos de un grupo quedan juntos), el contexto
+    compartido de cada polígono ({polygon_name: grupo}) y las listas de nombres por grupo.
+    Si la planificación falla, los polígonos se procesan como siempre.
+    """
+    try:
+        registros = {}
+        for ruta in rutas:
+            try:
+                registros[ruta] = cargar_poligono(ruta, REGISTRO_DIR)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ {os.path.basename(ruta)} queda fuera de los grupos de teselas: {str(e)}")
+        teselas = descubrir_teselas(list(registros.values()))
+        
+        por_nombre = {registro['polygon_name']: registro for registro in registros.values()}
+        contexto = {}
+        grupos = []
+        for i, grupo in enumerate(agrupar_por_teselas(teselas), 1):
+            coordenadas = [p for nombre in grupo['polygons'] for p in por_nombre[nombre]['simplified']['coordinates']]
+            compartido = {
+                'id': i,
+                'tiles': grupo['tiles'],
+                'polygons': grupo['polygons'],
+                'region': ee.Geometry.MultiPolygon(coordenadas),
+                'compuestos': {},
+                'lock': threading.Lock()
+            }
+            for nombre in grupo['polygons']:
+                contexto[nombre] = compartido
+            grupos.append(grupo['polygons'])
+            print(f"🧭 Grupo {i}: teselas {', '.join(grupo['tiles']) or 'desconocidas'} → {', '.join(grupo['polygons'])}")
         
-        return df
+        orden = {nombre: n for n, nombres in enumerate(grupos) for nombre in nombres}
+        nombre_de = {ruta: registro['polygon_name'] for ruta, registro in registros.items()}
+        rutas_ordenadas = sorted(rutas, key=lambda ruta: orden.get(nombre_de.get(ruta), len(grupos)))
+        return rutas_ordenadas, contexto, grupos
         
     except Exception as e:
-        print(f"❌ Error obteniendo serie temporal: {str(e)}")
+        print(f"❌ Error agrupando polígonos por teselas, se procesan por separado: {str(e)}")
         import traceback
         print(traceback.format_exc())
-        return pd.DataFrame()
+        return rutas, {}, None
+
+def filtrar_escenas(escenas, desde, excluir_productos):
+    """Escenas desde `desde` cuyo PRODUCT_ID no esté en `excluir_productos` (modo incremental)"""
+    if escenas.empty:
+        return escenas
+    filtro = (escenas['date'] >= pd.to_datetime(desde)) & ~escenas['scene_id'].isin(excluir_productos)
+    return escenas[filtro].reset_index(drop=True)
 
-def procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin):
-    """Procesa un polígono y descarga sus imágenes con mejor manejo de errores"""
+@medir
+def guardar_escenas_dataset(polygon_name, escenas, reemplazar):
+    """Guarda las escenas del polígono en el dataset Parquet; un fallo no detiene el procesamiento"""
+    try:
+        filas = escribir_escenas(DATASET_DIR, polygon_name, escenas, reemplazar=reemplazar)
+        print(f"🗃️ Dataset Parquet: {filas} escenas {'escritas' if reemplazar else 'agregadas'} para {polygon_name}")
+        return True
+    except Exception as e:
+        print(f"❌ Error guardando escenas en el dataset Parquet: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+def generar_imagenes(geometry, registro, output_dir, fecha_fin, download_workers, render, raster_cache_gb,
+                     image_format, tiles, catalogo, grupo):
+    """Etapa de imágenes de un polígono: descarga o renderiza sus productos en `output_dir`.
+    
+    Hopelchen usa promedios mensuales; el resto, la mejor escena de los 30 días que terminan
+    en `fecha_fin`. Devuelve True solo si se generaron todos los productos (y sus teselas,
+    con `tiles`); con uno que falte devuelve False y no se publica nada, porque la
+    publicación borraría la copia anterior del que falló.
+    """
+    polygon_name = registro['polygon_name']
+    area_km2 = registro['area_km2']
+    # Verificar si es Hopelchen para usar descarga especial
+    if polygon_name.lower() == 'hopelchen' and render == 'local':
+        print(f"🎯 Detectado polígono Hopelchen - render local de promedios mensuales...")
+        return render_hopelchen_monthly_images_local(
+            geometry,
+            registro,
+            output_dir,
+            raster_cache_gb=raster_cache_gb,
+            image_format=image_format,
+            tiles=tiles,
+            catalogo=catalogo,
+            grupo=grupo
+        )
+    elif polygon_name.lower() == 'hopelchen':
+        print(f"🎯 Detectado polígono Hopelchen - usando descarga de promedios mensuales...")
+        return download_hopelchen_monthly_images(
+            geometry,
+            output_dir,
+            polygon_name,
+            download_workers=download_workers,
+            area_km2=area_km2,
+            catalogo=catalogo,
+            grupo=grupo,
+            polygon_hash=registro['hash']
+        )
+    else:
+        # Descargar imágenes procesadas usando un rango de fechas reciente para otros polígonos
+        fecha_fin_descarga = fecha_fin
+        fecha_inicio_descarga = (datetime.strptime(fecha_fin, '%Y-%m-%d') - timedelta(days=30)).strftime('%Y-%m-%d')
+        
+        if render == 'local':
+            print(f"🖼️ Renderizando imágenes localmente (últimos 30 días)...")
+            return render_processed_images_local(
+                geometry,
+                registro,
+                fecha_inicio_descarga,
+                fecha_fin_descarga,
+                output_dir,
+                raster_cache_gb=raster_cache_gb,
+                image_format=image_format,
+                tiles=tiles,
+                catalogo=catalogo,
+                grupo=grupo
+            )
+        else:
+            print(f"🖼️ Descargando imágenes procesadas (últimos 30 días)...")
+            return download_processed_images(
+                geometry,
+                fecha_inicio_descarga,
+                fecha_fin_descarga,
+                output_dir,
+                polygon_name,
+                download_workers=download_workers,
+                area_km2=area_km2,
+                catalogo=catalogo,
+                grupo=grupo,
+                polygon_hash=registro['hash']
+            )
+
+def procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin, download_workers=MAX_WORKERS_DESCARGA,
+                      incremental=False, keep_history=False, timeseries_workers=TIMESERIES_WORKERS,
+                      render='server', raster_cache_gb=PRESUPUESTO_GB, image_format='png', tiles=False,
+                      parquet=False, indices=('NDVI',), scene_catalog=False, escenas_lote=None,
+                      grupos_teselas=None, chart_workers=GRAFICO_WORKERS, chart_formats=('png',), etapas=ETAPAS):
+    """Procesa un polígono y descarga sus imágenes con mejor manejo de errores.
+    
+    `etapas` elige qué se recalcula: 'timeseries' (CSV y gráfico) y/o 'images' (productos y
+    manifiesto); lo que no se recalcula queda como estaba publicado.
+    """
     try:
         # Leer el archivo GeoJSON
         print(f"📂 Leyendo archivo GeoJSON: {ruta_geojson}")
@@ -872,116 +1630,140 @@ def procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin):
             print(f"❌ Archivo no encontrado: {ruta_geojson}")
             return None
             
-        with open(ruta_geojson, 'r', encoding='utf-8') as f:
-            geojson_data = json.load(f)
-        
-        # Obtener el nombre del polígono del nombre del archivo
-        polygon_name = os.path.splitext(os.path.basename(ruta_geojson))[0]
-        print(f"📍 Polígono cargado: {polygon_name}")
-        
-        # Validar estructura del GeoJSON
-        if 'features' not in geojson_data or len(geojson_data['features']) == 0:
-            print(f"❌ GeoJSON inválido o sin features: {ruta_geojson}")
+        # Registro local del polígono: área, bbox, centroide y geometría simplificada precalculados
+        try:
+            registro = cargar_poligono(ruta_geojson, REGISTRO_DIR)
+        except (ValueError, KeyError) as e:
+            print(f"❌ GeoJSON inválido: {ruta_geojson} ({str(e)})")
             return None
         
-        # Convertir a geometría de Earth Engine
-        feature = geojson_data['features'][0]
-        if feature['geometry']['type'] == 'Polygon':
-            coords = feature['geometry']['coordinates']
-        elif feature['geometry']['type'] == 'MultiPolygon':
-            coords = feature['geometry']['coordinates'][0]
-        else:
-            print(f"❌ Tipo de geometría no soportado: {feature['geometry']['type']}")
-            return None
-            
-        geometry = ee.Geometry.Polygon(coords)
+        polygon_name = registro['polygon_name']
+        area_km2 = registro['area_km2']
+        print(f"📍 Polígono cargado: {polygon_name} ({area_km2:.2f} km², {registro['n_vertices_simplified']} vértices)")
+        
+        # Convertir a geometría de Earth Engine (todas las partes del MultiPolygon, simplificadas)
+        geometry = ee.Geometry.MultiPolygon(registro['simplified']['coordinates'])
         print("🔄 Geometría convertida a formato Earth Engine")
         
-        # Crear directorios necesarios
+        # Catálogo local de escenas: conteos y mejor escena sin consultar al servidor
+        catalogo = None
+        if scene_catalog:
+            ruta_catalogo = os.path.join(CATALOGO_DIR, f"{registro['hash']}.sqlite")
+            # Debe cubrir también el mes anterior a las imágenes de los 30 días previos a fecha_fin
+            inicio_imagenes = datetime.strptime(fecha_fin, '%Y-%m-%d') - timedelta(days=60)
+            inicio_catalogo = min(fecha_inicio, inicio_imagenes.strftime('%Y-%m-01'))
+            if sincronizar_catalogo(geometry, ruta_catalogo, inicio_catalogo):
+                catalogo = ruta_catalogo
+        
+        # Grupo de teselas MGRS: los compuestos mensuales se comparten con sus otros polígonos
+        grupo = grupos_teselas.get(polygon_name) if grupos_teselas else None
+        
+        # Crear directorios necesarios; los productos nuevos se escriben en staging y se publican al final
         polygon_images_dir, polygon_timeseries_dir = create_directories(polygon_name)
+        staging_base, staging_images_dir, staging_timeseries_dir = preparar_staging(STAGING_DIR, polygon_name)
         print(f"📁 Directorios creados para {polygon_name}")
+        csv_file = ruta_csv_serie(polygon_name)
+        
+        # Si la consulta de la serie falla se conserva la publicada (y, en modo incremental, su última fecha)
+        serie_exitosa = True
+        if 'timeseries' in etapas:
+            # Obtener serie temporal (ya calculada si el polígono entró en el lote)
+            print(f"⏳ Obteniendo serie temporal para {polygon_name}...")
+            precalculadas = escenas_lote.get(polygon_name) if escenas_lote else None
+            if precalculadas is not None:
+                print(f"📦 Usando las escenas calculadas por lotes ({len(precalculadas)})")
+            try:
+                if incremental:
+                    existente = leer_serie_existente(csv_file)
+                    desde, ids_guardados = inicio_incremental(existente, fecha_inicio)
+                    print(f"🔁 Modo incremental: {len(existente)} fechas guardadas, consultando desde {desde}")
+                    if precalculadas is not None:
+                        escenas = filtrar_escenas(precalculadas, desde, ids_guardados)
+                    else:
+                        escenas = get_ndvi_scenes(geometry, desde, fecha_fin, area_km2=area_km2,
+                                                  exclude_scene_ids=ids_guardados, chunk_workers=timeseries_workers,
+                                                  indices=indices, catalogo=catalogo)
+                    nueva = agrupar_por_fecha(escenas) if not escenas.empty else escenas
+                    print(f"🆕 Fechas nuevas o actualizadas: {len(nueva)}")
+                    df = fusionar_series(existente, nueva, None if keep_history else fecha_inicio)
+                elif precalculadas is not None:
+                    escenas = precalculadas
+                    df = agrupar_por_fecha(escenas) if not escenas.empty else escenas
+                else:
+                    escenas = get_ndvi_scenes(geometry, fecha_inicio, fecha_fin, area_km2=area_km2,
+                                              chunk_workers=timeseries_workers, indices=indices, catalogo=catalogo)
+                    df = agrupar_por_fecha(escenas) if not escenas.empty else escenas
+            except Exception as e:
+                print(f"❌ Error obteniendo la serie temporal de {polygon_name}: {str(e)}; se conserva la serie publicada")
+                serie_exitosa = False
         
-        # Obtener serie temporal
-        print(f"⏳ Obteniendo serie temporal para {polygon_name}...")
-        df = get_ndvi_timeseries(geometry, fecha_inicio, fecha_fin)
+        if 'timeseries' in etapas and serie_exitosa:
+            # En modo incremental solo se agregan las escenas nuevas; si no, se reemplaza la partición del polígono
+            if parquet and not escenas.empty:
+                guardar_escenas_dataset(polygon_name, escenas, reemplazar=not incremental)
 
-        if df.empty:
-            print(f"ℹ️ No se encontraron imágenes válidas para {polygon_name}.")
-            return {
-                'polygon_name': polygon_name,
-                'status': 'no_images_found'
-            }
+            if df.empty:
+                print(f"ℹ️ No se encontraron imágenes válidas para {polygon_name}.")
+                shutil.rmtree(staging_base, ignore_errors=True)
+                return {
+                    'polygon_name': polygon_name,
+                    'status': 'no_images_found'
+                }
 
-        print(f"📊 Serie temporal obtenida con {len(df)} registros")
-        
-        # Guardar serie temporal en CSV
-        csv_file = os.path.join(polygon_timeseries_dir, f"{polygon_name}_ndvi_timeseries.csv")
-        df.to_csv(csv_file, index=False)
-        print(f"✅ Serie temporal guardada en: {csv_file}")
-        
-        # Generar gráfico de serie temporal
-        print("📈 Generando gráfico de serie temporal...")
-        plt.figure(figsize=(15, 8))
-        
-        # Subplot para NDVI
-        plt.subplot(2, 1, 1)
-        plt.plot(df['date'], df['ndvi_mean'], 'g-', linewidth=2, label='NDVI')
-        plt.title(f'Serie Temporal NDVI - {polygon_name}', fontsize=14)
-        plt.ylabel('NDVI', fontsize=12)
-        plt.grid(True, alpha=0.3)
-        plt.legend()
-        
-        # Subplot para cobertura de nubes
-        plt.subplot(2, 1, 2)
-        plt.plot(df['date'], df['cloud_cover'], 'r-', linewidth=1, alpha=0.7, label='Cobertura de nubes')
-        plt.title('Cobertura de Nubes', fontsize=14)
-        plt.xlabel('Fecha', fontsize=12)
-        plt.ylabel('Porcentaje (%)', fontsize=12)
-        plt.grid(True, alpha=0.3)
-        plt.legend()
-        
-        plt.tight_layout()
-        
-        # Guardar gráfico
-        plot_file = os.path.join(polygon_timeseries_dir, f"{polygon_name}_timeseries.png")
-        plt.savefig(plot_file, dpi=300, bbox_inches='tight')
-        plt.close()
-        print(f"✅ Gráfico de serie temporal guardado en: {plot_file}")
-        
-        # Verificar si es Hopelchen para usar descarga especial
-        if polygon_name.lower() == 'hopelchen':
-            print(f"🎯 Detectado polígono Hopelchen - usando descarga de promedios mensuales...")
-            success = download_hopelchen_monthly_images(
-                geometry,
-                polygon_images_dir,
-                polygon_name
-            )
-        else:
-            # Descargar imágenes procesadas usando un rango de fechas reciente para otros polígonos
-            fecha_fin_descarga = datetime.now().strftime('%Y-%m-%d')
-            fecha_inicio_descarga = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+            print(f"📊 Serie temporal obtenida con {len(df)} registros")
             
-            print(f"🖼️ Descargando imágenes procesadas (últimos 30 días)...")
+            # Guardar serie temporal en CSV
+            df.to_csv(os.path.join(staging_timeseries_dir, os.path.basename(csv_file)), index=False, date_format='%Y-%m-%d')
+            print(f"✅ Serie temporal guardada en: {csv_file}")
             
-            success = download_processed_images(
-                geometry,
-                fecha_inicio_descarga,
-                fecha_fin_descarga,
-                polygon_images_dir,
-                polygon_name
-            )
-        
-        if success:
+            # El gráfico se dibuja en el pool de procesos mientras se descargan las imágenes
+            print("📈 Generando gráfico de serie temporal...")
+            futuro_grafico, huella_grafico = enviar_grafico(datos_grafico(df), polygon_name, staging_timeseries_dir,
+                                                            polygon_timeseries_dir, chart_formats, GRAFICOS_CACHE_DIR,
+                                                            chart_workers)
+        
+        # Sin la etapa de imágenes no hay descargas que puedan fallar
+        success = True
+        if 'images' in etapas:
+            success = generar_imagenes(geometry, registro, staging_images_dir, fecha_fin, download_workers,
+                                       render, raster_cache_gb, image_format, tiles, catalogo, grupo)
+        
+        if 'timeseries' in etapas and serie_exitosa:
+            # La serie se publica con su gráfico; si el gráfico falla se publica igual el CSV
+            graficos_generados = {}
+            try:
+                with etapa('espera_grafico'):
+                    graficos_generados = futuro_grafico.result()
+                print(f"✅ Gráfico de serie temporal guardado en: {polygon_timeseries_dir}")
+            except Exception as e:
+                print(f"❌ Error generando el gráfico de {polygon_name}: {str(e)}")
+            publicar_productos(staging_timeseries_dir, polygon_timeseries_dir, EXTENSIONES_SERIES, "Series temporales")
+            if graficos_generados:
+                guardar_huella(GRAFICOS_CACHE_DIR, polygon_name, huella_grafico)
+        
+        # Si falló algún producto se conservan todas las imágenes publicadas de la corrida anterior
+        if 'images' in etapas and success:
+            # El manifiesto se publica junto con las imágenes que describe
+            generar_manifiesto(staging_images_dir, polygon_name, registro['bbox'], serie=serie_publicada(polygon_name))
+            publicar_productos(staging_images_dir, polygon_images_dir, EXTENSIONES_IMAGENES, "Imágenes",
+                               SUBDIRECTORIOS_IMAGENES)
+        if success and serie_exitosa:
             print(f"✅ Procesamiento completado para {polygon_name}")
+        elif not success:
+            print(f"⚠️ Procesamiento completado para {polygon_name} pero con errores en las descargas; "
+                  "se conservan las imágenes anteriores")
         else:
-            print(f"⚠️ Procesamiento completado para {polygon_name} pero con errores en las descargas")
+            print(f"⚠️ Procesamiento completado para {polygon_name} pero sin serie temporal nueva")
+        shutil.rmtree(staging_base, ignore_errors=True)
         
+        plot_file = rutas_grafico(polygon_timeseries_dir, polygon_name, ('png',))['png']
         return {
             'polygon_name': polygon_name,
             'timeseries_csv': csv_file,
-            'timeseries_plot': plot_file,
+            'timeseries_plot': plot_file if os.path.exists(plot_file) else None,
             'images_dir': polygon_images_dir,
-            'download_success': success
+            'download_success': success,
+            'timeseries_success': serie_exitosa
         }
         
     except Exception as e:
@@ -990,21 +1772,112 @@ def procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin):
         print(traceback.format_exc())
         return None
 
-def main():
-    """Función principal con mejor manejo de errores"""
-    print("🚀 Iniciando proceso de descarga de imágenes satelitales...")
+def clasificar_resultado(resultados):
+    """Clasifica el resultado de procesar_poligono en un estado para el resumen final.
     
-    # Inicializar Earth Engine
-    if not initialize_earth_engine():
-        print("❌ No se pudo inicializar Earth Engine. Abortando.")
-        return
+    'exitoso' exige todos los productos y la serie; 'sin_imagenes' es una consulta que
+    funcionó y no encontró escenas (un error de Earth Engine queda 'con_errores').
+    """
+    if not resultados:
+        return 'fallido'
+    if resultados.get('status') == 'no_images_found':
+        return 'sin_imagenes'
+    if resultados.get('download_success', False) and resultados.get('timeseries_success', True):
+        return 'exitoso'
+    return 'con_errores'
+
+def procesar_poligono_aislado(ruta_geojson, fecha_inicio, fecha_fin, **opciones):
+    """Ejecuta procesar_poligono aislando cualquier excepción para que no afecte a otros polígonos"""
+    file = os.path.basename(ruta_geojson)
+    inicio = time.time()
+    with contexto_poligono(os.path.splitext(file)[0]):
+        try:
+            resultados = procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin, **opciones)
+        except Exception as e:
+            print(f"❌ Error crítico procesando {file}: {str(e)}")
+            import traceback
+            print(traceback.format_exc())
+            resultados = None
+        resultado = {
+            'file': file,
+            'estado': clasificar_resultado(resultados),
+            'resultados': resultados,
+            'duracion': time.time() - inicio
+        }
+        observar('poligono', resultado['duracion'])
+        registrar('poligono', estado=resultado['estado'], segundos=round(resultado['duracion'], 3))
+    return resultado
+
+def reportar_resultado(resultado):
+    """Imprime el estado de un polígono procesado"""
+    resultados = resultado['resultados']
+    estado = resultado['estado']
+    if estado == 'sin_imagenes':
+        print(f"🟡 No se encontraron imágenes para procesar en {resultados['polygon_name']}.")
+    elif estado == 'exitoso':
+        print(f"✅ Procesamiento completado exitosamente para {resultados['polygon_name']}")
+    elif estado == 'con_errores':
+        print(f"⚠️ Procesamiento completado con errores para {resultados['polygon_name']}")
+    else:
+        print(f"❌ El procesamiento de {resultado['file']} falló completamente.")
+
+def procesar_en_serie(rutas, fecha_inicio, fecha_fin, **opciones):
+    """Procesa los polígonos uno a uno; el ritmo de las solicitudes lo marca el limitador"""
+    resultados = []
+    for i, ruta_geojson in enumerate(rutas, 1):
+        print(f"\n{'='*60}")
+        print(f"📁 Procesando polígono {i}/{len(rutas)}: {os.path.basename(ruta_geojson)}")
+        print(f"{'='*60}")
+        
+        resultado = procesar_poligono_aislado(ruta_geojson, fecha_inicio, fecha_fin, **opciones)
+        reportar_resultado(resultado)
+        resultados.append(resultado)
     
-    # Configurar fechas (último año hasta hoy)
-    fecha_fin = datetime.now().strftime('%Y-%m-%d')
-    fecha_inicio = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
-    print(f"📅 Rango de fechas: {fecha_inicio} a {fecha_fin}")
+    return resultados
+
+def procesar_en_paralelo(rutas, fecha_inicio, fecha_fin, workers, **opciones):
+    """Procesa los polígonos concurrentemente con un máximo de `workers` a la vez"""
+    print(f"🧵 Procesando {len(rutas)} polígonos con {workers} workers en paralelo")
+    resultados = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futuros = {
+            executor.submit(procesar_poligono_aislado, ruta_geojson, fecha_inicio, fecha_fin, **opciones): ruta_geojson
+            for ruta_geojson in rutas
+        }
+        for completados, futuro in enumerate(as_completed(futuros), 1):
+            resultado = futuro.result()
+            print(f"\n📁 Polígono terminado {completados}/{len(rutas)}: {resultado['file']} ({resultado['duracion']:.1f}s)")
+            reportar_resultado(resultado)
+            resultados.append(resultado)
+    return resultados
+
+def imprimir_resumen(resultados, duracion_total):
+    """Imprime el resumen consolidado de todos los polígonos procesados"""
+    por_estado = {}
+    for resultado in resultados:
+        por_estado.setdefault(resultado['estado'], []).append(resultado)
     
-    # Procesar cada polígono en el directorio Bases/capas_geojson
+    print(f"\n{'='*60}")
+    print(f"🎯 RESUMEN FINAL:")
+    print(f"📊 Polígonos procesados exitosamente: {len(por_estado.get('exitoso', []))}/{len(resultados)}")
+    for estado, etiqueta in [('con_errores', '⚠️ Con errores en descargas o en la serie'),
+                             ('sin_imagenes', '🟡 Sin imágenes'),
+                             ('fallido', '❌ Fallidos')]:
+        if por_estado.get(estado):
+            nombres = ', '.join(sorted(r['file'] for r in por_estado[estado]))
+            print(f"{etiqueta}: {len(por_estado[estado])} ({nombres})")
+    if resultados:
+        mas_lento = max(resultados, key=lambda r: r['duracion'])
+        print(f"🐢 Polígono más lento: {mas_lento['file']} ({mas_lento['duracion']:.1f}s)")
+    print(f"⏱️ Tiempo total: {duracion_total:.1f}s")
+    print(f"✅ Proceso completado")
+    print(f"{'='*60}")
+
+def listar_poligonos(poligonos=()):
+    """Rutas de los GeoJSON de Bases/capas_geojson, solo los de `poligonos` si se indican.
+    
+    Devuelve una lista vacía (y explica por qué) si no hay nada que procesar.
+    """
     bases_dir = os.path.join(BASE_DIR, 'Bases', 'capas_geojson')
     
     if not os.path.exists(bases_dir):
@@ -1013,59 +1886,545 @@ def main():
         os.makedirs(bases_dir, exist_ok=True)
         print(f"📁 Directorio creado: {bases_dir}")
         print("ℹ️ Coloca tus archivos GeoJSON en este directorio y ejecuta el script nuevamente.")
-        return
+        return []
     
     print(f"📂 Buscando polígonos en: {bases_dir}")
     
     try:
-        archivos_encontrados = [f for f in os.listdir(bases_dir) if f.endswith('.geojson')]
+        archivos_encontrados = sorted(f for f in os.listdir(bases_dir) if f.endswith('.geojson'))
     except Exception as e:
         print(f"❌ Error listando archivos en {bases_dir}: {str(e)}")
-        return
+        return []
         
     print(f"📋 Archivos GeoJSON encontrados: {len(archivos_encontrados)}")
     
+    if poligonos:
+        disponibles = {os.path.splitext(f)[0] for f in archivos_encontrados}
+        faltantes = [p for p in poligonos if p not in disponibles]
+        if faltantes:
+            print(f"⚠️ Polígonos no encontrados: {', '.join(faltantes)}")
+        archivos_encontrados = [f for f in archivos_encontrados if os.path.splitext(f)[0] in poligonos]
+        print(f"🔎 Polígonos seleccionados: {len(archivos_encontrados)}")
+    
     if len(archivos_encontrados) == 0:
         print("ℹ️ No se encontraron archivos GeoJSON para procesar.")
+        return []
+    
+    return [os.path.join(bases_dir, file) for file in archivos_encontrados]
+
+def nombre_poligono(ruta_geojson):
+    """Nombre de un polígono: el de su archivo GeoJSON sin extensión"""
+    return os.path.splitext(os.path.basename(ruta_geojson))[0]
+
+def finalizar_corrida(args, resultados, duracion_total):
+    """Informa las cachés y el limitador, cierra las métricas e imprime el resumen de la corrida"""
+    if args.ee_cache:
+        conteos = estadisticas_cache()
+        print(f"🗄️ Caché de Earth Engine: {conteos['aciertos']} respuestas reutilizadas, {conteos['consultas']} consultas al servidor")
+    limites = estado_limitador()
+    print(f"🚦 Limitador de solicitudes: {limites['tasa']} solicitudes/s, concurrencia {limites['concurrencia']}, "
+          f"{limites['sobrecargas']} respuestas 429/5xx")
+    imprimir_tabla()
+    cerrar_corrida(segundos=round(duracion_total, 3), poligonos=len(resultados),
+                   exitosos=sum(r['estado'] == 'exitoso' for r in resultados), limitador=limites)
+    if args.prometheus_textfile:
+        escribir_prometheus(args.prometheus_textfile)
+    imprimir_resumen(resultados, duracion_total)
+
+def opciones_pipeline(args, etapas):
+    """Opciones de procesar_poligono tomadas de los argumentos de un subcomando de Earth Engine"""
+    return {
+        'download_workers': args.download_workers,
+        'incremental': args.incremental,
+        'keep_history': args.keep_history,
+        'timeseries_workers': args.timeseries_workers,
+        'render': args.render,
+        'raster_cache_gb': args.raster_cache_gb,
+        'image_format': args.image_format,
+        'tiles': args.tiles,
+        'parquet': args.parquet,
+        'indices': args.indices,
+        'scene_catalog': args.scene_catalog,
+        'chart_workers': getattr(args, 'chart_workers', GRAFICO_WORKERS),
+        'chart_formats': getattr(args, 'chart_formats', ('png',)),
+        'etapas': etapas
+    }
+
+def comando_pipeline(args):
+    """Subcomandos run, timeseries e images: procesa los polígonos consultando Earth Engine"""
+    etapas = COMANDOS_PIPELINE[args.comando]
+    print("🚀 Iniciando proceso de descarga de imágenes satelitales...")
+    
+    # Procesar cada polígono en el directorio Bases/capas_geojson
+    rutas = listar_poligonos(args.polygon)
+    if not rutas:
+        return
+    
+    # Inicializar Earth Engine
+    if not initialize_earth_engine():
+        print("❌ No se pudo inicializar Earth Engine. Abortando.")
         return
+    # Los módulos diferidos se terminan de importar antes de lanzar hilos
+    cargar('ee', 'pandas', 'numpy', 'requests', 'PIL.Image', 'PIL.ImageDraw')
     
-    resultados_exitosos = 0
+    fecha_inicio, fecha_fin = args.start, args.end
+    print(f"📅 Rango de fechas: {fecha_inicio} a {fecha_fin}")
+    print(f"🧩 Etapas: {', '.join(etapas)}")
     
-    for i, file in enumerate(archivos_encontrados, 1):
-        ruta_geojson = os.path.join(bases_dir, file)
-        print(f"\n{'='*60}")
-        print(f"📁 Procesando polígono {i}/{len(archivos_encontrados)}: {file}")
-        print(f"{'='*60}")
-        
+    print(f"📏 Métricas de la corrida en: {iniciar_corrida(METRICAS_DIR)}")
+    if args.ee_cache:
+        activar_cache(EE_CACHE)
+    configurar(args.ee_max_rate, args.ee_max_concurrency)
+    opciones = opciones_pipeline(args, etapas)
+    inicio = time.time()
+    
+    grupos = None
+    if args.group_tiles:
+        rutas, opciones['grupos_teselas'], grupos = planificar_grupos(rutas)
+    
+    if args.batch_timeseries and 'timeseries' in etapas:
+        opciones['escenas_lote'] = calcular_escenas_lote(rutas, fecha_inicio, fecha_fin, args.incremental,
+                                                         args.timeseries_workers, args.indices, grupos)
+    
+    if args.workers > 1:
+        resultados = procesar_en_paralelo(rutas, fecha_inicio, fecha_fin, args.workers, **opciones)
+    else:
+        resultados = procesar_en_serie(rutas, fecha_inicio, fecha_fin, **opciones)
+    cerrar_pool()
+    
+    if os.path.isdir(IMAGENES_DIR) and actualizar_indice(IMAGENES_DIR):
+        print(f"🗂️ Índice de productos actualizado: {os.path.join(IMAGENES_DIR, 'index.json')}")
+    finalizar_corrida(args, resultados, time.time() - inicio)
+
+def comando_plot(args):
+    """Subcomando plot: vuelve a dibujar los gráficos desde los CSV publicados, sin Earth Engine"""
+    rutas = listar_poligonos(args.polygon)
+    # Con un solo sitio, lanzar un proceso cuesta más que dibujar aquí
+    workers = args.chart_workers if len(rutas) > 1 else 0
+    pendientes = []
+    for ruta in rutas:
+        polygon_name = nombre_poligono(ruta)
+        csv_file = ruta_csv_serie(polygon_name)
+        df = leer_serie_existente(csv_file)
+        if df.empty:
+            print(f"ℹ️ {polygon_name}: sin serie temporal publicada")
+            continue
+        # Staging propio para no pisar el de una corrida en curso sobre el mismo polígono
+        staging_base, _, staging_timeseries_dir = preparar_staging(STAGING_DIR, f"{polygon_name}.plot")
+        # El CSV publicado pasa por el staging para que la publicación no lo tome por obsoleto
+        shutil.copyfile(csv_file, os.path.join(staging_timeseries_dir, os.path.basename(csv_file)))
+        print(f"📈 Generando gráfico de serie temporal de {polygon_name}...")
+        futuro, huella = enviar_grafico(datos_grafico(df), polygon_name, staging_timeseries_dir,
+                                        os.path.dirname(csv_file), args.chart_formats, GRAFICOS_CACHE_DIR,
+                                        workers, forzar=args.force)
+        pendientes.append((polygon_name, staging_base, staging_timeseries_dir, futuro, huella))
+    
+    for polygon_name, staging_base, staging_timeseries_dir, futuro, huella in pendientes:
         try:
-            resultados = procesar_poligono(ruta_geojson, fecha_inicio, fecha_fin)
-            if resultados:
-                if resultados.get('status') == 'no_images_found':
-                    print(f"🟡 No se encontraron imágenes para procesar en {resultados['polygon_name']}.")
-                else:
-                    if resultados.get('download_success', False):
-                        resultados_exitosos += 1
-                        print(f"✅ Procesamiento completado exitosamente para {resultados['polygon_name']}")
-                    else:
-                        print(f"⚠️ Procesamiento completado con errores para {resultados['polygon_name']}")
-            else:
-                print(f"❌ El procesamiento de {file} falló completamente.")
-                
+            futuro.result()
+            publicar_productos(staging_timeseries_dir, os.path.join(TIMESERIES_DIR, polygon_name),
+                               EXTENSIONES_SERIES, "Series temporales")
+            guardar_huella(GRAFICOS_CACHE_DIR, polygon_name, huella)
         except Exception as e:
-            print(f"❌ Error crítico procesando {file}: {str(e)}")
+            print(f"❌ Error generando el gráfico de {polygon_name}: {str(e)}")
+        finally:
+            shutil.rmtree(staging_base, ignore_errors=True)
+    cerrar_pool()
+
+def comando_publish(args):
+    """Subcomando publish: regenera los manifiestos y el índice desde lo publicado, sin Earth Engine"""
+    for ruta in listar_poligonos(args.polygon):
+        polygon_name = nombre_poligono(ruta)
+        polygon_images_dir = os.path.join(IMAGENES_DIR, polygon_name)
+        if not os.path.isdir(polygon_images_dir):
+            print(f"ℹ️ {polygon_name}: sin imágenes publicadas")
+            continue
+        staging_base, staging_images_dir, _ = preparar_staging(STAGING_DIR, f"{polygon_name}.publish")
+        try:
+            registro = cargar_poligono(ruta, REGISTRO_DIR)
+            # Manifiesto y miniaturas se escriben en staging y se publican como cualquier producto
+            generar_manifiesto(polygon_images_dir, polygon_name, registro['bbox'], serie=serie_publicada(polygon_name),
+                               destino_dir=staging_images_dir)
+            publicar_productos(staging_images_dir, polygon_images_dir, ('manifest.json',), "Manifiesto y miniaturas")
+        except Exception as e:
+            print(f"❌ Error regenerando el manifiesto de {polygon_name}: {str(e)}")
             import traceback
             print(traceback.format_exc())
-        
-        # Pausa entre procesamiento de polígonos
-        if i < len(archivos_encontrados):
-            print("⏸️ Pausa de 5 segundos antes del siguiente polígono...")
-            time.sleep(5)
+        finally:
+            shutil.rmtree(staging_base, ignore_errors=True)
+    if os.path.isdir(IMAGENES_DIR) and actualizar_indice(IMAGENES_DIR):
+        print(f"🗂️ Índice de productos actualizado: {os.path.join(IMAGENES_DIR, 'index.json')}")
+
+def estado_poligono(polygon_name):
+    """Estado de los productos publicados de un polígono, leído sin pandas ni Earth Engine"""
+    estado = {'polygon': polygon_name, 'fechas': 0, 'ultima_fecha': None, 'serie_actualizada': None,
+              'productos': 0, 'ultima_imagen': None, 'revision': None, 'grafico': False,
+              'staging': os.path.isdir(os.path.join(STAGING_DIR, polygon_name))}
+    csv_file = ruta_csv_serie(polygon_name)
+    if os.path.exists(csv_file):
+        with open(csv_file, 'r', encoding='utf-8', newline='') as f:
+            fechas = [fila['date'] for fila in csv.DictReader(f) if fila.get('date')]
+        estado['fechas'] = len(fechas)
+        estado['ultima_fecha'] = max(fechas)[:10] if fechas else None
+        estado['serie_actualizada'] = datetime.fromtimestamp(os.path.getmtime(csv_file)).strftime('%Y-%m-%d %H:%M')
+    estado['grafico'] = os.path.exists(rutas_grafico(os.path.dirname(csv_file), polygon_name, ('png',))['png'])
+    try:
+        with open(os.path.join(IMAGENES_DIR, polygon_name, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifiesto = json.load(f)
+        productos = manifiesto.get('products', [])
+        estado['productos'] = len(productos)
+        estado['ultima_imagen'] = max((p['date'] for p in productos), default=None)
+        estado['revision'] = manifiesto.get('revision')
+    except (OSError, ValueError):
+        pass
+    return estado
+
+def comando_status(args):
+    """Subcomando status: resume qué hay publicado por polígono"""
+    estados = [estado_poligono(nombre_poligono(ruta)) for ruta in listar_poligonos(args.polygon)]
+    if args.json:
+        print(json.dumps(estados, indent=2, ensure_ascii=False))
+        return
+    if not estados:
+        return
+    print(f"\n{'polígono':<24}{'fechas':>8}{'última fecha':>14}{'serie actualizada':>19}"
+          f"{'productos':>11}{'última imagen':>15}{'gráfico':>9}")
+    for e in estados:
+        print(f"{e['polygon']:<24}{e['fechas']:>8}{e['ultima_fecha'] or '-':>14}{e['serie_actualizada'] or '-':>19}"
+              f"{e['productos']:>11}{e['ultima_imagen'] or '-':>15}{'sí' if e['grafico'] else 'no':>9}")
+    pendientes = [e['polygon'] for e in estados if e['staging']]
+    if pendientes:
+        print(f"⚠️ Staging de una corrida en curso o interrumpida: {', '.join(pendientes)}")
+
+def ultimas_adquisiciones(registros, desde):
+    """Adquisición más reciente (nubes < MAX_NUBES_SERIE) de cada polígono desde `desde`, en un único getInfo.
     
-    print(f"\n{'='*60}")
-    print(f"🎯 RESUMEN FINAL:")
-    print(f"📊 Polígonos procesados exitosamente: {resultados_exitosos}/{len(archivos_encontrados)}")
-    print(f"✅ Proceso completado")
-    print(f"{'='*60}")
+    Devuelve {polígono: 'YYYY-MM-DDTHH:MM:SSZ'}; los polígonos sin escenas no aparecen.
+    """
+    manana = (datetime.now(timezone.utc) + timedelta(days=1)).strftime('%Y-%m-%d')
+    consulta = ee.Dictionary({
+        r['polygon_name']: (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+                            .filterDate(desde, manana)
+                            .filterBounds(ee.Geometry.MultiPolygon(r['simplified']['coordinates']))
+                            .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', MAX_NUBES_SERIE))
+                            .aggregate_max('system:time_start'))
+        for r in registros
+    })
+    # Con TTL 0 la consulta no pasa por la caché de Earth Engine: se busca justamente lo nuevo
+    consulta = evaluar(consulta, 0)
+    return {nombre: datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            for nombre, ms in consulta.items() if ms is not None}
+
+@medir
+def detectar_novedades(rutas, estado):
+    """Polígonos con adquisiciones posteriores a lo publicado.
+    
+    La referencia de cada polígono es la última adquisición que procesó el servicio o, si
+    todavía no procesó ninguna, la última fecha de su serie publicada. Devuelve
+    {ruta: trabajo} con la adquisición nueva, el atraso en días (infinito si no hay nada
+    publicado) y el área.
+    """
+    registros = {}
+    for ruta in rutas:
+        try:
+            registros[ruta] = cargar_poligono(ruta, REGISTRO_DIR)
+        except (ValueError, KeyError) as e:
+            print(f"❌ GeoJSON inválido: {ruta} ({str(e)})")
+    referencias = {}
+    for ruta, registro in registros.items():
+        nombre = registro['polygon_name']
+        procesada = estado.get(nombre, {}).get('adquisicion')
+        referencias[ruta] = procesada[:10] if procesada else estado_poligono(nombre)['ultima_fecha']
+    if not registros:
+        return {}
+    
+    # Sin referencia se mira el mismo año que procesa `run` por defecto
+    anio = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
+    desde = min(referencia or anio for referencia in referencias.values())
+    ultimas = ultimas_adquisiciones(list(registros.values()), desde)
+    
+    novedades = {}
+    for ruta, registro in registros.items():
+        ultima = ultimas.get(registro['polygon_name'])
+        referencia = referencias[ruta]
+        if ultima is None or (referencia is not None and ultima[:10] <= referencia):
+            continue
+        atraso = float('inf') if referencia is None else (
+            datetime.strptime(ultima[:10], '%Y-%m-%d') - datetime.strptime(referencia, '%Y-%m-%d')).days
+        novedades[ruta] = {'ruta': ruta, 'adquisicion': ultima, 'referencia': referencia,
+                           'atraso_dias': atraso, 'area_km2': registro['area_km2']}
+    return novedades
+
+def comando_serve(args):
+    """Subcomando serve: servicio que procesa solo los polígonos con adquisiciones nuevas.
+    
+    Cada `--interval` minutos busca adquisiciones nuevas de todos los polígonos con una sola
+    consulta, encola los que tienen datos posteriores a lo publicado (primero los más
+    atrasados y, a igual atraso, los más chicos) y los procesa en modo incremental con hasta
+    `--workers` a la vez. Termina con SIGTERM o Ctrl+C después de lo que está en curso.
+    """
+    print("🛰️ Iniciando servicio de monitoreo...")
+    rutas = listar_poligonos(args.polygon)
+    if not rutas:
+        return
+    if not initialize_earth_engine():
+        print("❌ No se pudo inicializar Earth Engine. Abortando.")
+        return
+    # Los módulos diferidos se terminan de importar antes de lanzar hilos
+    cargar('ee', 'pandas', 'numpy', 'requests', 'PIL.Image', 'PIL.ImageDraw')
+    print(f"📏 Métricas del servicio en: {iniciar_corrida(METRICAS_DIR)}")
+    if args.ee_cache:
+        activar_cache(EE_CACHE)
+    configurar(args.ee_max_rate, args.ee_max_concurrency)
+    opciones = opciones_pipeline(args, ETAPAS)
+    # El servicio solo agrega a la serie las escenas nuevas
+    opciones['incremental'] = True
+    
+    estado = cargar_estado(ESTADO_SERVICIO)
+    cola = nueva_cola()
+    en_curso = {}
+    terminados = queue.Queue()
+    detener = threading.Event()
+    resultados = []
+    
+    def parar(signum, frame):
+        if not detener.is_set():
+            print("🛑 Deteniendo el servicio cuando terminen los polígonos en curso...")
+        detener.set()
+    signal.signal(signal.SIGTERM, parar)
+    signal.signal(signal.SIGINT, parar)
+    
+    proxima_revision = time.time()
+    inicio = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while True:
+            if not detener.is_set() and proxima_revision is not None and time.time() >= proxima_revision:
+                try:
+                    # Los polígonos en curso se vuelven a revisar cuando terminan
+                    novedades = detectar_novedades([r for r in rutas if nombre_poligono(r) not in en_curso], estado)
+                    for ruta, trabajo in novedades.items():
+                        nombre = nombre_poligono(ruta)
+                        if encolar(cola, nombre, trabajo['atraso_dias'], trabajo['area_km2'], trabajo):
+                            contar('servicio_encolados')
+                            print(f"🆕 {nombre}: adquisición {trabajo['adquisicion']} "
+                                  f"(publicado hasta {trabajo['referencia'] or 'nunca'})")
+                    print(f"🔭 Revisión de adquisiciones: {len(novedades)} polígonos con datos nuevos, "
+                          f"{pendientes(cola)} en cola, {len(en_curso)} en curso")
+                except Exception as e:
+                    print(f"❌ Error buscando adquisiciones nuevas: {str(e)}")
+                    import traceback
+                    print(traceback.format_exc())
+                proxima_revision = None if args.once else time.time() + args.interval * 60
+            
+            while not detener.is_set() and pendientes(cola) and len(en_curso) < args.workers:
+                nombre, trabajo = desencolar(cola)
+                fecha_fin = datetime.now().strftime('%Y-%m-%d')
+                fecha_inicio = (datetime.now() - timedelta(days=365)).strftime('%Y-%m-%d')
+                print(f"\n📁 Procesando {nombre} ({pendientes(cola)} en cola)")
+                futuro = executor.submit(procesar_poligono_aislado, trabajo['ruta'], fecha_inicio, fecha_fin, **opciones)
+                en_curso[nombre] = trabajo
+                futuro.add_done_callback(lambda f, n=nombre: terminados.put((n, f)))
+            
+            if not en_curso and (detener.is_set() or (proxima_revision is None and not pendientes(cola))):
+                break
+            
+            # Espera a que termine un polígono o llegue la próxima revisión; acotada para atender señales
+            espera = 5 if proxima_revision is None else min(max(proxima_revision - time.time(), 0.1), 5)
+            try:
+                nombre, futuro = terminados.get(timeout=espera)
+            except queue.Empty:
+                continue
+            trabajo = en_curso.pop(nombre)
+            resultado = futuro.result()
+            reportar_resultado(resultado)
+            resultados.append(resultado)
+            # La adquisición solo se da por procesada si se publicaron todos los productos y la serie,
+            # o si la consulta funcionó y no encontró escenas; con errores se reintenta en la próxima revisión
+            if resultado['estado'] in ('exitoso', 'sin_imagenes'):
+                estado[nombre] = {'adquisicion': trabajo['adquisicion'],
+                                  'procesado': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}
+                guardar_estado(ESTADO_SERVICIO, estado)
+            if resultado['estado'] == 'exitoso':
+                adquisicion = datetime.strptime(trabajo['adquisicion'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+                demora = (datetime.now(timezone.utc) - adquisicion).total_seconds()
+                with contexto_poligono(nombre):
+                    observar('adquisicion_a_publicacion', demora)
+                    registrar('publicado', adquisicion=trabajo['adquisicion'], horas=round(demora / 3600, 2))
+            if os.path.isdir(IMAGENES_DIR) and actualizar_indice(IMAGENES_DIR):
+                print(f"🗂️ Índice de productos actualizado: {os.path.join(IMAGENES_DIR, 'index.json')}")
+            if args.prometheus_textfile:
+                escribir_prometheus(args.prometheus_textfile)
+    cerrar_pool()
+    finalizar_corrida(args, resultados, time.time() - inicio)
+
+# Subcomandos que consultan Earth Engine y las etapas de procesar_poligono que ejecutan
+COMANDOS_PIPELINE = {
+    'run': ETAPAS,
+    'timeseries': ('timeseries',),
+    'images': ('images',)
+}
+
+COMANDOS = {
+    'run': comando_pipeline,
+    'timeseries': comando_pipeline,
+    'images': comando_pipeline,
+    'plot': comando_plot,
+    'publish': comando_publish,
+    'status': comando_status,
+    'serve': comando_serve
+}
+
+def fecha_argumento(texto):
+    """Valida una fecha YYYY-MM-DD de la línea de comandos"""
+    try:
+        datetime.strptime(texto, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"fecha inválida '{texto}' (se espera YYYY-MM-DD)")
+    return texto
+
+def parse_poligonos(valores):
+    """Une los --polygon repetidos o separados por coma en una tupla de nombres sin repetir"""
+    return tuple(dict.fromkeys(n.strip() for valor in valores for n in valor.split(',') if n.strip()))
+
+def parse_args(argv=None):
+    """Lee los argumentos de línea de comandos.
+    
+    Sin subcomando se ejecuta `run` (todas las etapas), así que las invocaciones anteriores
+    a los subcomandos siguen funcionando igual.
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0].startswith('-') and argv[0] not in ('-h', '--help')):
+        argv = ['run'] + argv
+    
+    filtros = argparse.ArgumentParser(add_help=False)
+    filtros.add_argument('--polygon', action='append', default=[], metavar='NOMBRE',
+                         help="Solo este polígono (nombre del GeoJSON sin extensión); se puede repetir o separar por coma")
+    
+    fechas = argparse.ArgumentParser(add_help=False)
+    fechas.add_argument('--start', type=fecha_argumento,
+                        help="Inicio de la serie temporal, YYYY-MM-DD (por defecto 365 días antes de --end)")
+    fechas.add_argument('--end', type=fecha_argumento,
+                        help="Fin de la serie temporal y de la ventana de 30 días de las imágenes, YYYY-MM-DD (por defecto hoy)")
+    
+    graficos = argparse.ArgumentParser(add_help=False)
+    graficos.add_argument('--chart-workers', type=int, default=GRAFICO_WORKERS,
+                          help=f"Procesos que dibujan los gráficos de las series (por defecto {GRAFICO_WORKERS}; 0 dibuja en el proceso principal)")
+    graficos.add_argument('--chart-formats', default='png',
+                          help="Formatos del gráfico de la serie, separados por coma (png, json, svg); png siempre se incluye")
+    
+    pipeline = argparse.ArgumentParser(add_help=False)
+    pipeline.add_argument('--workers', type=int, default=1,
+                          help="Número de polígonos a procesar en paralelo (por defecto 1, en serie)")
+    pipeline.add_argument('--download-workers', type=int, default=MAX_WORKERS_DESCARGA,
+                          help=f"Productos de un polígono descargados en paralelo (por defecto {MAX_WORKERS_DESCARGA})")
+    pipeline.add_argument('--timeseries-workers', type=int, default=TIMESERIES_WORKERS,
+                          help=f"Ventanas mensuales de la serie temporal evaluadas en paralelo (por defecto {TIMESERIES_WORKERS})")
+    pipeline.add_argument('--render', choices=['server', 'local'], default='server',
+                          help="server: Earth Engine renderiza cada producto; local: se descargan las bandas una vez y se renderiza con NumPy")
+    pipeline.add_argument('--image-format', choices=['png', 'webp'], default='png',
+                          help="Formato de las imágenes del render local: PNG optimizado (paletas indexadas de 8 bits) o WebP")
+    pipeline.add_argument('--raster-cache-gb', type=float, default=PRESUPUESTO_GB,
+                          help=f"Espacio máximo de la caché local de bandas del render local, en GB (por defecto {PRESUPUESTO_GB:g}; 0 la desactiva)")
+    pipeline.add_argument('--tiles', action='store_true',
+                          help=f"Con --render local, genera además una pirámide de teselas XYZ a {ESCALA_NATIVA}m para polígonos grandes")
+    pipeline.add_argument('--indices', default='NDVI',
+                          help="Índices a calcular por escena, separados por coma (NDVI, EVI, SAVI, NDWI, NBR); NDVI siempre se incluye")
+    pipeline.add_argument('--batch-timeseries', action='store_true',
+                          help="Calcula la serie temporal de todos los polígonos a la vez con reduceRegions antes de procesarlos")
+    pipeline.add_argument('--group-tiles', action='store_true',
+                          help="Agrupa los polígonos por las teselas Sentinel-2 que tocan y comparte los compuestos mensuales de cada grupo")
+    pipeline.add_argument('--scene-catalog', action='store_true',
+                          help="Mantiene un catálogo SQLite local de escenas por polígono para elegir escenas y contar sin consultar al servidor")
+    pipeline.add_argument('--ee-cache', action='store_true',
+                          help="Guarda las respuestas de Earth Engine en una caché local; las de ventanas pasadas no vencen")
+    pipeline.add_argument('--ee-max-rate', type=float, default=TASA_MAXIMA,
+                          help=f"Solicitudes por segundo máximas a Earth Engine; el limitador se ajusta por debajo según los 429/5xx y la latencia (por defecto {TASA_MAXIMA:g})")
+    pipeline.add_argument('--ee-max-concurrency', type=int, default=CONCURRENCIA_MAXIMA,
+                          help=f"Solicitudes simultáneas máximas a Earth Engine (por defecto {CONCURRENCIA_MAXIMA})")
+    pipeline.add_argument('--prometheus-textfile',
+                          help="Escribe además las métricas de la corrida en este archivo .prom para el textfile collector de Prometheus")
+    pipeline.add_argument('--parquet', action='store_true',
+                          help="Guarda además las estadísticas por escena en un dataset Parquet particionado por polígono y año")
+    pipeline.add_argument('--incremental', action='store_true',
+                          help="Actualiza la serie temporal guardada consultando solo escenas nuevas")
+    pipeline.add_argument('--keep-history', action='store_true',
+                          help="En modo incremental, conserva fechas anteriores a la ventana de 365 días")
+    
+    parser = argparse.ArgumentParser(description="Descarga imágenes y series temporales Sentinel-2 por polígono")
+    subcomandos = parser.add_subparsers(dest='comando', metavar='COMANDO')
+    for nombre, ayuda, padres in [
+        ('run', "Serie temporal, gráfico e imágenes de cada polígono (por defecto)", [filtros, fechas, pipeline, graficos]),
+        ('timeseries', "Solo la serie temporal y su gráfico", [filtros, fechas, pipeline, graficos]),
+        ('images', "Solo las imágenes y el manifiesto", [filtros, fechas, pipeline]),
+        ('plot', "Vuelve a dibujar los gráficos desde los CSV publicados, sin Earth Engine", [filtros, graficos]),
+        ('publish', "Regenera manifiestos, miniaturas e índice desde lo publicado, sin Earth Engine", [filtros]),
+        ('status', "Resume los productos publicados de cada polígono", [filtros]),
+        ('serve', "Servicio que procesa solo los polígonos con adquisiciones nuevas", [filtros, pipeline, graficos])
+    ]:
+        subparser = subcomandos.add_parser(nombre, help=ayuda, description=ayuda, parents=padres)
+        if nombre == 'plot':
+            subparser.add_argument('--force', action='store_true',
+                                   help="Dibuja aunque la serie no haya cambiado desde el último gráfico publicado")
+        elif nombre == 'status':
+            subparser.add_argument('--json', action='store_true', help="Imprime el estado en JSON")
+        elif nombre == 'serve':
+            subparser.add_argument('--interval', type=float, default=INTERVALO_SERVICIO_MIN,
+                                   help=f"Minutos entre búsquedas de adquisiciones nuevas (por defecto {INTERVALO_SERVICIO_MIN})")
+            subparser.add_argument('--once', action='store_true',
+                                   help="Busca adquisiciones nuevas una sola vez y termina al procesarlas")
+    
+    args = parser.parse_args(argv)
+    args.polygon = parse_poligonos(args.polygon)
+    if hasattr(args, 'chart_formats'):
+        try:
+            args.chart_formats = parse_formatos(args.chart_formats)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.chart_workers < 0:
+            parser.error("--chart-workers no puede ser negativo")
+    if args.comando not in COMANDOS_PIPELINE and args.comando != 'serve':
+        return args
+    
+    try:
+        args.indices = parse_indices(args.indices)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.workers < 1:
+        parser.error("--workers debe ser al menos 1")
+    if args.ee_max_rate <= 0:
+        parser.error("--ee-max-rate debe ser positivo")
+    if args.ee_max_concurrency < 1:
+        parser.error("--ee-max-concurrency debe ser al menos 1")
+    if args.download_workers < 1:
+        parser.error("--download-workers debe ser al menos 1")
+    if args.timeseries_workers < 1:
+        parser.error("--timeseries-workers debe ser al menos 1")
+    if args.image_format != 'png' and args.render != 'local':
+        parser.error("--image-format webp requiere --render local")
+    if args.tiles and args.render != 'local':
+        parser.error("--tiles requiere --render local")
+    if args.parquet and not pyarrow_disponible():
+        parser.error("--parquet requiere el paquete pyarrow (pip install pyarrow)")
+    if args.comando == 'serve':
+        if args.interval <= 0:
+            parser.error("--interval debe ser positivo")
+        if args.batch_timeseries or args.group_tiles:
+            parser.error("serve procesa cada polígono por separado: no admite --batch-timeseries ni --group-tiles")
+        return args
+    if args.keep_history and not args.incremental:
+        parser.error("--keep-history requiere --incremental")
+    
+    # Por defecto, el último año hasta hoy
+    args.end = args.end or datetime.now().strftime('%Y-%m-%d')
+    args.start = args.start or (datetime.strptime(args.end, '%Y-%m-%d') - timedelta(days=365)).strftime('%Y-%m-%d')
+    if args.start >= args.end:
+        parser.error("--start debe ser anterior a --end")
+    return args
+
+def main(argv=None):
+    """Función principal: ejecuta el subcomando pedido"""
+    args = parse_args(argv)
+    COMANDOS[args.comando](args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,199 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache_compuestos import copiar_miniatura, guardar_miniatura
+from diferido import importar_diferido
+from limitador import solicitud
+from metricas import contar, enviar, observar
+
+requests = importar_diferido('requests')
+Image = importar_diferido('PIL.Image')
+
+# Tamaño del pool de conexiones compartido por todos los hilos de descarga
+POOL_CONEXIONES = 32
+# Productos de un mismo polígono descargados a la vez
+MAX_WORKERS_DESCARGA = 5
+# Tamaño de los bloques en que se escribe cada descarga, para no tener la imagen entera en memoria
+TAMANO_BLOQUE = 256 * 1024
+
+FIRMA_PNG = b'\x89PNG\r\n\x1a\n'
+FIRMAS_TIFF = (b'II*\x00', b'MM\x00*')
+
+_sesion = None
+_sesion_lock = threading.Lock()
+
+def obtener_sesion():
+    """Devuelve la sesión HTTP compartida, creándola la primera vez, para reutilizar conexiones"""
+    global _sesion
+    with _sesion_lock:
+        if _sesion is None:
+            sesion = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONEXIONES, pool_maxsize=POOL_CONEXIONES)
+            sesion.mount('https://', adapter)
+            sesion.mount('http://', adapter)
+            _sesion = sesion
+        return _sesion
+
+def espera_backoff(intento, base=1.0, maximo=30.0):
+    """Calcula la espera antes de un reintento: backoff exponencial con jitter completo"""
+    return random.uniform(0, min(maximo, base * (2 ** intento)))
+
+def lado_esperado(params):
+    """Lado mayor en píxeles que debe tener la miniatura según sus parámetros (None si se pidió por escala)"""
+    dimensiones = params.get('dimensions') if params else None
+    if dimensiones is None:
+        return None
+    if isinstance(dimensiones, str):
+        return max(int(lado) for lado in dimensiones.lower().split('x'))
+    if isinstance(dimensiones, (list, tuple)):
+        return max(int(lado) for lado in dimensiones)
+    return int(dimensiones)
+
+def validar_imagen(ruta, lado=None):
+    """Verifica que el archivo sea un PNG o TIFF completo y decodificable; lanza una excepción si no.
+
+    Revisa la firma, abre el encabezado con PIL y recorre la estructura del archivo (en PNG,
+    los CRC de cada bloque hasta IEND), así que un archivo truncado o una página de error no
+    pasan. Si se da `lado`, el lado mayor de la imagen debe coincidir.
+    """
+    with open(ruta, 'rb') as f:
+        firma = f.read(8)
+    if firma.startswith(FIRMA_PNG):
+        formato = 'PNG'
+    elif firma[:4] in FIRMAS_TIFF:
+        formato = 'TIFF'
+    else:
+        raise ValueError(f"El archivo no es PNG ni TIFF (firma {firma[:8]!r})")
+    with Image.open(ruta) as imagen:
+        if imagen.format != formato:
+            raise ValueError(f"Encabezado {imagen.format} no coincide con la firma {formato}")
+        ancho, alto = imagen.size
+        imagen.verify()
+    if lado is not None and max(ancho, alto) != lado:
+        raise ValueError(f"Dimensiones {ancho}x{alto} distintas de las pedidas ({lado} px de lado mayor)")
+    return ancho, alto
+
+def _descargar_a_temporal(sesion, url, temporal):
+    """Descarga `url` a `temporal` por bloques, continuando con Range lo que ya se haya descargado.
+
+    Devuelve los bytes recibidos en esta petición. Si el servidor no acepta el rango, el archivo
+    se descarga de nuevo desde el principio. Con una respuesta sin compresión, el tamaño final
+    debe coincidir con Content-Length.
+    """
+    previo = os.path.getsize(temporal) if os.path.exists(temporal) else 0
+    encabezados = {'Range': f'bytes={previo}-'} if previo else {}
+    with sesion.get(url, timeout=60, stream=True, headers=encabezados) as response:
+        if previo and response.status_code == 416:
+            # El rango empieza en el final: el temporal ya está completo
+            return 0
+        response.raise_for_status()
+        reanudar = previo and response.status_code == 206 and \
+            response.headers.get('Content-Range', '').startswith(f'bytes {previo}-')
+        if previo and not reanudar:
+            previo = 0
+        if reanudar:
+            print(f"⏯️ Reanudando {os.path.basename(temporal)} desde {previo / 1024:.0f} KB")
+            contar('descargas_reanudadas')
+        esperado = response.headers.get('Content-Length')
+        sin_compresion = response.headers.get('Content-Encoding', 'identity') == 'identity'
+        recibidos = 0
+        with open(temporal, 'ab' if reanudar else 'wb') as f:
+            for bloque in response.iter_content(chunk_size=TAMANO_BLOQUE):
+                f.write(bloque)
+                recibidos += len(bloque)
+                contar('bytes_descargados', len(bloque))
+    if esperado is not None and sin_compresion and recibidos != int(esperado):
+        raise IOError(f"Descarga incompleta: {recibidos} de {esperado} bytes")
+    return recibidos
+
+def download_image_with_retry(url, output_path, max_retries=3, lado=None):
+    """Descarga una imagen con reintentos usando el pool de conexiones compartido.
+
+    La respuesta se escribe por bloques en un temporal junto al destino, que se valida
+    (ver `validar_imagen`) y recién entonces se renombra al destino de una vez. Los
+    reintentos de esta misma llamada continúan la descarga interrumpida con un pedido
+    Range. Entre corridas no se reanuda: el temporal vive en el staging del polígono y
+    cada corrida pide a Earth Engine una URL nueva, cuyo contenido no tiene por qué
+    coincidir byte a byte. Un archivo que no pasa la validación se descarta entero.
+    """
+    sesion = obtener_sesion()
+    temporal = f"{output_path}.parcial"
+    # Un temporal que no es de esta llamada corresponde a otra URL y no se puede continuar
+    if os.path.exists(temporal):
+        os.remove(temporal)
+    for attempt in range(max_retries):
+        try:
+            print(f"📥 Descargando: {os.path.basename(output_path)} (intento {attempt + 1})")
+
+            with solicitud('descarga_miniatura'):
+                _descargar_a_temporal(sesion, url, temporal)
+
+            try:
+                ancho, alto = validar_imagen(temporal, lado)
+            except Exception:
+                # Un archivo completo pero inválido no se puede reanudar
+                os.remove(temporal)
+                contar('descargas_invalidas')
+                raise
+
+            os.replace(temporal, output_path)
+            print(f"✅ {os.path.basename(output_path)} descargada correctamente ({ancho}x{alto} px)")
+            return True
+
+        except Exception as e:
+            print(f"⚠️ Error en intento {attempt + 1}: {str(e)}")
+            if attempt < max_retries - 1:
+                espera = espera_backoff(attempt)
+                print(f"🔄 Reintentando en {espera:.1f} segundos...")
+                contar('reintentos_descarga')
+                observar('espera_reintentos', espera)
+                time.sleep(espera)
+            else:
+                print(f"❌ Falló la descarga de {os.path.basename(output_path)} después de {max_retries} intentos")
+                if os.path.exists(temporal):
+                    os.remove(temporal)
+                return False
+
+    return False
+
+def descargar_producto(download, output_dir):
+    """Genera la URL de un producto de Earth Engine y lo descarga.
+
+    Si el producto trae una entrada de caché (`'cache'`) se copia de ella cuando existe y se
+    guarda en ella tras descargarlo.
+    """
+    try:
+        output_path = os.path.join(output_dir, download['filename'])
+        cache = download.get('cache')
+        if cache is not None and copiar_miniatura(cache, output_path):
+            print(f"💾 {download['description']} copiada de la caché de compuestos")
+            contar('cache_miniaturas_aciertos')
+            return True
+        print(f"🔗 Generando URL para {download['description']}...")
+        with solicitud('ee_thumb_url'):
+            url = download['image'].getThumbUrl(download['params'])
+        exito = download_image_with_retry(url, output_path, lado=lado_esperado(download['params']))
+        if exito and cache is not None:
+            guardar_miniatura(cache, output_path)
+        return exito
+    except Exception as e:
+        print(f"❌ Error generando/descargando {download['description']}: {str(e)}")
+        import traceback
+        print(traceback.format_exc())
+        return False
+
+def descargar_productos(downloads, output_dir, max_workers=MAX_WORKERS_DESCARGA):
+    """Descarga en paralelo todos los productos de un polígono y devuelve cuántos tuvieron éxito"""
+    if not downloads:
+        return 0
+
+    successful_downloads = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(downloads)))) as executor:
+        futuros = [enviar(executor, descargar_producto, download, output_dir) for download in downloads]
+        for futuro in as_completed(futuros):
+            if futuro.result():
+                successful_downloads += 1
+    return successful_downloads
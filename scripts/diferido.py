@@ -0,0 +1,35 @@
+import importlib.util
+import sys
+
+def importar_diferido(nombre):
+    """Importa el módulo `nombre` sin ejecutarlo hasta que se use alguno de sus atributos.
+
+    Si el módulo no está instalado falla en el momento, igual que `import`. Con nombres
+    con punto (p. ej. 'PIL.Image') el paquete padre sí se importa de inmediato, así que
+    solo conviene usarlo con padres livianos.
+    """
+    if nombre in sys.modules:
+        return sys.modules[nombre]
+    spec = importlib.util.find_spec(nombre)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{nombre}'", name=nombre)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    modulo = importlib.util.module_from_spec(spec)
+    sys.modules[nombre] = modulo
+    loader.exec_module(modulo)
+    padre, _, hijo = nombre.rpartition('.')
+    if padre:
+        setattr(sys.modules[padre], hijo, modulo)
+    return modulo
+
+def cargar(*nombres):
+    """Termina de importar los módulos diferidos `nombres` que ya estén registrados.
+
+    Se llama antes de lanzar hilos: en Python 3.11 LazyLoader no es seguro si dos hilos
+    tocan a la vez un módulo que todavía no se cargó.
+    """
+    for nombre in nombres:
+        modulo = sys.modules.get(nombre)
+        if modulo is not None:
+            getattr(modulo, '__name__')
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from diferido import importar_diferido
+
+# matplotlib se importa solo en los procesos que dibujan
+pd = importar_diferido('pandas')
+
+# Cambia cuando cambia el diseño del gráfico, para regenerar los que ya estaban guardados
+VERSION_GRAFICO = 1
+
+# Formatos de salida: PNG a 300 dpi (siempre), datos en JSON y SVG livianos para el tablero
+FORMATOS_GRAFICO = ('png', 'json', 'svg')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def parse_formatos(texto):
+    """Convierte 'png,svg' en una tupla de formatos válidos; PNG siempre va primero"""
+    pedidos = [f.strip().lower() for f in texto.split(',') if f.strip()]
+    desconocidos = [f for f in pedidos if f not in FORMATOS_GRAFICO]
+    if desconocidos:
+        raise ValueError(f"Formatos de gráfico no soportados: {', '.join(desconocidos)} "
+                         f"(disponibles: {', '.join(FORMATOS_GRAFICO)})")
+    return tuple(['png'] + [f for f in dict.fromkeys(pedidos) if f != 'png'])
+
+def datos_grafico(df):
+    """Columnas de la serie que dibuja el gráfico"""
+    return df[['date', 'ndvi_mean', 'cloud_cover']].copy()
+
+def huella_serie(datos, polygon_name, formatos):
+    """Hash de lo que determina el gráfico: datos, sitio, formatos y versión del diseño"""
+    contenido = datos.to_csv(index=False, date_format='%Y-%m-%d')
+    clave = f"{VERSION_GRAFICO}|{polygon_name}|{','.join(formatos)}|{contenido}"
+    return hashlib.sha256(clave.encode('utf-8')).hexdigest()
+
+def rutas_grafico(directorio, polygon_name, formatos):
+    """Rutas de salida del gráfico de un polígono por formato"""
+    return {formato: os.path.join(directorio, f"{polygon_name}_timeseries.{formato}") for formato in formatos}
+
+def figura_serie(datos, polygon_name):
+    """Figura de NDVI y cobertura de nubes con la API orientada a objetos (sin estado global de pyplot)"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(15, 8))
+    FigureCanvasAgg(fig)
+    ax_ndvi, ax_nubes = fig.subplots(2, 1)
+
+    ax_ndvi.plot(datos['date'], datos['ndvi_mean'], 'g-', linewidth=2, label='NDVI')
+    ax_ndvi.set_title(f'Serie Temporal NDVI - {polygon_name}', fontsize=14)
+    ax_ndvi.set_ylabel('NDVI', fontsize=12)
+    ax_ndvi.grid(True, alpha=0.3)
+    ax_ndvi.legend()
+
+    ax_nubes.plot(datos['date'], datos['cloud_cover'], 'r-', linewidth=1, alpha=0.7, label='Cobertura de nubes')
+    ax_nubes.set_title('Cobertura de Nubes', fontsize=14)
+    ax_nubes.set_xlabel('Fecha', fontsize=12)
+    ax_nubes.set_ylabel('Porcentaje (%)', fontsize=12)
+    ax_nubes.grid(True, alpha=0.3)
+    ax_nubes.legend()
+
+    fig.tight_layout()
+    return fig
+
+def renderizar_grafico(datos, polygon_name, directorio, formatos):
+    """Escribe el gráfico en los formatos pedidos y devuelve sus rutas; corre en el pool de procesos"""
+    import matplotlib
+    rutas = rutas_grafico(directorio, polygon_name, formatos)
+    datos = datos.assign(date=pd.to_datetime(datos['date']))
+    fig = figura_serie(datos, polygon_name)
+    fig.savefig(rutas['png'], dpi=300, bbox_inches='tight')
+    if 'svg' in rutas:
+        # Sin fecha ni ids aleatorios: la misma serie produce el mismo archivo
+        with matplotlib.rc_context({'svg.hashsalt': polygon_name}):
+            fig.savefig(rutas['svg'], format='svg', bbox_inches='tight', metadata={'Date': None})
+    if 'json' in rutas:
+        serie = {
+            'site': polygon_name,
+            'dates': datos['date'].dt.strftime('%Y-%m-%d').tolist(),
+            'ndvi_mean': [None if pd.isna(v) else round(float(v), 5) for v in datos['ndvi_mean']],
+            'cloud_cover': [None if pd.isna(v) else round(float(v), 3) for v in datos['cloud_cover']]
+        }
+        with open(rutas['json'], 'w', encoding='utf-8') as f:
+            json.dump(serie, f, separators=(',', ':'))
+    return rutas
+
+def obtener_pool(workers):
+    """Pool de procesos compartido para los gráficos, creado la primera vez.
+
+    Usa 'spawn': hacer fork de un proceso con hilos de descarga activos puede heredar
+    candados tomados.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def cerrar_pool():
+    """Espera a los gráficos pendientes y cierra el pool de procesos"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+
+def huella_vigente(cache_dir, polygon_name, huella, publicados):
+    """Indica si el gráfico publicado corresponde a `huella` y todos sus archivos existen"""
+    try:
+        with open(os.path.join(cache_dir, f"{polygon_name}.sha256"), 'r', encoding='utf-8') as f:
+            guardada = f.read().strip()
+    except OSError:
+        return False
+    return guardada == huella and all(os.path.exists(ruta) for ruta in publicados.values())
+
+def guardar_huella(cache_dir, polygon_name, huella):
+    """Recuerda la huella del gráfico recién publicado"""
+    os.makedirs(cache_dir, exist_ok=True)
+    ruta = os.path.join(cache_dir, f"{polygon_name}.sha256")
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        f.write(huella)
+    os.replace(temporal, ruta)
+
+def enviar_grafico(datos, polygon_name, directorio, publicado_dir, formatos, cache_dir, workers, forzar=False):
+    """Lanza el gráfico de un polígono y devuelve (futuro con sus rutas, huella).
+
+    Si la serie no cambió desde el gráfico publicado no se dibuja: los archivos publicados se
+    copian al `directorio` de staging para que la publicación los encuentre sin cambios, salvo
+    con `forzar`. Con `workers` 0 se dibuja en el mismo proceso.
+    """
+    huella = huella_serie(datos, polygon_name, formatos)
+    publicados = rutas_grafico(publicado_dir, polygon_name, formatos)
+    if not forzar and huella_vigente(cache_dir, polygon_name, huella, publicados):
+        rutas = rutas_grafico(directorio, polygon_name, formatos)
+        for formato, ruta in publicados.items():
+            shutil.copyfile(ruta, rutas[formato])
+        futuro = Future()
+        futuro.set_result(rutas)
+        print(f"♻️ Serie de {polygon_name} sin cambios: se conserva el gráfico publicado")
+        return futuro, huella
+    if workers == 0:
+        futuro = Future()
+        try:
+            futuro.set_result(renderizar_grafico(datos, polygon_name, directorio, formatos))
+        except Exception as e:
+            futuro.set_exception(e)
+        return futuro, huella
+    return obtener_pool(workers).submit(renderizar_grafico, datos, polygon_name, directorio, formatos), huella
@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+
+def cargar_teselas(ruta):
+    """Lee la caché {hash de polígono: [teselas MGRS]}; vacía si no existe o está dañada"""
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def guardar_teselas(ruta, teselas):
+    """Guarda la caché de teselas MGRS reemplazando el archivo de una vez"""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(teselas, f, indent=2, sort_keys=True)
+    os.replace(temporal, ruta)
+
+def agrupar_por_teselas(teselas_por_poligono):
+    """Agrupa los polígonos que comparten alguna tesela MGRS (componentes conexas).
+
+    Recibe {polygon_name: [teselas]} y devuelve una lista de grupos {'tiles', 'polygons'}
+    ordenada por sus teselas; un polígono sin teselas conocidas forma su propio grupo.
+    """
+    padre = {nombre: nombre for nombre in teselas_por_poligono}
+
+    def raiz(nombre):
+        while padre[nombre] != nombre:
+            padre[nombre] = padre[padre[nombre]]
+            nombre = padre[nombre]
+        return nombre
+
+    primero_por_tesela = {}
+    for nombre, teselas in sorted(teselas_por_poligono.items()):
+        for tesela in teselas:
+            if tesela in primero_por_tesela:
+                padre[raiz(nombre)] = raiz(primero_por_tesela[tesela])
+            else:
+                primero_por_tesela[tesela] = nombre
+
+    grupos = {}
+    for nombre in sorted(teselas_por_poligono):
+        grupo = grupos.setdefault(raiz(nombre), {'tiles': set(), 'polygons': []})
+        grupo['tiles'].update(teselas_por_poligono[nombre])
+        grupo['polygons'].append(nombre)
+
+    resultado = [{'tiles': sorted(g['tiles']), 'polygons': g['polygons']} for g in grupos.values()]
+    return sorted(resultado, key=lambda g: (g['tiles'] == [], g['tiles'], g['polygons']))
@@ -0,0 +1,44 @@
+# Índices espectrales de Sentinel-2 disponibles para las series temporales. Cada uno recibe
+# una imagen S2_SR_HARMONIZED (reflectancia escalada por 10000) y devuelve una banda.
+INDICES = {
+    'NDVI': lambda image: image.normalizedDifference(['B8', 'B4']),
+    'EVI': lambda image: image.expression(
+        '2.5 * (N - R) / (N + 6 * R - 7.5 * B + 1)',
+        {'N': image.select('B8').divide(10000), 'R': image.select('B4').divide(10000),
+         'B': image.select('B2').divide(10000)}),
+    'SAVI': lambda image: image.expression(
+        '1.5 * (N - R) / (N + R + 0.5)',
+        {'N': image.select('B8').divide(10000), 'R': image.select('B4').divide(10000)}),
+    # NDWI de McFeeters (agua superficial)
+    'NDWI': lambda image: image.normalizedDifference(['B3', 'B8']),
+    'NBR': lambda image: image.normalizedDifference(['B8', 'B12'])
+}
+
+# Estadísticos por índice: sufijo de la columna y nombre de la salida del reductor de Earth Engine
+ESTADISTICOS = {
+    'mean': 'mean',
+    'median': 'median',
+    'std': 'stdDev',
+    'p10': 'p10',
+    'p90': 'p90'
+}
+
+def parse_indices(texto):
+    """Convierte 'NDVI,EVI' en una tupla de índices válidos; NDVI siempre va primero"""
+    pedidos = [i.strip().upper() for i in texto.split(',') if i.strip()]
+    desconocidos = [i for i in pedidos if i not in INDICES]
+    if desconocidos:
+        raise ValueError(f"Índices no soportados: {', '.join(desconocidos)} (disponibles: {', '.join(INDICES)})")
+    return tuple(['NDVI'] + [i for i in dict.fromkeys(pedidos) if i != 'NDVI'])
+
+def imagen_indices(image, indices):
+    """Imagen multibanda con una banda por índice, nombrada como el índice"""
+    bandas = [INDICES[indice](image).rename(indice) for indice in indices]
+    imagen = bandas[0]
+    for banda in bandas[1:]:
+        imagen = imagen.addBands(banda)
+    return imagen
+
+def columnas_indice(indice):
+    """Columnas por escena de un índice, p. ej. evi_mean, evi_median, ..."""
+    return [f"{indice.lower()}_{sufijo}" for sufijo in ESTADISTICOS]
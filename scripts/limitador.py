@@ -0,0 +1,161 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from metricas import contar, observar, registrar
+
+# Límites por defecto para las solicitudes a Earth Engine (evaluaciones, URLs y descargas de miniaturas)
+TASA_MAXIMA = 10.0
+CONCURRENCIA_MAXIMA = 16
+
+TASA_MINIMA = 0.2
+# Crecimiento aditivo de la tasa (solicitudes/s) por cada solicitud exitosa
+PASO_TASA = 0.05
+# Disminución multiplicativa ante 429/5xx y, más suave, ante latencias altas
+FACTOR_SOBRECARGA = 0.5
+FACTOR_LATENCIA = 0.9
+# Congestión: la latencia reciente (promedio rápido) supera este múltiplo de la habitual (promedio lento)
+UMBRAL_LATENCIA = 2.0
+# Solicitudes de un tipo antes de juzgar su latencia
+MIN_MUESTRAS_LATENCIA = 10
+# Tras una disminución, las respuestas de las solicitudes que ya estaban en curso no vuelven a reducir
+VENTANA_DISMINUCION = 2.0
+# Tope de la pausa global pedida por un Retry-After
+MAX_PAUSA = 60.0
+
+# Fragmentos de mensajes de Earth Engine que indican sobrecarga o cuota, cuando la excepción no trae código HTTP
+MENSAJES_SOBRECARGA = ('too many requests', 'quota exceeded', 'rate limit', 'concurrency limit', 'capacity exceeded',
+                       'service unavailable', 'backend error', 'internal error', 'bad gateway', 'gateway timeout')
+
+_cond = threading.Condition()
+_estado = {}
+# {tipo: (solicitudes, promedio rápido, promedio lento)} de latencias
+_latencias = {}
+
+def configurar(tasa_maxima=TASA_MAXIMA, concurrencia_maxima=CONCURRENCIA_MAXIMA):
+    """Reinicia el limitador: arranca a la mitad de los máximos y se ajusta con las respuestas"""
+    with _cond:
+        _estado.update({
+            'tasa_maxima': float(tasa_maxima),
+            'concurrencia_maxima': int(concurrencia_maxima),
+            'tasa': max(TASA_MINIMA, tasa_maxima / 2),
+            'concurrencia': max(1.0, concurrencia_maxima / 2),
+            'tokens': 1.0,
+            'repuesto': time.monotonic(),
+            'en_curso': 0,
+            'pausa_hasta': 0.0,
+            'ultima_disminucion': 0.0,
+            'sobrecargas': 0
+        })
+        _latencias.clear()
+        _registrar_limites('inicio')
+
+def estado_limitador():
+    """Límites actuales: tasa (solicitudes/s), concurrencia, solicitudes en curso y sobrecargas vistas"""
+    with _cond:
+        return {'tasa': round(_estado['tasa'], 2), 'concurrencia': int(_estado['concurrencia']),
+                'en_curso': _estado['en_curso'], 'sobrecargas': _estado['sobrecargas']}
+
+def _registrar_limites(motivo):
+    registrar('limitador', motivo=motivo, tasa=round(_estado['tasa'], 2), concurrencia=int(_estado['concurrencia']))
+
+# Límites por defecto hasta que la corrida configure los suyos
+configurar()
+
+def es_sobrecarga(error):
+    """Indica si un error es un 429 o 5xx (por código HTTP o, en Earth Engine, por el mensaje)"""
+    codigo = getattr(getattr(error, 'response', None), 'status_code', None)
+    if codigo is not None:
+        return codigo == 429 or codigo >= 500
+    texto = str(error).lower()
+    return any(mensaje in texto for mensaje in MENSAJES_SOBRECARGA)
+
+def _retry_after(error):
+    """Segundos del encabezado Retry-After de la respuesta, si lo trae"""
+    respuesta = getattr(error, 'response', None)
+    try:
+        return min(MAX_PAUSA, float(respuesta.headers.get('Retry-After')))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _adquirir():
+    """Espera un token del balde y un lugar libre bajo el límite de concurrencia"""
+    inicio = time.monotonic()
+    with _cond:
+        while True:
+            ahora = time.monotonic()
+            _estado['tokens'] = min(max(1.0, _estado['tasa']),
+                                    _estado['tokens'] + (ahora - _estado['repuesto']) * _estado['tasa'])
+            _estado['repuesto'] = ahora
+            if ahora < _estado['pausa_hasta']:
+                espera = _estado['pausa_hasta'] - ahora
+            elif _estado['en_curso'] >= int(_estado['concurrencia']):
+                espera = None
+            elif _estado['tokens'] < 1:
+                espera = (1 - _estado['tokens']) / _estado['tasa']
+            else:
+                _estado['tokens'] -= 1
+                _estado['en_curso'] += 1
+                break
+            _cond.wait(espera)
+    esperado = time.monotonic() - inicio
+    if esperado > 0.01:
+        observar('limitador_espera', esperado)
+
+def _disminuir(factor, motivo):
+    ahora = time.monotonic()
+    if ahora - _estado['ultima_disminucion'] < VENTANA_DISMINUCION:
+        return
+    _estado['ultima_disminucion'] = ahora
+    _estado['tasa'] = max(TASA_MINIMA, _estado['tasa'] * factor)
+    _estado['concurrencia'] = max(1.0, _estado['concurrencia'] * factor)
+    _registrar_limites(motivo)
+
+def _liberar(tipo, latencia, error):
+    """Devuelve el lugar de la solicitud y ajusta los límites según su resultado (AIMD)"""
+    with _cond:
+        _estado['en_curso'] -= 1
+        if error is not None:
+            if es_sobrecarga(error):
+                _estado['sobrecargas'] += 1
+                contar('limitador_sobrecargas')
+                pausa = _retry_after(error)
+                if pausa:
+                    _estado['pausa_hasta'] = max(_estado['pausa_hasta'], time.monotonic() + pausa)
+                _disminuir(FACTOR_SOBRECARGA, 'sobrecarga')
+        else:
+            solicitudes, rapido, lento = _latencias.get(tipo, (0, latencia, latencia))
+            rapido = 0.7 * rapido + 0.3 * latencia
+            lento = 0.98 * lento + 0.02 * latencia
+            _latencias[tipo] = (solicitudes + 1, rapido, lento)
+            if solicitudes >= MIN_MUESTRAS_LATENCIA and rapido > UMBRAL_LATENCIA * lento:
+                _disminuir(FACTOR_LATENCIA, 'latencia')
+            else:
+                concurrencia = int(_estado['concurrencia'])
+                _estado['tasa'] = min(_estado['tasa_maxima'], _estado['tasa'] + PASO_TASA)
+                _estado['concurrencia'] = min(_estado['concurrencia_maxima'],
+                                              _estado['concurrencia'] + 1 / _estado['concurrencia'])
+                if int(_estado['concurrencia']) != concurrencia:
+                    _registrar_limites('aumento')
+        _cond.notify_all()
+
+@contextmanager
+def solicitud(tipo):
+    """Ejecuta el bloque como una solicitud `tipo` a Earth Engine bajo el limitador.
+
+    Espera turno según la tasa y la concurrencia actuales, mide la latencia (como `tipo` en
+    las métricas) y ajusta los límites: crecen de a poco con cada éxito y se reducen a la
+    mitad ante un 429/5xx o un poco ante latencias muy por encima de lo habitual.
+    """
+    _adquirir()
+    inicio = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        latencia = time.perf_counter() - inicio
+        observar(tipo, latencia)
+        _liberar(tipo, latencia, error)
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import math
+import os
+import re
+
+from diferido import importar_diferido
+from publicacion import hash_archivo
+from registro_poligonos import METROS_POR_GRADO
+
+Image = importar_diferido('PIL.Image')
+
+# Versión del formato de manifest.json e index.json; cambia solo si cambia su estructura
+VERSION_MANIFIESTO = 1
+
+# Lado mayor (px) de las miniaturas listadas en el manifiesto
+LADO_MINIATURA = 512
+
+# Nombres de archivo de los productos: escena (TIPO_YYYY-MM-DD) o compuesto mensual (TIPO_promedio_YYYY-MM),
+# y las diferencias contra el mes anterior (NDVI_Diff_YYYY-MM-DD) o entre compuestos (NDVI_Diff_YYYY-MM_YYYY-MM)
+PATRONES_PRODUCTO = [
+    (re.compile(r'^NDVI_Diff_(\d{4}-\d{2})_(\d{4}-\d{2})\.(png|webp)$'), 'ndvi_diff', 'composite'),
+    (re.compile(r'^NDVI_Diff_(\d{4}-\d{2}-\d{2})\.(png|webp)$'), 'ndvi_diff', 'scene'),
+    (re.compile(r'^(RGB|NDVI|FalseColor)_promedio_(\d{4}-\d{2})\.(png|webp)$'), None, 'composite'),
+    (re.compile(r'^(RGB|NDVI|FalseColor)_(\d{4}-\d{2}-\d{2})\.(png|webp)$'), None, 'scene')
+]
+
+def identificar_producto(nombre):
+    """Tipo (rgb, ndvi, falsecolor, ndvi_diff), origen (scene o composite) y fechas de un producto por su nombre"""
+    for patron, tipo, origen in PATRONES_PRODUCTO:
+        coincidencia = patron.match(nombre)
+        if coincidencia is None:
+            continue
+        grupos = coincidencia.groups()
+        if tipo is None:
+            return {'type': grupos[0].lower(), 'source': origen, 'date': grupos[1]}
+        producto = {'type': tipo, 'source': origen, 'date': grupos[0]}
+        if origen == 'composite':
+            producto['reference_date'] = grupos[1]
+        return producto
+    return None
+
+def generar_miniatura(ruta, ruta_miniatura):
+    """Guarda una versión reducida de la imagen (lado mayor LADO_MINIATURA px) y devuelve sus dimensiones originales"""
+    with Image.open(ruta) as imagen:
+        dimensiones = imagen.size
+        miniatura = imagen.copy()
+    miniatura.thumbnail((LADO_MINIATURA, LADO_MINIATURA))
+    os.makedirs(os.path.dirname(ruta_miniatura), exist_ok=True)
+    miniatura.save(ruta_miniatura, optimize=True)
+    return dimensiones
+
+def escala_producto(bbox, width, height):
+    """Metros por píxel de un producto de `width` x `height` px que cubre `bbox` (EPSG:4326).
+
+    Los productos se piden por escala o por dimensiones según el área del polígono, así que la
+    resolución real sale de la imagen y no de la escala de trabajo. Se informa el eje más grueso.
+    """
+    oeste, sur, este, norte = bbox
+    metros_x = (este - oeste) * METROS_POR_GRADO * math.cos(math.radians((sur + norte) / 2)) / width
+    metros_y = (norte - sur) * METROS_POR_GRADO / height
+    return round(max(metros_x, metros_y), 2)
+
+def _mas_reciente(productos, tipo, origen=None):
+    candidatos = [p for p in productos if p['type'] == tipo and (origen is None or p['source'] == origen)]
+    return max(candidatos, key=lambda p: p['date']) if candidatos else None
+
+def productos_destacados(productos):
+    """Productos que muestra el tablero, resueltos con las mismas reglas que antes aplicaba app.R.
+
+    RGB, NDVI y Falso Color de la escena más reciente (o del compuesto más reciente si el sitio
+    solo tiene compuestos); el NDVI promedio del mes anterior a esa escena o, sin escenas, el
+    penúltimo compuesto; y la diferencia NDVI más reciente.
+    """
+    con_escenas = any(p['source'] == 'scene' for p in productos)
+    origen = 'scene' if con_escenas else 'composite'
+    destacados = {}
+    for tipo in ('rgb', 'ndvi', 'falsecolor', 'ndvi_diff'):
+        producto = _mas_reciente(productos, tipo, origen)
+        destacados[tipo] = producto['file'] if producto else None
+
+    promedios = sorted((p for p in productos if p['type'] == 'ndvi' and p['source'] == 'composite'),
+                       key=lambda p: p['date'], reverse=True)
+    if con_escenas or len(promedios) < 2:
+        destacados['ndvi_mes_anterior'] = promedios[0]['file'] if promedios else None
+    else:
+        destacados['ndvi_mes_anterior'] = promedios[1]['file']
+    return destacados
+
+def generar_manifiesto(images_dir, polygon_name, bbox, serie=None, destino_dir=None):
+    """Escribe `images_dir`/manifest.json con los productos del sitio y sus miniaturas en thumbs/.
+
+    Las rutas son relativas al directorio del sitio, salvo las de la serie temporal (`serie`:
+    CSV, gráfico y sus formatos livianos), relativas a la raíz del proyecto. `revision` resume
+    el contenido, así que el manifiesto solo cambia cuando cambia algún producto. Con
+    `destino_dir` el manifiesto y las miniaturas se escriben allí en lugar de en `images_dir`.
+    El `scale_m` de cada producto sale de `bbox` (oeste, sur, este, norte) y del tamaño de la imagen.
+    """
+    destino_dir = destino_dir or images_dir
+    productos = []
+    for nombre in sorted(os.listdir(images_dir)):
+        producto = identificar_producto(nombre)
+        if producto is None:
+            continue
+        ruta = os.path.join(images_dir, nombre)
+        miniatura = f"thumbs/{nombre}"
+        width, height = generar_miniatura(ruta, os.path.join(destino_dir, miniatura))
+        productos.append({
+            'file': nombre,
+            **producto,
+            'scale_m': escala_producto(bbox, width, height),
+            'width': width,
+            'height': height,
+            'bytes': os.path.getsize(ruta),
+            'sha256': hash_archivo(ruta),
+            'thumbnail': miniatura
+        })
+
+    teselas = os.path.join(images_dir, 'tiles', 'tiles.json')
+    manifiesto = {
+        'version': VERSION_MANIFIESTO,
+        'site': polygon_name,
+        'revision': hashlib.sha256(''.join(p['sha256'] for p in productos).encode('utf-8')).hexdigest()[:16],
+        'latest': productos_destacados(productos),
+        'products': productos,
+        'tiles': 'tiles/tiles.json' if os.path.exists(teselas) else None,
+        'timeseries': serie or {}
+    }
+    ruta = os.path.join(destino_dir, 'manifest.json')
+    with open(ruta, 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, indent=2, ensure_ascii=False)
+    return ruta
+
+def actualizar_indice(imagenes_dir):
+    """Reescribe `imagenes_dir`/index.json con el resumen de los manifiestos publicados de todos los sitios.
+
+    Devuelve False sin escribir si el índice no cambió.
+    """
+    sitios = {}
+    for sitio in sorted(os.listdir(imagenes_dir)):
+        ruta = os.path.join(imagenes_dir, sitio, 'manifest.json')
+        try:
+            with open(ruta, 'r', encoding='utf-8') as f:
+                manifiesto = json.load(f)
+        except (OSError, ValueError):
+            continue
+        sitios[sitio] = {
+            'manifest': f"{sitio}/manifest.json",
+            'revision': manifiesto.get('revision'),
+            'latest': manifiesto.get('latest', {})
+        }
+    contenido = json.dumps({'version': VERSION_MANIFIESTO, 'sites': sitios}, indent=2, ensure_ascii=False)
+
+    ruta = os.path.join(imagenes_dir, 'index.json')
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            if f.read() == contenido:
+                return False
+    except OSError:
+        pass
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        f.write(contenido)
+    os.replace(temporal, ruta)
+    return True
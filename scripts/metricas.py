@@ -0,0 +1,162 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Polígono al que se atribuyen las métricas del hilo actual; los pools internos lo heredan con enviar()
+_poligono = contextvars.ContextVar('poligono', default=None)
+
+_lock = threading.Lock()
+# {(poligono, nombre): [llamadas, segundos totales, segundos máximos]}
+_tiempos = {}
+# {(poligono, nombre): valor}
+_contadores = {}
+_log = None
+
+def iniciar_corrida(metricas_dir):
+    """Abre el log JSON-lines de la corrida en `metricas_dir` y devuelve su ruta"""
+    global _log
+    os.makedirs(metricas_dir, exist_ok=True)
+    ruta = os.path.join(metricas_dir, f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}.jsonl")
+    _log = open(ruta, 'a', encoding='utf-8')
+    registrar('inicio', pid=os.getpid())
+    return ruta
+
+def registrar(evento, **campos):
+    """Agrega un evento al log de la corrida, con marca de tiempo y polígono actual"""
+    if _log is None:
+        return
+    linea = json.dumps({'ts': datetime.now(timezone.utc).isoformat(timespec='milliseconds'), 'evento': evento,
+                        'poligono': _poligono.get(), **campos}, ensure_ascii=False, default=str)
+    with _lock:
+        _log.write(linea + '\n')
+        _log.flush()
+
+@contextmanager
+def contexto_poligono(nombre):
+    """Atribuye al polígono `nombre` las métricas registradas dentro del bloque"""
+    token = _poligono.set(nombre)
+    try:
+        yield
+    finally:
+        _poligono.reset(token)
+
+def enviar(executor, fn, *args, **kwargs):
+    """executor.submit conservando el polígono actual en el hilo del pool"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def observar(nombre, segundos):
+    """Acumula una duración (etapa, latencia de Earth Engine o espera)"""
+    with _lock:
+        acumulado = _tiempos.setdefault((_poligono.get(), nombre), [0, 0.0, 0.0])
+        acumulado[0] += 1
+        acumulado[1] += segundos
+        acumulado[2] = max(acumulado[2], segundos)
+
+def contar(nombre, valor=1):
+    """Suma `valor` al contador `nombre` (bytes descargados, reintentos, aciertos de caché...)"""
+    with _lock:
+        clave = (_poligono.get(), nombre)
+        _contadores[clave] = _contadores.get(clave, 0) + valor
+
+@contextmanager
+def etapa(nombre):
+    """Mide el tiempo de pared del bloque como etapa `nombre` y lo registra en el log"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        segundos = time.perf_counter() - inicio
+        observar(nombre, segundos)
+        registrar('etapa', etapa=nombre, segundos=round(segundos, 3))
+
+def medir(fn):
+    """Decorador: cada llamada a `fn` es una etapa con el nombre de la función"""
+    @functools.wraps(fn)
+    def envoltura(*args, **kwargs):
+        with etapa(fn.__name__):
+            return fn(*args, **kwargs)
+    return envoltura
+
+def resumen():
+    """Totales de la corrida por nombre, sumando todos los polígonos"""
+    with _lock:
+        tiempos = {}
+        for (_, nombre), (llamadas, total, maximo) in _tiempos.items():
+            t = tiempos.setdefault(nombre, [0, 0.0, 0.0])
+            t[0] += llamadas
+            t[1] += total
+            t[2] = max(t[2], maximo)
+        contadores = {}
+        for (_, nombre), valor in _contadores.items():
+            contadores[nombre] = contadores.get(nombre, 0) + valor
+    return {
+        'tiempos': {n: {'llamadas': t[0], 'segundos': round(t[1], 3), 'maximo': round(t[2], 3)}
+                    for n, t in tiempos.items()},
+        'contadores': contadores
+    }
+
+def imprimir_tabla():
+    """Imprime la tabla de tiempos y contadores de la corrida, de mayor a menor tiempo total"""
+    datos = resumen()
+    if not datos['tiempos'] and not datos['contadores']:
+        return
+    print(f"\n{'etapa / operación':<36}{'llamadas':>10}{'total s':>11}{'media s':>10}{'máx s':>10}")
+    for nombre, t in sorted(datos['tiempos'].items(), key=lambda item: -item[1]['segundos']):
+        print(f"{nombre:<36}{t['llamadas']:>10}{t['segundos']:>11.1f}"
+              f"{t['segundos'] / t['llamadas']:>10.2f}{t['maximo']:>10.2f}")
+    for nombre, valor in sorted(datos['contadores'].items()):
+        print(f"{nombre:<36}{valor:>10}")
+
+def _etiqueta(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def escribir_prometheus(ruta):
+    """Escribe las métricas de la corrida en formato de texto de Prometheus (textfile collector)"""
+    with _lock:
+        tiempos = dict(_tiempos)
+        contadores = dict(_contadores)
+    lineas = [
+        '# HELP monitoreo_segundos Tiempo de pared acumulado por polígono y etapa en la última corrida',
+        '# TYPE monitoreo_segundos gauge'
+    ]
+    lineas += [f'monitoreo_segundos{{poligono="{_etiqueta(p or "")}",nombre="{_etiqueta(n)}"}} {t[1]:.3f}'
+               for (p, n), t in sorted(tiempos.items(), key=lambda item: (item[0][0] or '', item[0][1]))]
+    lineas += [
+        '# HELP monitoreo_llamadas Llamadas por polígono y etapa en la última corrida',
+        '# TYPE monitoreo_llamadas gauge'
+    ]
+    lineas += [f'monitoreo_llamadas{{poligono="{_etiqueta(p or "")}",nombre="{_etiqueta(n)}"}} {t[0]}'
+               for (p, n), t in sorted(tiempos.items(), key=lambda item: (item[0][0] or '', item[0][1]))]
+    lineas += [
+        '# HELP monitoreo_contador Contadores por polígono en la última corrida',
+        '# TYPE monitoreo_contador gauge'
+    ]
+    lineas += [f'monitoreo_contador{{poligono="{_etiqueta(p or "")}",nombre="{_etiqueta(n)}"}} {v}'
+               for (p, n), v in sorted(contadores.items(), key=lambda item: (item[0][0] or '', item[0][1]))]
+    lineas += [
+        '# HELP monitoreo_ultima_corrida_timestamp_seconds Fin de la última corrida',
+        '# TYPE monitoreo_ultima_corrida_timestamp_seconds gauge',
+        f'monitoreo_ultima_corrida_timestamp_seconds {time.time():.0f}'
+    ]
+    directorio = os.path.dirname(os.path.abspath(ruta))
+    os.makedirs(directorio, exist_ok=True)
+    # El collector puede leer en cualquier momento: se reemplaza el archivo de una vez
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lineas) + '\n')
+    os.replace(temporal, ruta)
+
+def cerrar_corrida(**campos):
+    """Registra el resumen de la corrida en el log y lo cierra"""
+    global _log
+    if _log is None:
+        return
+    registrar('resumen', **resumen(), **campos)
+    with _lock:
+        _log.close()
+        _log = None
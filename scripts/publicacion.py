@@ -0,0 +1,87 @@
+import hashlib
+import os
+import shutil
+
+# Extensiones de los productos publicados por polígono; otros archivos de los directorios no se tocan
+EXTENSIONES_IMAGENES = ('.png', '.webp', '.jpg', '.jpeg', '.tiff', '.tif')
+EXTENSIONES_SERIES = ('.csv', '.png', '.jpg', '.jpeg', '.svg', '.json')
+# Subdirectorios que genera la etapa de imágenes: si una corrida no los genera, se retiran los publicados
+SUBDIRECTORIOS_IMAGENES = ('tiles', 'thumbs')
+
+def preparar_staging(staging_dir, polygon_name):
+    """Crea vacío el staging del polígono y devuelve sus directorios (base, imágenes, series)"""
+    base = os.path.join(staging_dir, polygon_name)
+    shutil.rmtree(base, ignore_errors=True)
+    imagenes = os.path.join(base, 'imagenes')
+    series = os.path.join(base, 'timeseries')
+    os.makedirs(imagenes)
+    os.makedirs(series)
+    return base, imagenes, series
+
+def hash_archivo(ruta):
+    """SHA-256 del contenido de un archivo, leído por bloques"""
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+def mismo_contenido(a, b):
+    """Indica si dos archivos tienen el mismo contenido (primero compara tamaños)"""
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+    except OSError:
+        return False
+    return hash_archivo(a) == hash_archivo(b)
+
+def _archivos(directorio, recursivo):
+    """Rutas relativas de los archivos de `directorio` (solo el primer nivel si no es recursivo)"""
+    if not os.path.isdir(directorio):
+        return set()
+    if not recursivo:
+        return {n for n in os.listdir(directorio) if os.path.isfile(os.path.join(directorio, n))}
+    return {os.path.relpath(os.path.join(raiz, n), directorio)
+            for raiz, _, nombres in os.walk(directorio) for n in nombres}
+
+def publicar(staging_dir, destino_dir, extensiones, subdirectorios=()):
+    """Publica en `destino_dir` los productos generados en `staging_dir`, sin dejar ningún momento sin datos.
+
+    Los archivos nuevos o modificados reemplazan a los publicados con os.replace, que es
+    atómico, y los que no cambiaron (mismo hash de contenido) no se escriben. Después se
+    borran los productos publicados que esta corrida ya no generó: los del primer nivel con
+    alguna de las `extensiones` y todo lo que sobre dentro de los subdirectorios generados
+    y de los `subdirectorios` que esta publicación reemplaza entera aunque no los haya
+    generado (p. ej. las teselas de una corrida sin --tiles). Devuelve (actualizados,
+    sin_cambios, eliminados).
+    """
+    os.makedirs(destino_dir, exist_ok=True)
+    generados = _archivos(staging_dir, recursivo=True)
+    actualizados = sin_cambios = eliminados = 0
+    for relativa in sorted(generados):
+        origen = os.path.join(staging_dir, relativa)
+        destino = os.path.join(destino_dir, relativa)
+        if mismo_contenido(origen, destino):
+            os.remove(origen)
+            sin_cambios += 1
+            continue
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        os.replace(origen, destino)
+        actualizados += 1
+
+    subdirectorios = {relativa.split(os.sep)[0] for relativa in generados if os.sep in relativa} | set(subdirectorios)
+    obsoletos = {n for n in _archivos(destino_dir, recursivo=False) if n.lower().endswith(extensiones)}
+    for subdirectorio in subdirectorios:
+        obsoletos |= {os.path.join(subdirectorio, r)
+                      for r in _archivos(os.path.join(destino_dir, subdirectorio), recursivo=True)}
+    for relativa in sorted(obsoletos - generados):
+        try:
+            os.remove(os.path.join(destino_dir, relativa))
+            eliminados += 1
+        except OSError as e:
+            print(f"⚠️ Error eliminando {relativa}: {str(e)}")
+    for subdirectorio in subdirectorios:
+        for raiz, _, _ in sorted(os.walk(os.path.join(destino_dir, subdirectorio)), reverse=True):
+            if not os.listdir(raiz):
+                os.rmdir(raiz)
+    return actualizados, sin_cambios, eliminados
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import math
+import os
+import threading
+
+# Elipsoide WGS84, el mismo que usa Earth Engine para geometry.area()
+WGS84_A = 6378137.0
+WGS84_E2 = 0.00669437999014
+WGS84_E = math.sqrt(WGS84_E2)
+# Metros por grado de latitud, para convertir la escala en tolerancia de simplificación
+METROS_POR_GRADO = 111320.0
+# Resolución nativa (m) de las bandas B2/B3/B4/B8 de Sentinel-2, a la que se generan las teselas
+ESCALA_NATIVA = 10
+# Polígonos de hasta esta área (km²) se piden por dimensiones y no por escala
+MAX_AREA_POR_DIMENSIONES = 100
+# Versión del formato del registro; cambiarla invalida las entradas guardadas
+VERSION_REGISTRO = 2
+
+def escala_para_area(area_km2):
+    """Devuelve la escala (m) y dimensiones (px) adecuadas para un área en km²"""
+    if area_km2 > 1000:  # Área muy grande (>1000 km²)
+        return 60, 1024
+    elif area_km2 > 100:  # Área grande (100-1000 km²)
+        return 30, 1536
+    elif area_km2 > 10:  # Área mediana (10-100 km²)
+        return 20, 2048
+    elif area_km2 > 1:  # Área pequeña (1-10 km²)
+        return 10, 2048
+    else:  # Área muy pequeña (<1 km²)
+        return 10, 1024
+
+def extraer_poligonos(geojson_data):
+    """Devuelve las coordenadas de todos los polígonos de un GeoJSON como lista MultiPolygon"""
+    poligonos = []
+    for feature in geojson_data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            poligonos.append(geometry['coordinates'])
+        elif geometry.get('type') == 'MultiPolygon':
+            poligonos.extend(geometry['coordinates'])
+        else:
+            raise ValueError(f"Tipo de geometría no soportado: {geometry.get('type')}")
+    return poligonos
+
+def _q_autalica(lat):
+    """Función q de la latitud autálica del elipsoide WGS84"""
+    s = math.sin(math.radians(lat))
+    return (1 - WGS84_E2) * (s / (1 - WGS84_E2 * s * s)
+                             - math.log((1 - WGS84_E * s) / (1 + WGS84_E * s)) / (2 * WGS84_E))
+
+_QP = _q_autalica(90.0)
+# Radio de la esfera de igual área que el elipsoide
+RADIO_AUTALICO_M = WGS84_A * math.sqrt(_QP / 2)
+
+def area_anillo_m2(anillo):
+    """Área elipsoidal de un anillo lon/lat en m², proyectando las latitudes a la esfera autálica"""
+    total = 0.0
+    for (lon1, lat1), (lon2, lat2) in zip(anillo, anillo[1:]):
+        total += math.radians(lon2 - lon1) * (2 + _q_autalica(lat1) / _QP + _q_autalica(lat2) / _QP)
+    return abs(total * RADIO_AUTALICO_M * RADIO_AUTALICO_M / 2.0)
+
+def area_poligonos_km2(poligonos):
+    """Área total de una lista MultiPolygon en km², restando los huecos"""
+    area = 0.0
+    for poligono in poligonos:
+        area += area_anillo_m2(poligono[0])
+        for hueco in poligono[1:]:
+            area -= area_anillo_m2(hueco)
+    return area / 1000000
+
+def bbox_poligonos(poligonos):
+    """Caja envolvente [oeste, sur, este, norte] de una lista MultiPolygon"""
+    lons = [p[0] for poligono in poligonos for p in poligono[0]]
+    lats = [p[1] for poligono in poligonos for p in poligono[0]]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+def centroide_poligonos(poligonos):
+    """Centroide ponderado por área (planar en lon/lat) de los anillos exteriores"""
+    area_total = cx = cy = 0.0
+    for poligono in poligonos:
+        anillo = poligono[0]
+        for (x1, y1), (x2, y2) in zip(anillo, anillo[1:]):
+            cruz = x1 * y2 - x2 * y1
+            area_total += cruz
+            cx += (x1 + x2) * cruz
+            cy += (y1 + y2) * cruz
+    if area_total == 0:
+        oeste, sur, este, norte = bbox_poligonos(poligonos)
+        return [(oeste + este) / 2, (sur + norte) / 2]
+    return [cx / (3 * area_total), cy / (3 * area_total)]
+
+def _distancia_segmento(p, a, b):
+    """Distancia del punto p al segmento a-b en unidades de coordenadas"""
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+def simplificar_anillo(anillo, tolerancia):
+    """Simplifica un anillo cerrado con Douglas-Peucker manteniendo al menos 4 vértices"""
+    if len(anillo) <= 4:
+        return anillo
+    conservar = [False] * len(anillo)
+    conservar[0] = conservar[-1] = True
+    # El anillo empieza y termina en el mismo punto, así que se parte en el vértice más lejano
+    lejano = max(range(1, len(anillo) - 1), key=lambda i: math.hypot(anillo[i][0] - anillo[0][0], anillo[i][1] - anillo[0][1]))
+    conservar[lejano] = True
+    pendientes = [(0, lejano), (lejano, len(anillo) - 1)]
+    while pendientes:
+        inicio, fin = pendientes.pop()
+        if fin - inicio < 2:
+            continue
+        distancia_max, indice = 0.0, None
+        for i in range(inicio + 1, fin):
+            distancia = _distancia_segmento(anillo[i], anillo[inicio], anillo[fin])
+            if distancia > distancia_max:
+                distancia_max, indice = distancia, i
+        if indice is not None and distancia_max > tolerancia:
+            conservar[indice] = True
+            pendientes.append((inicio, indice))
+            pendientes.append((indice, fin))
+    simplificado = [p for p, c in zip(anillo, conservar) if c]
+    return simplificado if len(simplificado) >= 4 else anillo
+
+def simplificar_poligonos(poligonos, tolerancia):
+    """Simplifica todos los anillos de una lista MultiPolygon"""
+    return [[simplificar_anillo(anillo, tolerancia) for anillo in poligono] for poligono in poligonos]
+
+def contar_vertices(poligonos):
+    """Número total de vértices de una lista MultiPolygon"""
+    return sum(len(anillo) for poligono in poligonos for anillo in poligono)
+
+def pixel_minimo_grados(bbox, area_km2, scale, dimensions):
+    """Lado (grados) del píxel más fino con que se dibuja el polígono.
+
+    Los polígonos chicos se piden por dimensiones, así que su lado mayor se reparte en
+    `dimensions` píxeles, más finos que la escala de trabajo; los grandes se piden por escala
+    pero pueden teselarse a la resolución nativa.
+    """
+    if area_km2 <= MAX_AREA_POR_DIMENSIONES:
+        oeste, sur, este, norte = bbox
+        return min(scale / METROS_POR_GRADO, max(este - oeste, norte - sur) / dimensions)
+    return min(scale, ESCALA_NATIVA) / METROS_POR_GRADO
+
+def construir_registro(geojson_data, polygon_name, content_hash):
+    """Calcula localmente los metadatos derivados de un polígono"""
+    poligonos = extraer_poligonos(geojson_data)
+    if not poligonos:
+        raise ValueError("GeoJSON sin polígonos")
+
+    area_km2 = area_poligonos_km2(poligonos)
+    scale, dimensions = escala_para_area(area_km2)
+    bbox = bbox_poligonos(poligonos)
+    # Medio píxel del render más fino: la simplificación no cambia los píxeles tocados
+    tolerancia = pixel_minimo_grados(bbox, area_km2, scale, dimensions) / 2.0
+    simplificados = simplificar_poligonos(poligonos, tolerancia)
+
+    return {
+        'version': VERSION_REGISTRO,
+        'hash': content_hash,
+        'polygon_name': polygon_name,
+        'area_km2': area_km2,
+        'bbox': bbox,
+        'centroid': centroide_poligonos(poligonos),
+        'scale': scale,
+        'dimensions': dimensions,
+        'simplify_tolerance_deg': tolerancia,
+        'n_vertices': contar_vertices(poligonos),
+        'n_vertices_simplified': contar_vertices(simplificados),
+        'geometry': {'type': 'MultiPolygon', 'coordinates': poligonos},
+        'simplified': {'type': 'MultiPolygon', 'coordinates': simplificados}
+    }
+
+def cargar_poligono(ruta_geojson, registro_dir):
+    """Devuelve el registro de un polígono, calculándolo y guardándolo solo si su contenido cambió"""
+    with open(ruta_geojson, 'rb') as f:
+        contenido = f.read()
+    content_hash = hashlib.sha256(contenido).hexdigest()
+    polygon_name = os.path.splitext(os.path.basename(ruta_geojson))[0]
+    ruta_registro = os.path.join(registro_dir, f"{content_hash}.json")
+
+    if os.path.exists(ruta_registro):
+        try:
+            with open(ruta_registro, 'r', encoding='utf-8') as f:
+                registro = json.load(f)
+            if registro.get('version') == VERSION_REGISTRO:
+                registro['polygon_name'] = polygon_name
+                return registro
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Registro de polígono ilegible, se recalcula: {str(e)}")
+
+    registro = construir_registro(json.loads(contenido.decode('utf-8')), polygon_name, content_hash)
+
+    os.makedirs(registro_dir, exist_ok=True)
+    temporal = f"{ruta_registro}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(registro, f)
+    os.replace(temporal, ruta_registro)
+    print(f"🗂️ Polígono registrado: {polygon_name} ({registro['n_vertices']} → {registro['n_vertices_simplified']} vértices)")
+    return registro
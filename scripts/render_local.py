@@ -0,0 +1,172 @@
+import math
+import os
+import time
+from functools import lru_cache
+
+from descargas import espera_backoff
+from diferido import importar_diferido
+from limitador import solicitud
+from metricas import contar, observar
+
+ee = importar_diferido('ee')
+np = importar_diferido('numpy')
+Image = importar_diferido('PIL.Image')
+
+# Paletas usadas por Earth Engine y por el render local
+PALETA_NDVI = ['#d73027', '#f46d43', '#fdae61', '#fee08b', '#ffffbf', '#d9ef8b', '#a6d96a', '#66bd63', '#1a9850']
+PALETA_DIFF = ['#8B0000', '#FF4500', '#FFA500', '#FFFF00', '#FFFFFF', '#90EE90', '#32CD32', '#228B22', '#006400']
+
+# Conversión de metros a grados que aplica Earth Engine a la escala en EPSG:4326
+METROS_POR_GRADO = 111319.49079327357
+# Tamaño máximo de cada bloque pedido a computePixels (el límite del servidor es 48 MB)
+MAX_BYTES_BLOQUE = 16 * 1024 * 1024
+# Niveles de las tablas de color: un PNG indexado admite hasta 256 entradas
+NIVELES_PALETA = 256
+# Formatos de salida del render local y su extensión
+FORMATOS_IMAGEN = {'png': 'png', 'webp': 'webp'}
+
+def grilla_para_bbox(bbox, scale=None, dimensions=None):
+    """Define la grilla EPSG:4326 que cubre el bbox, por escala en metros o por dimensión máxima en píxeles"""
+    oeste, sur, este, norte = bbox
+    if scale is not None:
+        paso = scale / METROS_POR_GRADO
+    else:
+        paso = max(este - oeste, norte - sur) / dimensions
+    return {
+        'dimensions': {
+            'width': max(1, int(math.ceil((este - oeste) / paso))),
+            'height': max(1, int(math.ceil((norte - sur) / paso)))
+        },
+        'affineTransform': {
+            'scaleX': paso,
+            'shearX': 0,
+            'translateX': oeste,
+            'shearY': 0,
+            'scaleY': -paso,
+            'translateY': norte
+        },
+        'crsCode': 'EPSG:4326'
+    }
+
+def descargar_bandas(image, bands, grid, max_retries=3):
+    """Descarga los píxeles de `bands` en la grilla dada como arreglo float32 (bandas, alto, ancho).
+
+    La grilla se pide en bloques de filas para respetar el tamaño máximo de respuesta de computePixels.
+    """
+    ancho = grid['dimensions']['width']
+    alto = grid['dimensions']['height']
+    paso_y = grid['affineTransform']['scaleY']
+    filas_por_bloque = max(1, MAX_BYTES_BLOQUE // (ancho * len(bands) * 4))
+
+    resultado = np.zeros((len(bands), alto, ancho), dtype=np.float32)
+    expression = image.select(bands).toFloat()
+
+    for fila in range(0, alto, filas_por_bloque):
+        filas = min(filas_por_bloque, alto - fila)
+        bloque = {
+            'dimensions': {'width': ancho, 'height': filas},
+            'affineTransform': {**grid['affineTransform'],
+                                'translateY': grid['affineTransform']['translateY'] + fila * paso_y},
+            'crsCode': grid['crsCode']
+        }
+        for attempt in range(max_retries):
+            try:
+                with solicitud('ee_compute_pixels'):
+                    pixeles = ee.data.computePixels({
+                        'expression': expression,
+                        'fileFormat': 'NUMPY_NDARRAY',
+                        'grid': bloque
+                    })
+                contar('bytes_descargados', pixeles.nbytes)
+                break
+            except Exception as e:
+                print(f"⚠️ Error descargando píxeles (filas {fila}-{fila + filas}, intento {attempt + 1}): {str(e)}")
+                if attempt == max_retries - 1:
+                    raise
+                contar('reintentos_pixeles')
+                espera = espera_backoff(attempt)
+                observar('espera_reintentos', espera)
+                time.sleep(espera)
+        for i, band in enumerate(bands):
+            resultado[i, fila:fila + filas, :] = pixeles[band]
+
+    return resultado
+
+def indice_normalizado(a, b):
+    """(a - b) / (a + b) como normalizedDifference de Earth Engine, con 0 donde no está definido"""
+    suma = a + b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        indice = np.where(suma != 0, (a - b) / suma, 0)
+    return indice.astype(np.float32)
+
+def estirar_reflectancia(bandas, factor):
+    """Reproduce divide(10000).pow(0.7).multiply(factor).clamp(0, 1)"""
+    return np.clip(np.power(np.clip(bandas / 10000.0, 0, None), 0.7) * factor, 0, 1)
+
+def visualizar(valores, vmin, vmax, gamma=1.0):
+    """Escala valores a 0-255 como los parámetros min/max/gamma de getThumbUrl"""
+    normalizado = np.clip((valores - vmin) / (vmax - vmin), 0, 1)
+    if gamma != 1.0:
+        normalizado = np.power(normalizado, 1.0 / gamma)
+    return np.round(normalizado * 255).astype(np.uint8)
+
+def hex_a_rgb(paleta):
+    """Convierte una paleta de colores '#rrggbb' en un arreglo (n, 3)"""
+    return np.array([[int(c.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4)] for c in paleta], dtype=np.float32)
+
+@lru_cache(maxsize=None)
+def lut_paleta(paleta):
+    """Tabla (NIVELES_PALETA, 3) uint8 con la paleta interpolada linealmente como hace Earth Engine"""
+    colores = hex_a_rgb(paleta)
+    posicion = np.linspace(0, len(paleta) - 1, NIVELES_PALETA)
+    nodos = np.arange(len(paleta))
+    lut = np.stack([np.interp(posicion, nodos, colores[:, c]) for c in range(3)], axis=-1)
+    return np.round(lut).astype(np.uint8)
+
+def indices_paleta(valores, vmin, vmax):
+    """Cuantiza valores sobre [vmin, vmax] a índices 0-255 de la tabla de color"""
+    normalizado = np.clip((valores - vmin) / (vmax - vmin), 0, 1)
+    return np.round(normalizado * (NIVELES_PALETA - 1)).astype(np.uint8)
+
+def render_paleta(valores, vmin, vmax, paleta):
+    """Imagen indexada de 8 bits (modo 'P') con la tabla de color de la paleta"""
+    imagen = Image.fromarray(indices_paleta(valores, vmin, vmax), 'P')
+    imagen.putpalette(lut_paleta(tuple(paleta)).tobytes())
+    return imagen
+
+def guardar_imagen(imagen, output_path, formato='png'):
+    """Guarda una imagen PIL o un arreglo (alto, ancho, 3) uint8 en PNG optimizado o WebP"""
+    if isinstance(imagen, np.ndarray):
+        imagen = Image.fromarray(imagen, 'RGB')
+    if formato == 'webp':
+        if imagen.mode == 'P':
+            # WebP no tiene modo paleta; en modo sin pérdida reconstruye el índice de colores
+            imagen.convert('RGB').save(output_path, format='WEBP', lossless=True, method=6)
+        else:
+            imagen.save(output_path, format='WEBP', quality=90, method=6)
+    else:
+        imagen.save(output_path, format='PNG', optimize=True)
+    print(f"✅ {os.path.basename(output_path)} renderizada localmente ({os.path.getsize(output_path) / 1024:.0f} KB)")
+    return True
+
+def render_rgb(bandas, factor, gamma):
+    """Compone una imagen de 3 bandas con el estiramiento de reflectancia y gamma de Earth Engine"""
+    estirado = estirar_reflectancia(bandas, factor)
+    return np.transpose(visualizar(estirado, 0, 1, gamma), (1, 2, 0))
+
+def render_productos(productos, output_dir, formato='png'):
+    """Renderiza y guarda una lista de productos locales; devuelve cuántos se guardaron.
+
+    Cada producto es un dict con 'filename', 'description' y una función 'render' que devuelve
+    una imagen PIL o un arreglo RGB uint8. La extensión del archivo se ajusta a `formato`.
+    """
+    successful = 0
+    for producto in productos:
+        try:
+            imagen = producto['render']()
+            filename = f"{os.path.splitext(producto['filename'])[0]}.{FORMATOS_IMAGEN[formato]}"
+            guardar_imagen(imagen, os.path.join(output_dir, filename), formato)
+            successful += 1
+        except Exception as e:
+            print(f"❌ Error renderizando {producto['description']}: {str(e)}")
+    return successful
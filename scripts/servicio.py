@@ -0,0 +1,46 @@
+import heapq
+import json
+import os
+import threading
+
+def cargar_estado(ruta):
+    """Estado del servicio: última adquisición procesada por polígono ({} si no existe)"""
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def guardar_estado(ruta, estado):
+    """Guarda el estado del servicio reemplazando el archivo de una vez"""
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(estado, f, indent=2, ensure_ascii=False, sort_keys=True)
+    os.replace(temporal, ruta)
+
+def nueva_cola():
+    """Cola de prioridad de polígonos pendientes, sin repetidos"""
+    return {'heap': [], 'trabajos': {}}
+
+def encolar(cola, nombre, atraso_dias, area_km2, trabajo):
+    """Agrega un polígono a la cola; devuelve False si ya estaba (entonces solo actualiza su trabajo).
+
+    Sale primero el más atrasado respecto de lo publicado y, a igual atraso, el de menor área,
+    que llega antes al tablero.
+    """
+    if nombre in cola['trabajos']:
+        cola['trabajos'][nombre].update(trabajo)
+        return False
+    cola['trabajos'][nombre] = dict(trabajo)
+    heapq.heappush(cola['heap'], (-atraso_dias, area_km2, nombre))
+    return True
+
+def desencolar(cola):
+    """Saca el polígono más prioritario y devuelve (nombre, trabajo)"""
+    _, _, nombre = heapq.heappop(cola['heap'])
+    return nombre, cola['trabajos'].pop(nombre)
+
+def pendientes(cola):
+    """Número de polígonos en la cola"""
+    return len(cola['heap'])
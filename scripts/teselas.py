@@ -0,0 +1,145 @@
+import json
+import math
+import os
+import shutil
+
+from diferido import importar_diferido
+
+np = importar_diferido('numpy')
+Image = importar_diferido('PIL.Image')
+ImageDraw = importar_diferido('PIL.ImageDraw')
+
+TAMANO_TESELA = 256
+# Resolución (m/px) de Web Mercator en zoom 0 sobre el ecuador
+RESOLUCION_Z0 = 2 * math.pi * 6378137.0 / TAMANO_TESELA
+# Niveles por debajo del nativo que se generan como máximo
+NIVELES_PIRAMIDE = 6
+# Lado máximo de la vista general de baja resolución
+LADO_VISTA_GENERAL = 512
+
+def zoom_nativo(scale, lat):
+    """Menor zoom XYZ cuya resolución en la latitud dada es igual o mejor que `scale` metros"""
+    return max(0, int(math.ceil(math.log2(RESOLUCION_Z0 * math.cos(math.radians(lat)) / scale))))
+
+def _px_de_lon(lon, z):
+    return (lon + 180.0) / 360.0 * TAMANO_TESELA * 2 ** z
+
+def _px_de_lat(lat, z):
+    s = math.sin(math.radians(lat))
+    return (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * TAMANO_TESELA * 2 ** z
+
+def _lon_de_px(px, z):
+    return px / (TAMANO_TESELA * 2 ** z) * 360.0 - 180.0
+
+def _lat_de_px(py, z):
+    n = math.pi - 2 * math.pi * py / (TAMANO_TESELA * 2 ** z)
+    return np.degrees(np.arctan(np.sinh(n)))
+
+def mascara_poligonos(poligonos, grid):
+    """Rasteriza una lista MultiPolygon lon/lat en la grilla EPSG:4326 (True dentro del polígono)"""
+    ancho = grid['dimensions']['width']
+    alto = grid['dimensions']['height']
+    t = grid['affineTransform']
+    mascara = Image.new('L', (ancho, alto), 0)
+    dibujo = ImageDraw.Draw(mascara)
+    for poligono in poligonos:
+        for i, anillo in enumerate(poligono):
+            puntos = [((lon - t['translateX']) / t['scaleX'], (lat - t['translateY']) / t['scaleY']) for lon, lat in anillo]
+            # El primer anillo es el exterior; los siguientes son huecos
+            dibujo.polygon(puntos, fill=255 if i == 0 else 0)
+    return np.asarray(mascara) > 0
+
+def a_rgba(imagen, mascara):
+    """Convierte una imagen PIL o arreglo RGB en RGBA transparente fuera de la máscara"""
+    if isinstance(imagen, Image.Image):
+        imagen = np.asarray(imagen.convert('RGB'))
+    alfa = np.where(mascara, 255, 0).astype(np.uint8)
+    return np.dstack([imagen, alfa])
+
+def reproyectar_zoom(rgba, grid, bbox, z):
+    """Remuestrea (vecino más cercano) la imagen EPSG:4326 al mosaico Web Mercator del zoom z.
+
+    Devuelve el mosaico RGBA alineado a teselas y el índice (x, y) de su primera tesela.
+    La transformación es separable: la longitud depende solo de la columna y la latitud solo de la fila.
+    """
+    oeste, sur, este, norte = bbox
+    t = grid['affineTransform']
+    alto, ancho = rgba.shape[:2]
+
+    tx0 = int(_px_de_lon(oeste, z) // TAMANO_TESELA)
+    tx1 = int(_px_de_lon(este, z) // TAMANO_TESELA)
+    ty0 = int(_px_de_lat(norte, z) // TAMANO_TESELA)
+    ty1 = int(_px_de_lat(sur, z) // TAMANO_TESELA)
+
+    px = np.arange(tx0 * TAMANO_TESELA, (tx1 + 1) * TAMANO_TESELA) + 0.5
+    py = np.arange(ty0 * TAMANO_TESELA, (ty1 + 1) * TAMANO_TESELA) + 0.5
+    columnas = np.floor((_lon_de_px(px, z) - t['translateX']) / t['scaleX']).astype(np.int64)
+    filas = np.floor((_lat_de_px(py, z) - t['translateY']) / t['scaleY']).astype(np.int64)
+
+    columnas_validas = (columnas >= 0) & (columnas < ancho)
+    filas_validas = (filas >= 0) & (filas < alto)
+    mosaico = rgba[np.clip(filas, 0, alto - 1)][:, np.clip(columnas, 0, ancho - 1)]
+    mosaico[~filas_validas, :, 3] = 0
+    mosaico[:, ~columnas_validas, 3] = 0
+    return mosaico, tx0, ty0
+
+def generar_piramide(rgba, grid, bbox, output_dir, scale):
+    """Escribe la pirámide XYZ {z}/{x}/{y}.png, la vista general y tiles.json; devuelve el número de teselas"""
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    lat_centro = (bbox[1] + bbox[3]) / 2
+    zoom_max = zoom_nativo(scale, lat_centro)
+    total = 0
+    zoom_min = zoom_max
+    for z in range(zoom_max, max(-1, zoom_max - NIVELES_PIRAMIDE - 1), -1):
+        zoom_min = z
+        mosaico, tx0, ty0 = reproyectar_zoom(rgba, grid, bbox, z)
+        filas_teselas = mosaico.shape[0] // TAMANO_TESELA
+        columnas_teselas = mosaico.shape[1] // TAMANO_TESELA
+        for j in range(filas_teselas):
+            for i in range(columnas_teselas):
+                tesela = mosaico[j * TAMANO_TESELA:(j + 1) * TAMANO_TESELA, i * TAMANO_TESELA:(i + 1) * TAMANO_TESELA]
+                if not tesela[:, :, 3].any():
+                    continue
+                ruta = os.path.join(output_dir, str(z), str(tx0 + i), f"{ty0 + j}.png")
+                os.makedirs(os.path.dirname(ruta), exist_ok=True)
+                Image.fromarray(tesela, 'RGBA').save(ruta, optimize=True)
+                total += 1
+        # Con una sola tesela el polígono ya cabe entero; no hace falta bajar más
+        if filas_teselas * columnas_teselas <= 1:
+            break
+
+    vista = Image.fromarray(rgba, 'RGBA')
+    vista.thumbnail((LADO_VISTA_GENERAL, LADO_VISTA_GENERAL))
+    vista.save(os.path.join(output_dir, 'overview.png'), optimize=True)
+
+    with open(os.path.join(output_dir, 'tiles.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'tilejson': '2.2.0',
+            'scheme': 'xyz',
+            'tiles': ['{z}/{x}/{y}.png'],
+            'minzoom': zoom_min,
+            'maxzoom': zoom_max,
+            'bounds': bbox,
+            'center': [(bbox[0] + bbox[2]) / 2, lat_centro, zoom_min],
+            'scale_m': scale,
+            'overview': 'overview.png'
+        }, f, indent=2)
+    return total
+
+def generar_teselas_productos(productos, grid, bbox, poligonos, tiles_dir, scale):
+    """Genera una pirámide por producto en `tiles_dir/<nombre del archivo>`; devuelve cuántos productos se teselaron"""
+    mascara = mascara_poligonos(poligonos, grid)
+    successful = 0
+    for producto in productos:
+        try:
+            nombre = os.path.splitext(producto['filename'])[0]
+            rgba = a_rgba(producto['render'](), mascara)
+            total = generar_piramide(rgba, grid, bbox, os.path.join(tiles_dir, nombre), scale)
+            print(f"🧩 Teselas de {producto['description']}: {total}")
+            successful += 1
+        except Exception as e:
+            print(f"❌ Error generando teselas de {producto['description']}: {str(e)}")
+    return successful